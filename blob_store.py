@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""Content-addressed store for plugin output files.
+
+Files are kept in output_directory/blobs, named by the sha256 of their content
+and sharded into two levels of subdirectories, so that no directory grows too
+large:
+
+  blobs/3a/7f/3a7f...e1.mp4
+
+Identical outputs are stored once. The index, kept in
+output_directory/data/blobs.json, maps the name a file would have had in the
+flat files directory, the safename plus extension, to its blob:
+
+{
+  "video-title.mp4": "blobs/3a/7f/3a7f...e1.mp4",
+  ...
+}
+
+Processes sharing the store each save the names they added, merged into the
+index as it is on disk at that time.
+
+Temporary directories for plugins are created inside the store, in blobs/tmp,
+so that adding their output is a rename rather than a copy. Output from
+elsewhere is copied to a partial file there first, so that a blob is never
+partly written. What dead processes leave in blobs/tmp is removed when the
+store is loaded, once it is older than a lease and its video is not leased.
+"""
+
+import errno
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import json
+
+import file_util
+import lease_table
+
+
+BLOBS_DIRECTORY = 'blobs'
+TEMP_DIRECTORY = 'tmp'
+INDEX_FILENAME = 'blobs.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+PARTIAL_SUFFIX = '.partial'
+
+
+def hash_file(path):
+  digest = hashlib.sha256()
+  fp = open(path, 'rb')
+  try:
+    while True:
+      chunk = fp.read(HASH_CHUNK_SIZE)
+      if not chunk:
+        break
+      digest.update(chunk)
+  finally:
+    fp.close()
+  return digest.hexdigest()
+
+
+class BlobStore(object):
+  def __init__(self, output_directory, max_age=lease_table.LEASE_DURATION):
+    self.output_directory = output_directory
+    self.root = os.path.join(output_directory, BLOBS_DIRECTORY)
+    self.temp_root = os.path.join(self.root, TEMP_DIRECTORY)
+    # Age after which temporary files of dead processes are removed.
+    self.max_age = max_age
+    self.index_path = os.path.join(output_directory, 'data', INDEX_FILENAME)
+    self.names = {}
+    # Names added since the index was last saved.
+    self.changes = {}
+    self.dirty = False
+    self.lock = threading.Lock()
+
+  def load(self):
+    """Load the index from disk, if it exists, and clean up temporary files."""
+    self._remove_stale_temp_files()
+    self._load_index()
+
+  def _load_index(self):
+    try:
+      fp = open(self.index_path, 'r')
+    except IOError:
+      e = sys.exc_info()[1]
+      if e.errno == errno.ENOENT:
+        return
+      else:
+        raise
+    content = fp.read()
+    fp.close()
+    self.names = json.loads(content)
+    self.names.update(self.changes)
+
+  def save(self):
+    """Save the index to disk, if it has been modified."""
+    with self.lock:
+      if not self.dirty:
+        return
+      with file_util.output_lock(self.output_directory,
+                                  self.index_path):
+        self._load_index()
+        file_util.write_atomic(self.index_path, [
+          json.dumps(self.names, indent=2, separators=(',', ': '),
+                     sort_keys=True)])
+      self.changes = {}
+      self.dirty = False
+
+  def make_temp_directory(self, video_id):
+    """Return a new empty directory, on the same filesystem as the store.
+
+    It is named after video_id, which must be leased while it is in use.
+    """
+    file_util.mkdir_p(self.temp_root)
+    return tempfile.mkdtemp(prefix=video_id + '.', dir=self.temp_root)
+
+  def _remove_stale_temp_files(self):
+    """Remove what dead processes left in the temporary directory.
+
+    Partial files are written to until they are complete, so they are stale
+    once older than max_age. Plugin directories are also kept while their
+    video is leased, as plugins may not write to them for a long time.
+    """
+    try:
+      names = os.listdir(self.temp_root)
+    except OSError:
+      e = sys.exc_info()[1]
+      if e.errno == errno.ENOENT:
+        return
+      else:
+        raise
+    leased = None
+    now = time.time()
+    for name in names:
+      path = os.path.join(self.temp_root, name)
+      try:
+        if now - os.path.getmtime(path) < self.max_age:
+          continue
+      except OSError:
+        # Removed by another process.
+        continue
+      if not name.endswith(PARTIAL_SUFFIX):
+        if leased is None:
+          leased = lease_table.LeaseTable(self.output_directory).leased()
+        if name.split('.')[0] in leased:
+          continue
+      if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+        continue
+      try:
+        os.unlink(path)
+      except OSError:
+        e = sys.exc_info()[1]
+        if e.errno != errno.ENOENT:
+          raise
+
+  def add(self, path, name):
+    """Move the file at path into the store, recording it under name.
+
+    Return the path of the blob, relative to the output directory. If a blob
+    with the same content exists, the file is removed instead.
+    """
+    digest = hash_file(path)
+    ext = os.path.splitext(path)[1]
+    relative = os.path.join(BLOBS_DIRECTORY, digest[0:2], digest[2:4],
+                            digest + ext)
+    target = os.path.join(self.output_directory, relative)
+    if os.path.exists(target):
+      os.unlink(path)
+    else:
+      file_util.mkdir_p(os.path.dirname(target))
+      # A rename when path is on the same filesystem. Otherwise the copy is
+      # only renamed to target once complete.
+      file_util.mkdir_p(self.temp_root)
+      (fd, partial) = tempfile.mkstemp(suffix=PARTIAL_SUFFIX,
+                                       dir=self.temp_root)
+      os.close(fd)
+      shutil.move(path, partial)
+      os.rename(partial, target)
+    with self.lock:
+      self.names[name] = relative
+      self.changes[name] = relative
+      self.dirty = True
+    return relative
+
+  def get(self, name):
+    """Return the path of the blob recorded under name, or None."""
+    return self.names.get(name)
@@ -0,0 +1,94 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import blob_store
+import lease_table
+
+
+class BlobStoreTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.temp_directory, 'data'))
+    self.store = blob_store.BlobStore(self.temp_directory)
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def write_output(self, filename, content):
+    path = os.path.join(self.store.make_temp_directory('v1'), filename)
+    fp = open(path, 'w')
+    fp.write(content)
+    fp.close()
+    return path
+
+  def test_artifact_path(self):
+    path = self.write_output('out.mp4', 'content')
+    relative = self.store.add(path, 'video-title.mp4')
+    digest = hashlib.sha256(b'content').hexdigest()
+    self.assertEqual(relative, os.path.join('blobs', digest[0:2], digest[2:4],
+                                            digest + '.mp4'))
+    self.assertFalse(os.path.exists(path))
+    fp = open(os.path.join(self.temp_directory, relative), 'r')
+    self.assertEqual(fp.read(), 'content')
+    fp.close()
+    self.assertEqual(self.store.get('video-title.mp4'), relative)
+    self.assertEqual(self.store.get('other-title.mp4'), None)
+
+  def test_dedupe(self):
+    first = self.store.add(self.write_output('a.mp4', 'same'), 'first.mp4')
+    second = self.store.add(self.write_output('b.mp4', 'same'), 'second.mp4')
+    other = self.store.add(self.write_output('c.mp4', 'other'), 'other.mp4')
+    self.assertEqual(first, second)
+    self.assertNotEqual(first, other)
+    blobs = []
+    for (directory, subdirectories, filenames) in os.walk(
+        os.path.join(self.temp_directory, 'blobs')):
+      if os.path.basename(directory) != blob_store.TEMP_DIRECTORY:
+        blobs.extend(filenames)
+    self.assertEqual(len(blobs), 2)
+
+  def test_temp_directory_in_store(self):
+    directory = self.store.make_temp_directory('v1')
+    self.assertEqual(os.listdir(directory), [])
+    self.assertEqual(os.path.dirname(directory),
+                     os.path.join(self.temp_directory, 'blobs',
+                                  blob_store.TEMP_DIRECTORY))
+
+  def test_remove_stale_temp_files(self):
+    stale = time.time() - 2 * self.store.max_age
+    def make_temp_file(video_id, age):
+      directory = self.store.make_temp_directory(video_id)
+      os.utime(directory, (age, age))
+      return directory
+    dead = make_temp_file('v1', stale)
+    leased = make_temp_file('v2', stale)
+    fresh = make_temp_file('v3', time.time())
+    partial = os.path.join(self.store.temp_root,
+                           'abc' + blob_store.PARTIAL_SUFFIX)
+    open(partial, 'w').close()
+    os.utime(partial, (stale, stale))
+    table = lease_table.LeaseTable(self.temp_directory)
+    table.claim(['v2'])
+    self.store.load()
+    self.assertFalse(os.path.exists(dead))
+    self.assertFalse(os.path.exists(partial))
+    self.assertTrue(os.path.exists(leased))
+    self.assertTrue(os.path.exists(fresh))
+
+  def test_save_merges(self):
+    other = blob_store.BlobStore(self.temp_directory)
+    first = self.store.add(self.write_output('a.mp4', 'a'), 'a.mp4')
+    second = other.add(self.write_output('b.mp4', 'b'), 'b.mp4')
+    self.store.save()
+    other.save()
+    loaded = blob_store.BlobStore(self.temp_directory)
+    loaded.load()
+    self.assertEqual(loaded.names, {'a.mp4': first, 'b.mp4': second})
+
+
+if __name__ == '__main__':
+  unittest.main()
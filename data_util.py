@@ -2,30 +2,70 @@
 
 """Utilities for manipulating metadata."""
 
-import datetime
 import time
 import re
 
 
-def normalize_name(title):
-  accum = ''
-  for ch in title.lower():
-    if ord(ch) > 127:
-      accum += ('--x%x' % ord(ch))
-    elif ch in ['/', ':', ' ']:
-      accum += '-'
-    elif ch in ['(', ')']:
-      pass
+NAME_MAX_LENGTH = 200
+NAME_CACHE_SIZE = 100000
+TIMESTAMP_CACHE_SIZE = 100000
+TIMESTAMP_PATTERN = re.compile(
+  r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?Z$')
+
+
+class NameTranslation(dict):
+  """Translation table for normalize_name, filled in as characters are seen."""
+  def __missing__(self, codepoint):
+    if codepoint > 127:
+      value = '--x%x' % codepoint
     else:
-      accum += ch
-  if len(accum) > 200:
-    accum = accum[0:200]
-  return accum
+      value = codepoint
+    self[codepoint] = value
+    return value
+
+
+NAME_TRANSLATION = NameTranslation({ord('/'): u'-', ord(':'): u'-',
+                                    ord(' '): u'-', ord('('): None,
+                                    ord(')'): None})
+normalized_names = {}
+hour_timestamps = {}
+
+
+def normalize_name(title):
+  name = normalized_names.get(title)
+  if name is None:
+    name = title.lower()
+    if isinstance(name, bytes):
+      # Python 2 str, each byte is translated as its own character.
+      name = name.decode('latin-1')
+    name = name.translate(NAME_TRANSLATION)[0:NAME_MAX_LENGTH]
+    if len(normalized_names) >= NAME_CACHE_SIZE:
+      normalized_names.clear()
+    normalized_names[title] = name
+  return name
 
 
 def create_timestamp(text):
-  dt = datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.000Z')
-  return int(time.mktime(dt.timetuple()))
+  """Convert a Youtube API time, such as 2009-02-13T18:31:30.000Z, to seconds.
+
+  The time is interpreted as local time, as it always has been, so that new
+  timestamps stay comparable with those already saved in feeds. time.mktime
+  is only called once per hour.
+  """
+  if not TIMESTAMP_PATTERN.match(text):
+    raise ValueError('Cannot parse time: %s' % (text,))
+  # Cached by hour, which assumes that the UTC offset is the same for a whole
+  # local hour. That holds where daylight saving moves clocks by a whole hour
+  # on the hour, but not for the half hour shifts of Australia/Lord_Howe.
+  hour = text[0:13]
+  base = hour_timestamps.get(hour)
+  if base is None:
+    base = int(time.mktime((int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                            int(text[11:13]), 0, 0, 0, 0, -1)))
+    if len(hour_timestamps) >= TIMESTAMP_CACHE_SIZE:
+      hour_timestamps.clear()
+    hour_timestamps[hour] = base
+  return base + int(text[14:16]) * 60 + int(text[17:19])
 
 
 def convert_youtube_time_to_sec(duration):
@@ -1,6 +1,9 @@
-import data_util
+import datetime
+import time
 import unittest
 
+import data_util
+
 
 class DataUtilTest(unittest.TestCase):
   def test_unicode(self):
@@ -23,6 +26,18 @@ class DataUtilTest(unittest.TestCase):
     expect = 'video-something'
     self.assertEqual(normal, expect)
 
+  def test_truncate_long_name(self):
+    normal = data_util.normalize_name('a' * 300)
+    self.assertEqual(normal, 'a' * 200)
+
+  def test_create_timestamp(self):
+    text = '2009-02-13T18:31:30.000Z'
+    dt = datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.000Z')
+    expect = int(time.mktime(dt.timetuple()))
+    self.assertEqual(data_util.create_timestamp(text), expect)
+    self.assertEqual(data_util.create_timestamp('2009-02-13T18:31:30Z'),
+                     expect)
+
   def test_convert_hours_minutes_seconds(self):
     length = data_util.convert_youtube_time_to_sec('PT1H45M29S')
     self.assertEqual(length, 6329)
@@ -2,28 +2,57 @@
 
 """Execute plugins using the local metadata."""
 
+import itertools
 import os
 import shutil
 import subprocess
+import sys
 import tempfile
+import threading
+import time
 
 import json
+from multiprocessing.pool import ThreadPool
 
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+import blob_store
 import file_util
+import lease_table
+import plugin_worker
+import video_index
 
 
 PLUGINS_DIRECTORY = 'plugins'
+FILE_STORES = ['flat', 'sharded']
+# Pending entries submitted at once, sharing one claim on their leases.
+SUBMIT_BATCH_SIZE = 100
 
 
 class ExecutePlugins(object):
-  def __init__(self):
+  def __init__(self, jobs=1, metrics=None):
     self.plugin_list = None
     self.plugin_script = None
-    self.current_directory = os.getcwd()
+    self.jobs = jobs
+    self.metrics = metrics
+    # Idle long-lived plugin processes, by command, and all those started.
+    self.idle_workers = {}
+    self.workers = []
+    self.workers_lock = threading.Lock()
     fp = open('plugin_config.cfg', 'r')
     content = fp.read()
     fp.close()
-    self.plugin_list = json.loads(content).get(PLUGINS_DIRECTORY)
+    config = json.loads(content)
+    self.plugin_list = config.get(PLUGINS_DIRECTORY)
+    # Where outputs are kept: 'flat' in the files directory, named by safename,
+    # or 'sharded' in the content-addressed blob store.
+    self.file_store = config.get('file_store', 'flat')
+    if not self.file_store in FILE_STORES:
+      raise RuntimeError('Unknown file_store %s' % self.file_store)
+    self.blob_store = None
     file_util.mkdir_p(PLUGINS_DIRECTORY)
     for script in os.listdir(PLUGINS_DIRECTORY):
       if os.access(os.path.join(PLUGINS_DIRECTORY, script), os.X_OK):
@@ -34,54 +63,242 @@ class ExecutePlugins(object):
                           'but it is not executable\n') % script)
       break
 
-  def execute(self, metadata):
-    """Execute matching plugins for all local metadata."""
+  def execute(self, metadata, sync=None):
+    """Execute matching plugins for all local metadata.
+
+    Plugins run once per video_id. The result is recorded in every feed that
+    contains the video. Other processes may execute plugins on the same output
+    directory at the same time: videos they have leased are skipped, and left
+    pending if their result is not known yet.
+
+    If sync is set, it is called with a function to pass as on_added to
+    LocalMetadata.synchronize, and plugins run on new videos while the sync
+    continues. Return what sync returned.
+    """
+    if metadata.has_pending_index():
+      work = metadata.iter_pending()
+      if sync is None:
+        # Usually nothing is pending, avoid loading the indexes then.
+        work = list(work)
+        if not work:
+          metadata.save_pending()
+          return None
+    else:
+      work = None
+    self.start(metadata, background=not sync is None)
+    try:
+      if work is None:
+        # Build the pending index, from every feed.
+        feeds = metadata.get_metadata_feeds()
+        work = metadata.rebuild_pending(
+          self._pending_work(feeds, metadata, self.index))
+      work = iter(work)
+      while True:
+        batch = list(itertools.islice(work, SUBMIT_BATCH_SIZE))
+        if not batch:
+          break
+        self._submit(batch)
+      result = None
+      if not sync is None:
+        result = sync(self.submit)
+    except BaseException:
+      self.finish(wait=False)
+      raise
+    self.finish()
+    return result
+
+  def start(self, metadata, background=False):
+    """Prepare to run plugins on entries passed to submit.
+
+    With more than one job, or if background is set, plugins run on a pool of
+    worker threads, and submit returns without waiting for them.
+    """
+    self.metadata = metadata
     output_directory = metadata.output_directory
-    feeds = metadata.get_metadata_feeds()
-    for filename in feeds:
-      self._process_metadata_file(filename, metadata, output_directory)
+    self.index = video_index.VideoIndex(output_directory)
+    self.index.load()
+    if self.file_store == 'sharded':
+      self.blob_store = blob_store.BlobStore(output_directory)
+      self.blob_store.load()
+    # No plugin can run, the entries only get their known results.
+    self.leases = None
+    if self._runnable_plugins():
+      self.leases = lease_table.LeaseTable(output_directory)
+      self.leases.start()
+    self.updated_feeds = set()
+    # Feeds waiting for the result of a plugin running on each video_id, or
+    # None once it has run.
+    self.running = {}
+    self.running_lock = threading.Lock()
+    self.errors = []
+    self.pool = None
+    if self.jobs > 1 or background:
+      self.pool = ThreadPool(max(1, self.jobs))
+
+  def submit(self, filename, entries):
+    """Run plugins on entries of the given feed that have no status."""
+    self._submit([(filename, meta) for meta in entries])
 
-  def _process_metadata_file(self, filename, metadata, output_directory):
-    """Execute plugins for the given file or metadata."""
-    data = metadata.deserialize_feed(filename)
-    for i,meta in enumerate(data):
-      if 'status' in meta:
+  def _submit(self, work):
+    """Run plugins on (filename, metadata) entries that have no status.
+
+    The leases of all the videos are claimed at once, with running_lock
+    released.
+    """
+    known = []
+    candidates = []
+    with self.running_lock:
+      for (filename, meta) in work:
+        video_id = meta['video_id']
+        result = self.index.get(video_id)
+        if result:
+          known.append((filename, video_id, result))
+        elif video_id in self.running:
+          # Already running, or run with no result, as part of another feed.
+          if not self.running[video_id] is None:
+            self.running[video_id].append(filename)
+        else:
+          # Reserved while the lease is claimed.
+          self.running[video_id] = [filename]
+          candidates.append(meta)
+    claims = {}
+    if candidates and self.leases:
+      claims = self.leases.claim([meta['video_id'] for meta in candidates],
+                                 self.index)
+    for meta in candidates:
+      video_id = meta['video_id']
+      (claimed, result) = claims.get(video_id, (True, None))
+      if claimed:
+        if self.pool:
+          # Results are recorded by the pool, on a single thread.
+          self.pool.apply_async(self._run, (meta,), callback=self._record)
+        else:
+          self._record(self._run(meta))
         continue
-      retval = self._run_plugin(meta, output_directory)
+      with self.running_lock:
+        filenames = self.running.pop(video_id)
+        if result and not self.index.get(video_id):
+          # Completed by another process, which has yet to save it.
+          self.index.put(video_id, result['status'], result.get('artifact'))
+      if result:
+        known.extend((filename, video_id, result) for filename in filenames)
+      # Otherwise running in another process, the entries stay pending.
+    for (filename, video_id, result) in known:
+      # Already processed as part of another feed.
+      self.metadata.append_status(filename, video_id, result['status'])
+      self.updated_feeds.add(filename)
+
+  def finish(self, wait=True):
+    """Wait for plugins to complete, then save indexes and compact feeds.
+
+    Raise the first error a plugin run raised, if any.
+    """
+    try:
+      if self.pool:
+        if wait:
+          self.pool.close()
+        else:
+          self.pool.terminate()
+        self.pool.join()
+    finally:
+      self._stop_workers()
+      if self.leases:
+        self.leases.stop()
+      self.index.save()
+      if self.leases:
+        # Other processes find the results in the index from now on.
+        self.leases.forget_done()
+      self.metadata.save_pending()
+      if self.blob_store:
+        self.blob_store.save()
+      self.metadata.compact_feeds(self.updated_feeds)
+    if wait and self.errors:
+      raise self.errors[0]
+
+  def _run(self, meta):
+    video_id = meta['video_id']
+    start = time.time()
+    try:
+      (retval, artifact) = self._run_plugin(meta,
+                                            self.metadata.output_directory)
+    except Exception as e:
+      self.errors.append(e)
+      return (video_id, None, None)
+    if self.metrics and self.plugin_script:
+      self.metrics.record_plugin(os.path.basename(self.plugin_script),
+                                 time.time() - start, retval)
+    return (video_id, retval, artifact)
+
+  def _record(self, result):
+    (video_id, retval, artifact) = result
+    with self.running_lock:
+      filenames = self.running[video_id]
+      self.running[video_id] = None
       if retval:
-        data[i]['status'] = retval
-        metadata.serialize_feed(filename, data)
+        self.index.put(video_id, retval, artifact)
+    # Written to the leases along with the next claim or renewal.
+    if self.leases and retval:
+      self.leases.complete(video_id, retval, artifact)
+    elif self.leases:
+      self.leases.release(video_id)
+    if retval:
+      for filename in filenames:
+        self.metadata.append_status(filename, video_id, retval)
+        self.updated_feeds.add(filename)
+
+  def _pending_work(self, feeds, metadata, index):
+    """Yield (filename, metadata) for every entry with no status.
+
+    Entries that already have a status are added to the index, if missing.
+    """
+    for filename in feeds:
+      for meta in metadata.iter_feed(filename):
+        if 'status' in meta:
+          if not index.get(meta['video_id']):
+            index.put(meta['video_id'], meta['status'])
+          continue
+        yield (filename, meta)
 
   def _run_plugin(self, meta, output_directory):
-    """Run the configured plugins for the given metadata object."""
+    """Run the configured plugins for the given metadata object.
+
+    Return a tuple of the status and the path of the output file, relative to
+    the output directory, or None.
+    """
     retval = None
-    if (not self.plugin_list or not isinstance(self.plugin_list, list) or
-        not self.plugin_script):
-      return False
-    for plugin in self.plugin_list:
-      # Plugin API still in development.
-      if (plugin.get('script') != '*' or
-          plugin.get('condition') != 'executable' or
-          plugin.get('save_as') != '${safename}' or
-          plugin.get('defaults') != True):
-        continue
+    artifact = None
+    plugins = self._runnable_plugins()
+    if not plugins:
+      return (False, None)
+    for plugin in plugins:
       # Create the command to run.
       command = plugin.get('command')
       command = command.replace('${script}', self.plugin_script)
-      command = command.replace('${url}', meta['url'])
       # Make temporary directory, execute script within it.
-      temp_directory = tempfile.mkdtemp()
-      os.chdir(temp_directory)
-      outcode = subprocess.call(command, shell=True)
+      if self.blob_store:
+        temp_directory = self.blob_store.make_temp_directory(meta['video_id'])
+      else:
+        temp_directory = tempfile.mkdtemp()
+      if plugin.get('mode') == 'worker':
+        (outcode, script_output) = self._call_worker(
+          command, meta, temp_directory,
+          plugin.get('timeout', plugin_worker.ITEM_TIMEOUT))
+      else:
+        command = command.replace('${url}', meta['url'])
+        outcode = subprocess.call(command, shell=True, cwd=temp_directory)
+        script_output = None
       # Find output the script may have created.
-      script_output = None
-      for output_file in os.listdir('.'):
-        script_output = os.path.abspath(output_file)
-        break
+      if not script_output:
+        for output_file in os.listdir(temp_directory):
+          script_output = os.path.join(temp_directory, output_file)
+          break
       # Command completed.
-      os.chdir(self.current_directory)
       if outcode != 0:
         retval = 'failed'
+      elif script_output and self.blob_store:
+        ext = os.path.splitext(script_output)[1]
+        artifact = self.blob_store.add(script_output, meta['safename'] + ext)
+        retval = 'success'
       elif script_output:
         # Rename output and move it to the files directory.
         ext = os.path.splitext(script_output)[1]
@@ -89,7 +306,59 @@ class ExecutePlugins(object):
         file_util.mkdir_p(os.path.dirname(target))
         shutil.move(script_output, target)
         retval = 'success'
+        artifact = os.path.relpath(target, output_directory)
       # Cleanup temporary directory.
       shutil.rmtree(temp_directory)
-    return retval
+    return (retval, artifact)
+
+  def _runnable_plugins(self):
+    """Return the configured plugins that can run, if any."""
+    if (not self.plugin_list or not isinstance(self.plugin_list, list) or
+        not self.plugin_script):
+      return []
+    # Plugin API still in development.
+    return [plugin for plugin in self.plugin_list
+            if plugin.get('script') == '*' and
+            plugin.get('condition') == 'executable' and
+            plugin.get('save_as') == '${safename}' and
+            plugin.get('defaults') == True]
+
+  def _call_worker(self, command, meta, temp_directory,
+                   timeout=plugin_worker.ITEM_TIMEOUT):
+    """Send an item to a long-lived plugin process running command.
+
+    Return a tuple of an exit code, 0 for success, and the path of the output
+    file if the plugin named one.
+    """
+    with self.workers_lock:
+      idle = self.idle_workers.setdefault(command, queue.Queue())
+      try:
+        worker = idle.get_nowait()
+      except queue.Empty:
+        worker = plugin_worker.PluginWorker(command, timeout)
+        self.workers.append(worker)
+    try:
+      reply = worker.process_item({'url': meta['url'],
+                                   'video_id': meta['video_id'],
+                                   'safename': meta['safename'],
+                                   'directory': temp_directory})
+    finally:
+      idle.put(worker)
+    if not reply or reply.get('status') != 'success':
+      return (1, None)
+    if reply.get('output'):
+      output = os.path.join(temp_directory, reply['output'])
+      # The output is moved into the output directory, so it must not be
+      # anything of the user's outside of the temporary directory.
+      real_directory = os.path.join(os.path.realpath(temp_directory), '')
+      if not os.path.realpath(output).startswith(real_directory):
+        return (1, None)
+      if os.path.exists(output):
+        return (0, output)
+    return (0, None)
 
+  def _stop_workers(self):
+    for worker in self.workers:
+      worker.stop()
+    self.idle_workers = {}
+    self.workers = []
@@ -0,0 +1,322 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import execute_plugins
+import file_util
+import lease_table
+import local_metadata
+import user_account_fake
+
+
+REPOSITORY_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+PLUGIN = """#!/bin/sh
+echo "$1" >> %(runs)s
+echo "$1" > output.txt
+"""
+SLOW_PLUGIN = """#!/bin/sh
+echo "start:$1" >> %(runs)s
+sleep 0.5
+echo "end:$1" >> %(runs)s
+echo "$1" > output.txt
+"""
+
+# Handles items as a long-lived worker, recording its pid for each.
+WORKER_PLUGIN = """#!%(python)s
+import json
+import os
+import sys
+
+for line in iter(sys.stdin.readline, ''):
+  item = json.loads(line)
+  fp = open(%(runs)r, 'a')
+  fp.write('%%d:%%s\\n' %% (os.getpid(), item['video_id']))
+  fp.close()
+  fp = open(os.path.join(item['directory'], 'video.txt'), 'w')
+  fp.write(item['url'])
+  fp.close()
+  sys.stdout.write(json.dumps({'status': 'success',
+                               'output': 'video.txt'}) + '\\n')
+  sys.stdout.flush()
+"""
+
+# Replies with the path of the runs file, outside of its directory.
+ESCAPING_WORKER_PLUGIN = """#!%(python)s
+import json
+import sys
+
+for line in iter(sys.stdin.readline, ''):
+  item = json.loads(line)
+  fp = open(%(runs)r, 'a')
+  fp.write(item['video_id'] + '\\n')
+  fp.close()
+  sys.stdout.write(json.dumps({'status': 'success',
+                               'output': %(runs)r}) + '\\n')
+  sys.stdout.flush()
+"""
+
+
+
+class SharedVideoAccount(user_account_fake.UserAccountFake):
+  """Has the apple video in the banana playlist too."""
+
+  def clone(self):
+    return SharedVideoAccount()
+
+  def get_playlist_videos(self, playlist_id, **kwargs):
+    videos = user_account_fake.UserAccountFake.get_playlist_videos(
+      self, playlist_id, **kwargs)
+    if playlist_id == 'PLB':
+      kwargs['etag_cache'] = {}
+      videos.extend(user_account_fake.UserAccountFake.get_playlist_videos(
+        self, 'PLA', **kwargs))
+    return videos
+
+
+class ExecutePluginsTest(unittest.TestCase):
+  jobs = 1
+
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.output_directory = os.path.join(self.temp_directory, 'output')
+    self.runs_path = os.path.join(self.temp_directory, 'runs')
+    # Plugins and their config are found in the current directory.
+    self.preserve_cwd = os.getcwd()
+    os.chdir(self.temp_directory)
+    self.write_plugin(PLUGIN)
+    self.write_config({})
+    self.metadata = local_metadata.LocalMetadata(self.output_directory,
+                                                 verbose=True)
+    self.account = user_account_fake.UserAccountFake()
+
+  def tearDown(self):
+    os.chdir(self.preserve_cwd)
+    shutil.rmtree(self.temp_directory)
+
+  def write_plugin(self, content):
+    file_util.mkdir_p('plugins')
+    path = os.path.join('plugins', 'plugin.sh')
+    fp = open(path, 'w')
+    fp.write(content % {'runs': self.runs_path, 'python': sys.executable})
+    fp.close()
+    os.chmod(path, 0o755)
+
+  def write_config(self, options):
+    plugin = {'script': '*', 'condition': 'executable',
+              'command': '${script} ${url}', 'save_as': '${safename}',
+              'defaults': True}
+    plugin.update(options.get('plugin', {}))
+    config = {'plugins': [plugin]}
+    config.update(options.get('config', {}))
+    fp = open('plugin_config.cfg', 'w')
+    fp.write(json.dumps(config))
+    fp.close()
+
+  def read_runs(self):
+    if not os.path.exists(self.runs_path):
+      return []
+    fp = open(self.runs_path, 'r')
+    runs = fp.read().split()
+    fp.close()
+    return runs
+
+  def statuses(self):
+    result = {}
+    for filename in self.metadata.get_metadata_feeds():
+      for meta in self.metadata.iter_feed(filename):
+        result[meta['video_id']] = meta.get('status')
+    return result
+
+  def test_pipeline_on_empty_output(self):
+    executor = execute_plugins.ExecutePlugins(self.jobs)
+    num_added = executor.execute(
+      self.metadata, sync=lambda on_added: self.metadata.synchronize(
+        self.account, quiet=True, on_added=on_added))
+    self.assertEqual(num_added, 3)
+    self.assertEqual(self.statuses(),
+                     {'vA_': 'success', 'vB_': 'success', 'vC_': 'success'})
+
+  def test_locks_directory(self):
+    self.metadata.synchronize(self.account, quiet=True)
+    executor = execute_plugins.ExecutePlugins(self.jobs)
+    executor.execute(self.metadata)
+    locks = os.listdir(os.path.join(self.output_directory, 'locks'))
+    for name in ['data_videos.json.lock', 'data_leases.json.lock',
+                 'data_pending.json.lock']:
+      self.assertTrue(name in locks)
+    # No lock is kept next to the files it guards.
+    for (directory, unused_subdirectories, filenames) in os.walk(
+        os.path.join(self.output_directory, 'data')):
+      self.assertEqual([f for f in filenames if f.endswith('.lock')], [])
+
+  def test_status_in_every_feed(self):
+    self.metadata.synchronize(SharedVideoAccount(), quiet=True)
+    executor = execute_plugins.ExecutePlugins(self.jobs)
+    executor.execute(self.metadata)
+    # The shared video ran once.
+    self.assertEqual(sorted(self.read_runs()),
+                     ['http://youtube.com/watch?v=vA_',
+                      'http://youtube.com/watch?v=vB_',
+                      'http://youtube.com/watch?v=vC_'])
+    feeds = {}
+    for filename in self.metadata.get_metadata_feeds():
+      feed = os.path.basename(os.path.dirname(filename))
+      feeds[feed] = dict((meta['video_id'], meta.get('status'))
+                         for meta in self.metadata.iter_feed(filename))
+    self.assertEqual(feeds, {'apple': {'vA_': 'success'},
+                             'banana': {'vA_': 'success', 'vB_': 'success'},
+                             'carrot': {'vC_': 'success'}})
+
+  def test_worker_mode(self):
+    self.write_plugin(WORKER_PLUGIN)
+    self.write_config({'plugin': {'mode': 'worker',
+                                  'command': '${script} --worker'}})
+    self.metadata.synchronize(self.account, quiet=True)
+    executor = execute_plugins.ExecutePlugins(self.jobs)
+    executor.execute(self.metadata)
+    runs = [run.split(':') for run in self.read_runs()]
+    self.assertEqual(sorted(video_id for (pid, video_id) in runs),
+                     ['vA_', 'vB_', 'vC_'])
+    # At most one worker process per job.
+    self.assertTrue(len(set(pid for (pid, video_id) in runs)) <= self.jobs)
+    self.assertEqual(executor.workers, [])
+    # Outputs are named after the safename of their video.
+    path = os.path.join(self.output_directory, 'files', 'apple-video.txt')
+    fp = open(path, 'r')
+    self.assertEqual(fp.read(), 'http://youtube.com/watch?v=vA_')
+    fp.close()
+    self.assertEqual(self.statuses(),
+                     {'vA_': 'success', 'vB_': 'success', 'vC_': 'success'})
+
+  def test_worker_output_outside_directory(self):
+    self.write_plugin(ESCAPING_WORKER_PLUGIN)
+    self.write_config({'plugin': {'mode': 'worker',
+                                  'command': '${script} --worker'}})
+    self.metadata.synchronize(self.account, quiet=True)
+    execute_plugins.ExecutePlugins(self.jobs).execute(self.metadata)
+    # The runs file is left where it is, and the items failed.
+    self.assertEqual(sorted(self.read_runs()), ['vA_', 'vB_', 'vC_'])
+    self.assertFalse(os.path.exists(os.path.join(self.output_directory,
+                                                 'files')))
+    self.assertEqual(self.statuses(),
+                     {'vA_': 'failed', 'vB_': 'failed', 'vC_': 'failed'})
+
+  def test_sharded_file_store(self):
+    # Every video gets the same output.
+    self.write_config({'plugin': {'command': '${script} same'},
+                       'config': {'file_store': 'sharded'}})
+    self.metadata.synchronize(self.account, quiet=True)
+    executor = execute_plugins.ExecutePlugins(self.jobs)
+    executor.execute(self.metadata)
+    fp = open(os.path.join(self.output_directory, 'data', 'videos.json'))
+    videos = json.loads(fp.read())
+    fp.close()
+    artifacts = set(video['artifact'] for video in videos.values())
+    self.assertEqual(len(videos), 3)
+    self.assertEqual(len(artifacts), 1)
+    artifact = artifacts.pop()
+    self.assertTrue(artifact.startswith('blobs' + os.sep))
+    self.assertTrue(os.path.exists(
+      os.path.join(self.output_directory, artifact)))
+    self.assertFalse(os.path.exists(
+      os.path.join(self.output_directory, 'files')))
+
+  def test_skip_videos_leased_elsewhere(self):
+    self.metadata.synchronize(self.account, quiet=True)
+    other = lease_table.LeaseTable(self.output_directory)
+    other.claim(['vA_', 'vB_'])
+    other.complete('vB_', 'success', 'files/banana-video.txt')
+    other.renew()
+    executor = execute_plugins.ExecutePlugins(self.jobs)
+    executor.execute(self.metadata)
+    # vA_ is still running elsewhere and stays pending, the result recorded
+    # for vB_ is used.
+    self.assertEqual(self.read_runs(), ['http://youtube.com/watch?v=vC_'])
+    self.assertEqual(self.statuses(),
+                     {'vA_': None, 'vB_': 'success', 'vC_': 'success'})
+    self.assertEqual([meta['video_id'] for (filename, meta)
+                      in self.metadata.iter_pending()], ['vA_'])
+    other.stop()
+    executor.execute(self.metadata)
+    self.assertEqual(self.statuses(),
+                     {'vA_': 'success', 'vB_': 'success', 'vC_': 'success'})
+
+  def test_finish_raises_plugin_errors(self):
+    self.metadata.synchronize(self.account, quiet=True)
+    executor = execute_plugins.ExecutePlugins(self.jobs)
+    run_plugin = executor._run_plugin
+    def failing_run_plugin(meta, output_directory):
+      if meta['video_id'] == 'vB_':
+        raise RuntimeError('plugin failed')
+      return run_plugin(meta, output_directory)
+    executor._run_plugin = failing_run_plugin
+    self.assertRaises(RuntimeError, executor.execute, self.metadata)
+    # Other videos are recorded, and the failed one is left for next time.
+    self.assertEqual(self.statuses(),
+                     {'vA_': 'success', 'vB_': None, 'vC_': 'success'})
+    fp = open(os.path.join(self.output_directory, 'data', 'leases.json'))
+    self.assertEqual(json.loads(fp.read()), {})
+    fp.close()
+    executor = execute_plugins.ExecutePlugins(self.jobs)
+    executor.execute(self.metadata)
+    self.assertEqual(self.statuses(),
+                     {'vA_': 'success', 'vB_': 'success', 'vC_': 'success'})
+
+  def test_concurrent_processes(self):
+    self.write_plugin(SLOW_PLUGIN)
+    self.metadata.synchronize(self.account, quiet=True)
+    script = ('import execute_plugins, local_metadata; '
+              'execute_plugins.ExecutePlugins(%d).execute('
+              'local_metadata.LocalMetadata(%r))' %
+              (self.jobs, self.output_directory))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+      [REPOSITORY_DIRECTORY] + [p for p in [env.get('PYTHONPATH')] if p])
+    processes = [subprocess.Popen([sys.executable, '-c', script], env=env)
+                 for i in range(3)]
+    for process in processes:
+      self.assertEqual(process.wait(), 0)
+    execute_plugins.ExecutePlugins(self.jobs).execute(self.metadata)
+    starts = [run for run in self.read_runs() if run.startswith('start:')]
+    self.assertEqual(sorted(starts),
+                     ['start:http://youtube.com/watch?v=vA_',
+                      'start:http://youtube.com/watch?v=vB_',
+                      'start:http://youtube.com/watch?v=vC_'])
+    self.assertEqual(self.statuses(),
+                     {'vA_': 'success', 'vB_': 'success', 'vC_': 'success'})
+
+  def test_no_leases_without_runnable_plugin(self):
+    self.write_config({'plugin': {'condition': 'never'}})
+    self.metadata.synchronize(self.account, quiet=True)
+    executor = execute_plugins.ExecutePlugins(self.jobs)
+    executor.execute(self.metadata)
+    self.assertEqual(self.read_runs(), [])
+    self.assertFalse(os.path.exists(
+      os.path.join(self.output_directory, 'data', 'leases.json')))
+
+
+class ExecutePluginsParallelTest(ExecutePluginsTest):
+  jobs = 4
+
+  def test_parallel_jobs(self):
+    self.write_plugin(SLOW_PLUGIN)
+    self.metadata.synchronize(self.account, quiet=True)
+    executor = execute_plugins.ExecutePlugins(self.jobs)
+    executor.execute(self.metadata)
+    runs = self.read_runs()
+    self.assertEqual(len(runs), 6)
+    # Every video started before any of them ended.
+    self.assertEqual([run.split(':')[0] for run in runs[:3]],
+                     ['start'] * 3)
+    self.assertEqual(self.statuses(),
+                     {'vA_': 'success', 'vB_': 'success', 'vC_': 'success'})
+
+
+if __name__ == '__main__':
+  unittest.main()
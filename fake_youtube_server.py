@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+"""Local stand-in for the parts of the Youtube API used by UserAccount.
+
+Serves the channels, playlists, playlistItems and videos list endpoints, batch
+requests, and a discovery document pointing at itself, for a generated account.
+Connect to it with UserAccount.connect(api_url=server.url). Requests and bytes
+sent are counted per endpoint, so that benchmarks can report them. A fraction
+of requests can be failed with rateLimitExceeded, to exercise retries.
+
+Usage: python fake_youtube_server.py [port]
+"""
+
+import json
+import random
+import re
+import sys
+import threading
+import time
+
+try:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+  from urllib.parse import parse_qs, urlparse
+except ImportError:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+  from urlparse import parse_qs, urlparse
+
+
+DEFAULT_PAGE_SIZE = 5
+MAX_PAGE_SIZE = 50
+FAVORITES_ID = 'FLfavorites'
+
+
+def discovery_document(url):
+  """Return a discovery document describing the fake endpoints."""
+  def method(name, parameters):
+    described = {'part': {'type': 'string', 'required': True,
+                          'location': 'query'}}
+    for parameter, kind in parameters:
+      described[parameter] = {'type': kind, 'location': 'query'}
+    return {'methods': {'list': {'id': 'youtube.%s.list' % name,
+                                 'path': name,
+                                 'httpMethod': 'GET',
+                                 'parameters': described,
+                                 'parameterOrder': ['part'],
+                                 'response': {'$ref': 'ListResponse'}}}}
+  return {
+    'kind': 'discovery#restDescription',
+    'discoveryVersion': 'v1',
+    'id': 'youtube:v3',
+    'name': 'youtube',
+    'version': 'v3',
+    'protocol': 'rest',
+    'rootUrl': url + '/',
+    'servicePath': 'youtube/v3/',
+    'baseUrl': url + '/youtube/v3/',
+    'batchPath': 'batch/youtube/v3',
+    'parameters': {},
+    'schemas': {'ListResponse': {'id': 'ListResponse', 'type': 'object'}},
+    'resources': {
+      'channels': method('channels', [('mine', 'boolean')]),
+      'playlists': method('playlists', [('mine', 'boolean'),
+                                        ('pageToken', 'string'),
+                                        ('maxResults', 'integer')]),
+      'playlistItems': method('playlistItems', [('playlistId', 'string'),
+                                                ('pageToken', 'string'),
+                                                ('maxResults', 'integer')]),
+      'videos': method('videos', [('id', 'string')]),
+    },
+  }
+
+
+class FakeAccount(object):
+  """A generated account: a favorites list plus some number of playlists.
+
+  Favorites are ordered newest first, other playlists newest last, as in the
+  real API.
+  """
+  def __init__(self, num_playlists, items_per_playlist, seed=0):
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.next_video = 0
+    self.next_time = 1200000000
+    self.playlists = []
+    self.items = {}
+    self.versions = {}
+    self.lengths = {}
+    for i in range(num_playlists + 1):
+      if i == 0:
+        playlist_id = FAVORITES_ID
+        title = 'Favorites'
+      else:
+        playlist_id = 'PL%08d' % i
+        title = 'Playlist %d' % i
+      self.playlists.append({'id': playlist_id, 'title': title})
+      self.items[playlist_id] = []
+      self.versions[playlist_id] = 0
+      for unused in range(items_per_playlist):
+        self._add_video(playlist_id)
+
+  def _add_video(self, playlist_id):
+    video_id = 'v%010d' % self.next_video
+    self.next_video += 1
+    self.next_time += 60
+    published = time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                              time.gmtime(self.next_time))
+    item = {'title': 'Video %s' % video_id,
+            'description': 'Description of %s' % video_id,
+            'publishedAt': published,
+            'videoId': video_id}
+    self.lengths[video_id] = self.random.randint(1, 3 * 3600)
+    if playlist_id == FAVORITES_ID:
+      self.items[playlist_id].insert(0, item)
+    else:
+      self.items[playlist_id].append(item)
+    self.versions[playlist_id] += 1
+
+  def add_videos(self, count):
+    """Add count new videos to randomly chosen playlists."""
+    with self.lock:
+      for unused in range(count):
+        playlist = self.random.choice(self.playlists)
+        self._add_video(playlist['id'])
+
+  def churn(self, count):
+    """Change the etag of count playlists, without adding any video."""
+    with self.lock:
+      for playlist in self.random.sample(self.playlists, count):
+        self.versions[playlist['id']] += 1
+
+  def etag(self, playlist_id):
+    return '"etag-%s-%d"' % (playlist_id, self.versions[playlist_id])
+
+
+class FakeYoutubeServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, account, port=0, latency=0.0, error_rate=0.0):
+    HTTPServer.__init__(self, ('127.0.0.1', port), FakeYoutubeHandler)
+    self.account = account
+    self.latency = latency
+    self.error_rate = error_rate
+    self.random = random.Random(0)
+    self.url = 'http://127.0.0.1:%d' % self.server_address[1]
+    self.stats_lock = threading.Lock()
+    self.reset_stats()
+
+  def start(self):
+    thread = threading.Thread(target=self.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+  def reset_stats(self):
+    with self.stats_lock:
+      self.requests = {}
+      self.bytes_sent = 0
+
+  def record(self, endpoint, num_bytes):
+    with self.stats_lock:
+      self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+      self.bytes_sent += num_bytes
+
+  def respond(self, path, query):
+    """Return the status code and json response for an API request."""
+    account = self.account
+    endpoint = path.rstrip('/').split('/')[-1]
+    params = dict((k, v[0]) for k, v in parse_qs(query).items())
+    if self.latency:
+      time.sleep(self.latency)
+    with account.lock:
+      if endpoint == 'rest':
+        return (200, endpoint, discovery_document(self.url))
+      if self.error_rate and self.random.random() < self.error_rate:
+        return (403, endpoint, {'error': {
+          'code': 403, 'message': 'Rate Limit Exceeded',
+          'errors': [{'reason': 'rateLimitExceeded'}]}})
+      elif endpoint == 'channels':
+        body = {'items': [{'contentDetails': {'relatedPlaylists': {
+                 'favorites': FAVORITES_ID}}}]}
+        return (200, endpoint, body)
+      elif endpoint == 'playlists':
+        playlists = [{'id': p['id'], 'snippet': {'title': p['title']}}
+                     for p in account.playlists[1:]]
+        return (200, endpoint, self._page(playlists, params, 'playlists'))
+      elif endpoint == 'playlistItems':
+        playlist_id = params.get('playlistId')
+        if not playlist_id in account.items:
+          return (404, endpoint, {'error': {'code': 404,
+                                            'message': 'playlistNotFound'}})
+        items = []
+        for position, item in enumerate(account.items[playlist_id]):
+          items.append({'snippet': {'title': item['title'],
+                                    'description': item['description'],
+                                    'publishedAt': item['publishedAt'],
+                                    'position': position},
+                        'contentDetails': {'videoId': item['videoId']}})
+        return (200, endpoint, self._page(items, params,
+                                          account.etag(playlist_id)))
+      elif endpoint == 'videos':
+        items = []
+        for video_id in params.get('id', '').split(','):
+          if video_id in account.lengths:
+            length = account.lengths[video_id]
+            duration = 'PT%dH%dM%dS' % (length // 3600, length // 60 % 60,
+                                        length % 60)
+            items.append({'id': video_id,
+                          'contentDetails': {'duration': duration}})
+        return (200, endpoint, {'items': items})
+    return (404, endpoint, {'error': {'code': 404, 'message': 'notFound'}})
+
+  def _page(self, items, params, etag):
+    size = min(int(params.get('maxResults', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+    offset = int(params.get('pageToken') or 0)
+    response = {'etag': etag,
+                'pageInfo': {'totalResults': len(items),
+                             'resultsPerPage': size},
+                'items': items[offset:offset + size]}
+    if offset + size < len(items):
+      response['nextPageToken'] = str(offset + size)
+    return response
+
+
+class FakeYoutubeHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Headers and body are written separately, avoid delayed ACK stalls.
+  disable_nagle_algorithm = True
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    parsed = urlparse(self.path)
+    (code, endpoint, body) = self.server.respond(parsed.path, parsed.query)
+    self._send(code, endpoint, 'application/json', json.dumps(body))
+
+  def do_POST(self):
+    """Handle a multipart/mixed batch of GET requests."""
+    length = int(self.headers.get('Content-Length', 0))
+    content = self.rfile.read(length).decode('utf-8')
+    content_type = self.headers.get('Content-Type', '')
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1)
+    out_boundary = 'batch_fake_youtube_server'
+    parts = []
+    for part in content.split('--' + boundary)[1:]:
+      if part.strip() in ['', '--']:
+        continue
+      (headers, request) = re.split(r'\r?\n\r?\n', part.strip(), 1)
+      content_id = re.search(r'Content-ID: <(.*)>', headers, re.I).group(1)
+      request_line = request.split('\n', 1)[0].strip()
+      parsed = urlparse(request_line.split(' ')[1])
+      (code, endpoint, body) = self.server.respond(parsed.path, parsed.query)
+      self.server.record(endpoint, 0)
+      parts.append('--%s\r\nContent-Type: application/http\r\n'
+                   'Content-ID: <response-%s>\r\n\r\n'
+                   'HTTP/1.1 %d OK\r\nContent-Type: application/json\r\n\r\n'
+                   '%s\r\n' % (out_boundary, content_id, code,
+                               json.dumps(body)))
+    parts.append('--%s--\r\n' % out_boundary)
+    self._send(200, 'batch',
+               'multipart/mixed; boundary=%s' % out_boundary, ''.join(parts))
+
+  def _send(self, code, endpoint, content_type, text):
+    data = text.encode('utf-8')
+    self.server.record(endpoint, len(data))
+    self.send_response(code)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+
+def run():
+  port = 8000
+  if len(sys.argv) > 1:
+    port = int(sys.argv[1])
+  server = FakeYoutubeServer(FakeAccount(20, 100), port=port)
+  sys.stderr.write('Serving fake Youtube API at %s\n' % server.url)
+  server.serve_forever()
+
+
+if __name__ == '__main__':
+  run()
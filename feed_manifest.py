@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""Summary of every feed, so that a sync need not read the feeds themselves.
+
+Kept in output_directory/data/manifest.json, it maps each playlist_id to the
+feed it is stored in, relative to the output directory, the newest timestamp
+and number of entries in that feed, and the etag the playlist was last seen
+with:
+
+{
+  "PLXXXXXXXXXXXXXXXX": {"feed": "data/favorites/feed.json",
+                         "timestamp": 1234567890, "count": 123,
+                         "etag": "\"XXXXXXXXXXXXXXXXXXXXXXXXXXX\"",
+                         "signature": [4567, 1234567890.0]},
+  ...
+}
+
+The signature, as returned by the metadata store's feed_signature, tells
+whether the feed was modified by anything other than a sync since the summary
+was taken, in which case the summary is read from the feed again.
+"""
+
+import errno
+import os
+import sys
+
+import json
+
+import file_util
+
+
+class FeedManifest(object):
+  def __init__(self, output_directory):
+    self.output_directory = output_directory
+    self.path = os.path.join(output_directory, 'data', 'manifest.json')
+    self.playlists = {}
+    self.dirty = False
+
+  def load(self):
+    """Load the manifest from disk. Return False if it does not exist."""
+    try:
+      fp = open(self.path, 'r')
+    except IOError:
+      e = sys.exc_info()[1]
+      if e.errno == errno.ENOENT:
+        return False
+      else:
+        raise
+    content = fp.read()
+    fp.close()
+    self.playlists = json.loads(content)
+    return True
+
+  def save(self):
+    """Save the manifest to disk, if it has been modified."""
+    if not self.dirty:
+      return
+    file_util.write_atomic(self.path, [
+      json.dumps(self.playlists, indent=2, separators=(',', ': '),
+                 sort_keys=True)])
+    self.dirty = False
+
+  def get_etags(self):
+    """Return the etag last seen for each playlist_id."""
+    return dict((k, v['etag']) for k, v in self.playlists.items()
+                if not v.get('etag') is None)
+
+  def get_summary(self, playlist_id, filename, signature):
+    """Return the newest timestamp and count of the feed, as feed_summary.
+
+    Return None if the manifest has no summary for the feed, or if the feed
+    has changed since, according to its signature.
+    """
+    entry = self.playlists.get(playlist_id)
+    if (entry is None or signature is None or
+        entry.get('feed') != self._key(filename) or
+        entry.get('signature') != signature):
+      return None
+    return (entry['timestamp'], entry['count'])
+
+  def update(self, playlist_id, filename, timestamp, count, etag, signature):
+    entry = {'feed': self._key(filename), 'timestamp': timestamp,
+             'count': count, 'etag': etag, 'signature': signature}
+    if self.playlists.get(playlist_id) != entry:
+      self.playlists[playlist_id] = entry
+      self.dirty = True
+
+  def replace_signatures(self, signatures):
+    """Update signatures on disk, for feeds changed without adding entries.
+
+    signatures maps each feed to its signature before and after the change,
+    such as compaction. Summaries taken before the change stay valid, others
+    are left to be read from the feed again.
+    """
+    signatures = dict((self._key(filename), change)
+                      for (filename, change) in signatures.items())
+    with file_util.output_lock(self.output_directory, self.path):
+      if not self.load():
+        return
+      for entry in self.playlists.values():
+        change = signatures.get(entry['feed'])
+        if change and entry.get('signature') == change[0]:
+          entry['signature'] = change[1]
+          self.dirty = True
+      self.save()
+
+  def _key(self, filename):
+    return os.path.relpath(filename, self.output_directory)
@@ -4,7 +4,17 @@
 
 import errno
 import os
+import random
 import sys
+import tempfile
+import threading
+import time
+
+try:
+  import fcntl
+except ImportError:
+  # Not available on Windows, where locks only hold within a process.
+  fcntl = None
 
 
 def mkdir_p(path):
@@ -16,3 +26,119 @@ def mkdir_p(path):
       pass
     else:
       raise
+
+
+def write_atomic(path, chunks):
+  """Write an iterable of strings to path, replacing it atomically.
+
+  The strings are written to a temporary file in the same directory, which is
+  then renamed over path, so readers see either the old or the new content.
+  """
+  directory = os.path.dirname(path) or '.'
+  (handle, temp_path) = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+  try:
+    fp = os.fdopen(handle, 'w')
+    for chunk in chunks:
+      fp.write(chunk)
+    fp.flush()
+    os.fsync(fp.fileno())
+    fp.close()
+    os.chmod(temp_path, 0o644)
+    replace = getattr(os, 'replace', os.rename)
+    replace(temp_path, path)
+  except:
+    os.unlink(temp_path)
+    raise
+
+
+LOCK_RETRY_DELAY = 0.01
+LOCKS_DIRECTORY = 'locks'
+
+# FileLock objects by path, as closing any descriptor of a file releases all
+# the locks the process holds on it.
+file_locks = {}
+file_locks_lock = threading.Lock()
+
+
+def file_lock(path):
+  """Return the FileLock for path, shared by all threads of the process."""
+  path = os.path.abspath(path)
+  with file_locks_lock:
+    if not path in file_locks:
+      file_locks[path] = FileLock(path)
+    return file_locks[path]
+
+
+def output_lock(output_directory, path):
+  """Return the FileLock guarding path, a file or directory of the output.
+
+  Locks are kept in output_directory/locks, named after path relative to the
+  output directory, rather than next to the files they guard, which are
+  replaced rather than written in place.
+  """
+  directory = os.path.join(output_directory, LOCKS_DIRECTORY)
+  name = os.path.relpath(path, output_directory).replace(os.sep, '_')
+  lock_path = os.path.abspath(os.path.join(directory, name + '.lock'))
+  with file_locks_lock:
+    if not lock_path in file_locks:
+      mkdir_p(directory)
+  return file_lock(lock_path)
+
+
+class FileLock(object):
+  """Exclusive lock on a file, held across processes and machines.
+
+  Uses fcntl.lockf, which also works over NFS. Within a process, the lock is
+  reentrant for the thread holding it, and other threads wait for it. Use
+  file_lock rather than creating instances directly.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.thread_lock = threading.RLock()
+    self.depth = 0
+    self.fd = None
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, unused_type, unused_value, unused_traceback):
+    self.release()
+
+  def acquire(self):
+    self.thread_lock.acquire()
+    if self.depth == 0 and fcntl:
+      try:
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._lock_file()
+      except:
+        if not self.fd is None:
+          os.close(self.fd)
+          self.fd = None
+        self.thread_lock.release()
+        raise
+    self.depth += 1
+
+  def _lock_file(self):
+    while True:
+      try:
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        return
+      except (IOError, OSError):
+        e = sys.exc_info()[1]
+        if e.errno != errno.EDEADLK:
+          raise
+      # Locks belong to processes rather than threads, so a thread waiting
+      # for a lock held by another process, while another thread holds a lock
+      # that process waits for, looks like a deadlock to the kernel. The
+      # other thread will release its lock, try again.
+      time.sleep(random.uniform(0, LOCK_RETRY_DELAY))
+
+  def release(self):
+    self.depth -= 1
+    if self.depth == 0 and not self.fd is None:
+      fcntl.lockf(self.fd, fcntl.LOCK_UN)
+      os.close(self.fd)
+      self.fd = None
+    self.thread_lock.release()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""Benchmark for turning playlistItems API items into VideoElements.
+
+Usage: python ingest_benchmark.py [count]
+
+Generates count (default 1000000) synthetic API items, then reports items per
+second for the original per-item parsing and for the current ingest path.
+"""
+
+import datetime
+import random
+import sys
+import time
+
+import data_util
+import video_element
+
+
+def make_items(count):
+  rand = random.Random(0)
+  words = ['music', 'Live', 'video', 'Official', '(remix)', 'cat', 'dog/or',
+           'tutorial:', u'おね', 'HD', 'part', '2014']
+  items = []
+  for i in range(count):
+    title = ' '.join(rand.choice(words) for unused in range(rand.randint(2, 8)))
+    published = time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                               time.gmtime(1200000000 + i * 37))
+    items.append({'snippet': {'title': title,
+                              'description': 'Description %d' % i,
+                              'publishedAt': published,
+                              'position': i},
+                  'contentDetails': {'videoId': 'v%010d' % i}})
+  return items
+
+
+def reference_normalize_name(title):
+  accum = ''
+  for ch in title.lower():
+    if ord(ch) > 127:
+      accum += ('--x%x' % ord(ch))
+    elif ch in ['/', ':', ' ']:
+      accum += '-'
+    elif ch in ['(', ')']:
+      pass
+    else:
+      accum += ch
+  if len(accum) > 200:
+    accum = accum[0:200]
+  return accum
+
+
+def reference_ingest(item):
+  """The per-item parsing from before the fast ingest path."""
+  element = {}
+  element['title'] = item['snippet']['title']
+  element['description'] = item['snippet']['description']
+  element['published'] = item['snippet']['publishedAt']
+  dt = datetime.datetime.strptime(element['published'],
+                                  '%Y-%m-%dT%H:%M:%S.000Z')
+  element['timestamp'] = int(time.mktime(dt.timetuple()))
+  element['video_id'] = item['contentDetails']['videoId']
+  element['safename'] = (reference_normalize_name(element['title']) + '-' +
+                         element['video_id'])
+  element['url'] = 'http://youtube.com/watch?v=%s' % element['video_id']
+  return element
+
+
+def measure(name, function, items):
+  data_util.normalized_names.clear()
+  start = time.time()
+  for item in items:
+    function(item)
+  elapsed = time.time() - start
+  print('%-10s %10.0f items/sec  (%.2fs)' % (name, len(items) / elapsed,
+                                             elapsed))
+
+
+def run():
+  count = 1000000
+  if len(sys.argv) > 1:
+    count = int(sys.argv[1])
+  items = make_items(count)
+  # Both paths must produce the same metadata.
+  for item in items[:1000]:
+    element = video_element.VideoElement.from_playlist_item(item).to_json()
+    expect = reference_ingest(item)
+    expect['length'] = None
+    if element != expect:
+      raise RuntimeError('Mismatch: %s != %s' % (element, expect))
+  print('Ingesting %d items' % count)
+  measure('reference', reference_ingest, items)
+  measure('ingest', video_element.VideoElement.from_playlist_item, items)
+
+
+if __name__ == '__main__':
+  run()
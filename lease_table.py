@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""Leases on videos that plugins are running on, shared by all processes.
+
+Several execute processes, on one or several machines, may work on the same
+output directory. Before running plugins on a video, a process claims a lease
+on its video_id, and other processes skip the video while the lease is held.
+Leases are kept in output_directory/data/leases.json:
+
+{
+  "XXXXXXXXXXX": {"owner": "host:1234:5f3a", "expires": 1234567890},
+  "YYYYYYYYYYY": {"owner": "host:1234:5f3a", "expires": 1234567890,
+                  "status": "success", "artifact": "files/video-title.mp4"},
+  ...
+}
+
+A lease is renewed in the background for as long as its owner runs. Once
+plugins are done, the result is recorded in the lease, so that other processes
+use it rather than run the plugins again, until the owner has saved it to the
+video index. If the owner dies, its leases expire and the videos can be
+claimed again.
+"""
+
+import errno
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+import json
+
+import file_util
+
+
+LEASE_DURATION = 15 * 60
+
+
+class LeaseTable(object):
+  def __init__(self, output_directory, duration=LEASE_DURATION):
+    self.output_directory = output_directory
+    self.path = os.path.join(output_directory, 'data', 'leases.json')
+    self.duration = duration
+    self.owner = '%s:%d:%04x' % (socket.gethostname(), os.getpid(),
+                                 random.getrandbits(16))
+    # video_ids leased by this process, running or with a recorded result.
+    self.held = set()
+    self.done = set()
+    # Results and releases not written yet, by video_id. They are written
+    # along with the next claim, renewal or stop, rather than one at a time.
+    self.unsaved = {}
+    self.lock = threading.Lock()
+    self.stopping = threading.Event()
+    self.renewer = None
+    self.time = time.time
+
+  def start(self):
+    """Renew held leases in the background until stop is called."""
+    self.stopping.clear()
+    self.renewer = threading.Thread(target=self._renew_loop)
+    self.renewer.daemon = True
+    self.renewer.start()
+
+  def stop(self):
+    """Stop renewing, and release the leases of videos with no result."""
+    self.stopping.set()
+    if self.renewer:
+      self.renewer.join()
+      self.renewer = None
+    with self.lock:
+      for video_id in self.held - self.done:
+        self.unsaved[video_id] = None
+      self.held &= self.done
+    self.renew()
+
+  def claim(self, video_ids, index=None):
+    """Try to lease the videos for this process.
+
+    Return a dictionary mapping each video_id to a tuple of whether the lease
+    was granted and, if not, the result another process recorded for the
+    video, or None if it is still running. If index is given, it is refreshed
+    and checked for results under the same lock, so that no result saved by
+    another process is missed.
+    """
+    claims = {}
+    def update(leases, now):
+      if index:
+        index.refresh()
+      for video_id in video_ids:
+        lease = leases.get(video_id)
+        if lease and lease['owner'] != self.owner and lease['expires'] > now:
+          if 'status' in lease:
+            claims[video_id] = (False, {'status': lease['status'],
+                                        'artifact': lease.get('artifact')})
+          else:
+            claims[video_id] = (False, None)
+          continue
+        known = index and index.get(video_id)
+        if known:
+          claims[video_id] = (False, known)
+          continue
+        leases[video_id] = {'owner': self.owner,
+                            'expires': now + self.duration}
+        claims[video_id] = (True, None)
+    self._update(update)
+    with self.lock:
+      self.held.update(v for v in video_ids if claims[v][0])
+    return claims
+
+  def complete(self, video_id, status, artifact=None):
+    """Record the result for a leased video, until forget_done is called."""
+    with self.lock:
+      self.unsaved[video_id] = {'status': status, 'artifact': artifact}
+      self.done.add(video_id)
+
+  def release(self, video_id):
+    """Give up the lease on a video, such as when its plugins failed."""
+    with self.lock:
+      self.unsaved[video_id] = None
+      self.held.discard(video_id)
+      self.done.discard(video_id)
+
+  def forget_done(self):
+    """Remove the results recorded by this process, once they are saved."""
+    with self.lock:
+      done = set(self.done)
+    def update(leases, now):
+      for video_id in done:
+        lease = leases.get(video_id)
+        if lease and lease['owner'] == self.owner:
+          del leases[video_id]
+    self._update(update)
+    with self.lock:
+      self.held -= done
+      self.done -= done
+
+  def renew(self):
+    """Extend the leases held by this process, and write unsaved results."""
+    with self.lock:
+      held = set(self.held)
+    def update(leases, now):
+      for video_id in held:
+        lease = leases.get(video_id)
+        if lease and lease['owner'] == self.owner:
+          lease['expires'] = now + self.duration
+    self._update(update)
+
+  def _renew_loop(self):
+    while not self.stopping.wait(self.duration / 3.0):
+      try:
+        self.renew()
+      except Exception as e:
+        # Try again next time, leases last long enough for a few failures.
+        sys.stderr.write('Failed to renew leases: %s\n' % (e,))
+
+  def _update(self, function):
+    """Call function with the leases and the time, then save the leases.
+
+    Results and releases not written yet are applied first.
+    """
+    with self.lock:
+      unsaved = dict(self.unsaved)
+    with file_util.output_lock(self.output_directory, self.path):
+      leases = self._load()
+      now = self.time()
+      for video_id, result in unsaved.items():
+        lease = leases.get(video_id)
+        if result is None:
+          if lease and lease['owner'] == self.owner:
+            del leases[video_id]
+        else:
+          lease = {'owner': self.owner, 'expires': now + self.duration}
+          lease.update(result)
+          leases[video_id] = lease
+      function(leases, now)
+      self._save(leases, now)
+    with self.lock:
+      for video_id, result in unsaved.items():
+        if self.unsaved.get(video_id, 0) is result:
+          del self.unsaved[video_id]
+
+  def leased(self):
+    """Return the video_ids leased by any process, as they are on disk."""
+    now = self.time()
+    return set(video_id for (video_id, lease) in self._load().items()
+               if lease['expires'] > now)
+
+  def _load(self):
+    try:
+      fp = open(self.path, 'r')
+    except IOError:
+      e = sys.exc_info()[1]
+      if e.errno == errno.ENOENT:
+        return {}
+      else:
+        raise
+    content = fp.read()
+    fp.close()
+    return json.loads(content)
+
+  def _save(self, leases, now):
+    # Expired leases are dropped, their owners are gone.
+    leases = dict((k, v) for k, v in leases.items() if v['expires'] > now)
+    file_util.write_atomic(self.path, [
+      json.dumps(leases, indent=2, separators=(',', ': '), sort_keys=True)])
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import lease_table
+import video_index
+
+
+class LeaseTableTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.temp_directory, 'data'))
+    self.now = 10000
+    self.first = self.create_table()
+    self.second = self.create_table()
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def create_table(self):
+    table = lease_table.LeaseTable(self.temp_directory, duration=100)
+    table.time = lambda: self.now
+    return table
+
+  def claim(self, table, video_id, index=None):
+    return table.claim([video_id], index)[video_id]
+
+  def test_claim(self):
+    self.assertEqual(self.first.claim(['v1', 'v2']),
+                     {'v1': (True, None), 'v2': (True, None)})
+    # Invisible to others while leased.
+    self.assertEqual(self.second.claim(['v1', 'v3']),
+                     {'v1': (False, None), 'v3': (True, None)})
+    self.first.release('v1')
+    # Releases are written along with the next update.
+    self.assertEqual(self.claim(self.second, 'v1'), (False, None))
+    self.first.renew()
+    self.assertEqual(self.claim(self.second, 'v1'), (True, None))
+
+  def test_expire_and_renew(self):
+    self.claim(self.first, 'v1')
+    self.now += 90
+    self.first.renew()
+    self.now += 90
+    self.assertEqual(self.claim(self.second, 'v1'), (False, None))
+    # The owner stopped renewing, such as after a crash.
+    self.now += 20
+    self.assertEqual(self.claim(self.second, 'v1'), (True, None))
+
+  def test_result(self):
+    index = video_index.VideoIndex(self.temp_directory)
+    self.claim(self.first, 'v1')
+    self.first.complete('v1', 'success', 'files/v1.mp4')
+    self.first.stop()
+    result = {'status': 'success', 'artifact': 'files/v1.mp4'}
+    self.assertEqual(self.claim(self.second, 'v1', index), (False, result))
+    # Once saved to the index, the result is found there.
+    other_index = video_index.VideoIndex(self.temp_directory)
+    other_index.put('v1', 'success', 'files/v1.mp4')
+    other_index.save()
+    self.first.forget_done()
+    self.assertEqual(self.claim(self.second, 'v1', index), (False, result))
+    self.assertEqual(self.claim(self.second, 'v2', index), (True, None))
+
+  def test_stop_releases_unfinished(self):
+    self.first.claim(['v1', 'v2'])
+    self.first.complete('v1', 'success')
+    self.first.stop()
+    self.assertEqual(self.second.claim(['v1', 'v2']),
+                     {'v1': (False, {'status': 'success', 'artifact': None}),
+                      'v2': (True, None)})
+
+  def test_one_save_per_claim(self):
+    saves = []
+    save = self.first._save
+    def counting_save(leases, now):
+      saves.append(sorted(leases))
+      save(leases, now)
+    self.first._save = counting_save
+    self.first.claim(['v%d' % i for i in range(50)])
+    self.assertEqual(len(saves), 1)
+    self.assertEqual(len(saves[0]), 50)
+
+
+if __name__ == '__main__':
+  unittest.main()
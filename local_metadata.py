@@ -6,6 +6,15 @@ Files on disk will live in the following directory structure:
 
 output_directory/
   data/
+    blobs.json         (blob_store, with the sharded file store)
+    leases.json        (lease_table)
+    lengths.json       (video_length_cache)
+    manifest.json      (feed_manifest)
+    metadata.sqlite    (metadata_store, with the sqlite backend)
+    pending.json       (pending_index)
+    query.sqlite       (query_index)
+    videos.json        (video_index)
+    watermarks.json    (last item synced in each playlist)
     favorites/
       feed.json
     playlist_1/
@@ -13,6 +22,16 @@ output_directory/
     playlist_2/
       feed.json
   ...
+  files/               (plugin outputs, with the flat file store)
+  blobs/               (plugin outputs, with the sharded file store)
+  locks/
+    data_favorites.lock
+    data_videos.json.lock
+    ...
+
+Each lock in locks is named after the file or feed directory it guards,
+relative to output_directory, see file_util.output_lock. Feeds are locked by
+directory, as feed.json and the files next to it are written together.
 
 Where each feed.json file will have the following structure:
 
@@ -29,25 +48,47 @@ Where each feed.json file will have the following structure:
   },
   ...
 ]
+
+Plugin results are recorded in a status.journal file next to each feed.json.
+Alternatively, all feeds can be stored in a single sqlite database, see
+metadata_store.
 """
 
 import errno
 import os
 import sys
+import threading
 
 import json
+from multiprocessing.pool import ThreadPool
 
+import feed_manifest
 import file_util
+import metadata_store
+import pending_index
+import query_index
+import video_length_cache
 
 
 class LocalMetadata(object):
-  def __init__(self, output_directory, verbose=None):
+  def __init__(self, output_directory, verbose=None, jobs=1, backend=None):
     self.output_directory = output_directory
     self.verbose = verbose
+    self.jobs = jobs
+    self.store = metadata_store.create_store(output_directory, backend)
+    # Guards writes to the store, which plugins may record statuses in while
+    # a sync adds videos.
+    self.lock = threading.RLock()
+    # Loaded on first use. None if the index has yet to be built.
+    self.pending = None
+    self.pending_loaded = False
+    # Opened on first use. None if the index has yet to be built.
+    self.query_index = None
+    self.query_index_loaded = False
     self.account = None
     self.feed_name = None
     self.target = None
-    self.current_metadata = None
+    self.current_count = None
 
   def create_init(self, account):
     """Create initial local metadata. If it already exists, warn and delete."""
@@ -57,73 +98,341 @@ class LocalMetadata(object):
         return
     unused_num_added = self._sync_metadata(quiet=False, initialize=True)
 
-  def synchronize(self, account, quiet=False):
-    """Update existing local metadata, and return number of new items."""
+  def synchronize(self, account, quiet=False, on_added=None, playlists=None):
+    """Update existing local metadata, and return number of new items.
+
+    If on_added is set, it is called with the feed filename and the new
+    entries as soon as each playlist is saved. If playlists is set, only
+    those playlists, as returned by get_all_playlists, are synchronized.
+    """
     self.account = account
     if not self.verbose is None:
       quiet = self.verbose
-    return self._sync_metadata(quiet, initialize=False)
+    return self._sync_metadata(quiet, initialize=False, on_added=on_added,
+                               playlists=playlists)
+
+  def get_etags(self):
+    """Return the etag last seen for each playlist_id."""
+    manifest = feed_manifest.FeedManifest(self.output_directory)
+    if not manifest.load():
+      # Written before the manifest existed.
+      return self._load_cache('etags.json')
+    return manifest.get_etags()
 
   def get_metadata_feeds(self):
     """Return list of paths to local metadata json files."""
-    feeds = []
-    feed_directories = os.listdir(os.path.join(self.output_directory, 'data'))
-    for item in feed_directories:
-      directory = os.path.join(self.output_directory, 'data', item)
-      if not os.path.isdir(directory):
-        continue
-      feeds.append(os.path.join(directory, 'feed.json'))
-    feeds.sort()
-    return feeds
+    return self.store.get_metadata_feeds()
 
   def serialize_feed(self, filename, data):
     """Serialize the metadata to the given filename."""
-    fp = open(filename, 'w')
-    fp.write(json.dumps(data, indent=2, separators=(',', ': ')))
-    fp.close()
+    with self.lock:
+      self.store.serialize_feed(filename, data)
 
   def deserialize_feed(self, filename):
     """Deserialize the metadata from the given filename."""
+    return self.store.deserialize_feed(filename)
+
+  def iter_feed(self, filename):
+    """Yield the metadata entries from the given filename, one at a time."""
+    return self.store.iter_feed(filename)
+
+  def append_status(self, filename, video_id, status):
+    """Record the status of a video in the given feed."""
+    with self.lock:
+      self.store.append_status(filename, video_id, status)
+      if self._get_pending():
+        self.pending.remove(filename, video_id)
+      if self._get_query_index():
+        self.query_index.set_status(filename, video_id, status)
+
+  def compact_feed(self, filename):
+    """Fold recorded statuses back into the given feed."""
+    self.compact_feeds([filename])
+
+  def compact_feeds(self, filenames):
+    """Fold recorded statuses back into the given feeds.
+
+    Their summaries in the feed manifest stay valid, only their signatures
+    are updated, so that the next sync does not read them again.
+    """
+    signatures = {}
+    with self.lock:
+      for filename in filenames:
+        before = self.store.feed_signature(filename)
+        self.store.compact_feed(filename)
+        after = self.store.feed_signature(filename)
+        if before != after:
+          signatures[filename] = (before, after)
+    if signatures:
+      manifest = feed_manifest.FeedManifest(self.output_directory)
+      manifest.replace_signatures(signatures)
+
+  def has_pending_index(self):
+    """Return whether the index of entries with no status exists."""
+    return not self._get_pending() is None
+
+  def iter_pending(self):
+    """Yield (filename, entry) for every entry with no status.
+
+    Only the feeds with pending entries are read. Use only if
+    has_pending_index returns True.
+    """
+    pending = self._get_pending()
+    feeds = set(self.get_metadata_feeds())
+    for filename in pending.get_feeds():
+      video_ids = set(pending.get(filename))
+      if filename in feeds:
+        for meta in self.iter_feed(filename):
+          if not meta['video_id'] in video_ids:
+            continue
+          video_ids.discard(meta['video_id'])
+          if 'status' in meta:
+            with self.lock:
+              pending.remove(filename, meta['video_id'])
+            continue
+          yield (filename, meta)
+      # Left are videos no longer in the feed, or the feed itself was removed,
+      # such as when init replaced it or it was edited by hand.
+      with self.lock:
+        for video_id in video_ids:
+          pending.remove(filename, video_id)
+
+  def rebuild_pending(self, work):
+    """Rebuild the pending index from (filename, entry) pairs, passed through.
+
+    work should yield every entry with no status, from every feed.
+    """
+    with self.lock:
+      self.pending = pending_index.PendingIndex(self.output_directory)
+      self.pending.clear()
+      self.pending_loaded = True
+    for (filename, meta) in work:
+      with self.lock:
+        self.pending.add(filename, [meta['video_id']])
+      yield (filename, meta)
+
+  def save_pending(self):
+    with self.lock:
+      if self.pending:
+        self.pending.save()
+
+  def _get_pending(self):
+    with self.lock:
+      if not self.pending_loaded:
+        pending = pending_index.PendingIndex(self.output_directory)
+        if pending.load():
+          self.pending = pending
+        self.pending_loaded = True
+      return self.pending
+
+  def query(self, text=None, min_length=None, max_length=None, status=None,
+            since=None, until=None, limit=None):
+    """Return entries matching all of the given conditions, newest first.
+
+    See QueryIndex.query. The index is built from every feed the first time.
+    """
+    if not self._get_query_index():
+      self.rebuild_query_index()
+    return self.query_index.query(text, min_length, max_length, status, since,
+                                  until, limit)
+
+  def rebuild_query_index(self):
+    """Index every feed again, such as after they were modified by hand."""
+    with self.lock:
+      index = query_index.QueryIndex(self.output_directory)
+      index.rebuild((f, self.iter_feed(f)) for f in self.get_metadata_feeds())
+      self.query_index = index
+      self.query_index_loaded = True
+
+  def _get_query_index(self):
+    with self.lock:
+      if not self.query_index_loaded:
+        index = query_index.QueryIndex(self.output_directory)
+        if index.exists():
+          self.query_index = index
+        self.query_index_loaded = True
+      return self.query_index
+
+  def compact(self):
+    """Fold recorded statuses and segments back into every feed."""
+    self.compact_feeds(self.get_metadata_feeds())
+
+  def migrate(self, backend):
+    """Copy all metadata into a new store using the given backend.
+
+    Return the new store. LocalMetadata uses the new store from then on.
+    """
+    store = metadata_store.create_store(self.output_directory, backend)
+    for filename in self.get_metadata_feeds():
+      self.compact_feed(filename)
+      store.serialize_feed(filename, self.deserialize_feed(filename))
+    self.store = store
+    return store
+
+  def export_json(self):
+    """Write every feed as a feed.json file, whatever the backend."""
+    exporter = metadata_store.JsonMetadataStore(self.output_directory)
+    for filename in self.get_metadata_feeds():
+      file_util.mkdir_p(os.path.dirname(filename))
+      exporter.serialize_feed(filename, self.deserialize_feed(filename))
+
+  def _sync_metadata(self, quiet, initialize, on_added=None, playlists=None):
     try:
-      fp = open(filename, 'r')
-    except IOError:
-      e = sys.exc_info()[1]
-      if e.errno == errno.ENOENT:
-        return []
-      else:
-        raise
-    content = fp.read()
-    fp.close()
-    return json.loads(content)
+      return self._sync_playlists(quiet, initialize, on_added, playlists)
+    finally:
+      # Stop threads the account started for this sync.
+      self.account.close()
 
-  def _sync_metadata(self, quiet, initialize):
+  def _sync_playlists(self, quiet, initialize, on_added, playlists):
     num_added = 0
-    etag_cache = self._load_etag_cache()
-    for playlist in self.account.get_all_playlists():
-      self._set_current_metadata(playlist['title'], playlist['directory'],
-                                 initialize)
-      timestamp = self._most_recent_timestamp()
-      if not quiet:
-        sys.stderr.write('Getting playlist "%s"\n' % playlist['title'])
-      videos = self.account.get_playlist_videos(playlist['playlist_id'],
-                                                min_timestamp=timestamp,
-                                                etag_cache=etag_cache)
-      self._save_etag_cache(etag_cache)
-      if videos is None:
+    manifest = feed_manifest.FeedManifest(self.output_directory)
+    if manifest.load():
+      etag_cache = manifest.get_etags()
+    else:
+      etag_cache = self._load_cache('etags.json')
+    watermarks = {}
+    if not initialize:
+      watermarks = self._load_cache('watermarks.json')
+    saved_watermarks = dict(watermarks)
+    if playlists is None:
+      playlists = self.account.get_all_playlists()
+    self.account.prefetch_first_pages([p['playlist_id'] for p in playlists])
+    file_util.mkdir_p(os.path.join(self.output_directory, 'data'))
+    length_cache = video_length_cache.VideoLengthCache(
+        os.path.join(self.output_directory, 'data', 'lengths.json'))
+    length_cache.load()
+    # When new videos are handed over as each playlist is saved, or the
+    # account looks up lengths while pages are fetched, lengths are looked up
+    # as each playlist is fetched instead.
+    fetch_lengths = on_added is not None or self.account.pipeline_lengths
+    results = self._fetch_playlists(playlists, etag_cache, watermarks,
+                                    initialize, manifest,
+                                    length_cache if fetch_lengths else None)
+    if on_added is None:
+      # Video lengths for all playlists are looked up together, so that videos
+      # found in several playlists are requested once, in full batches. With
+      # pipeline_lengths, this only retries lengths still missing.
+      results = list(results)
+      all_videos = []
+      for result in results:
+        if result[2]:
+          all_videos.extend(result[2])
+      self.account.fill_video_lengths(all_videos, length_cache)
+      length_cache.save()
+    # Fetching may happen concurrently, but results are merged here, in
+    # playlist order, so that the files written match the sequential path.
+    # The manifest and watermarks are written once, even if a playlist fails,
+    # so that the playlists merged so far need not be fetched again.
+    try:
+      for result in results:
+        (playlist, current_count, videos, etag, watermark, timestamp,
+         signature) = result
+        playlist_id = playlist['playlist_id']
+        self._set_current_metadata(playlist['title'], playlist['directory'],
+                                   current_count)
         if not quiet:
-          sys.stderr.write('No changes to "%s"\n' % playlist['title'])
-        continue
-      num_added += self._add_to_current_metadata(videos, quiet)
+          sys.stderr.write('Getting playlist "%s"\n' % playlist['title'])
+        if videos is None:
+          if not quiet:
+            sys.stderr.write('No changes to "%s"\n' % playlist['title'])
+        else:
+          num_added += self._add_to_current_metadata(videos, quiet,
+                                                     initialize, on_added)
+          if videos:
+            timestamp = videos[0].timestamp
+            signature = self.store.feed_signature(self.target)
+        # Only moved forward once the new videos are merged.
+        if not etag is None:
+          etag_cache[playlist_id] = etag
+        if not watermark is None:
+          watermarks[playlist_id] = watermark
+        manifest.update(playlist_id, self.target, timestamp,
+                        self.current_count, etag_cache.get(playlist_id),
+                        signature)
+    finally:
+      manifest.save()
+      if watermarks != saved_watermarks:
+        self._save_cache('watermarks.json', watermarks)
+    length_cache.save()
+    self.save_pending()
     return num_added
 
-  def _save_etag_cache(self, etag_cache):
-    path = os.path.join(self.output_directory, 'data', 'etags.json')
-    fp = open(path, 'w')
-    fp.write(json.dumps(etag_cache, indent=2, separators=(',', ': ')))
-    fp.close()
+  def _fetch_playlists(self, playlists, etag_cache, watermarks, initialize,
+                       manifest, length_cache=None):
+    """Yield fetch results for each playlist, in the order given.
 
-  def _load_etag_cache(self):
-    path = os.path.join(self.output_directory, 'data', 'etags.json')
+    With more than one job, playlists are fetched by a pool of worker threads,
+    each using its own copy of the account so that HTTP clients are not
+    shared between threads.
+    """
+    local = threading.local()
+    def fetch(playlist):
+      if self.jobs <= 1:
+        account = self.account
+      else:
+        if not hasattr(local, 'account'):
+          local.account = self.account.clone()
+        account = local.account
+      return self._fetch_playlist(account, playlist, etag_cache, watermarks,
+                                  initialize, manifest, length_cache)
+    if self.jobs <= 1:
+      for playlist in playlists:
+        yield fetch(playlist)
+      return
+    pool = ThreadPool(self.jobs)
+    try:
+      for result in pool.imap(fetch, playlists):
+        yield result
+    finally:
+      pool.terminate()
+      pool.join()
+
+  def _fetch_playlist(self, account, playlist, etag_cache, watermarks,
+                      initialize, manifest, length_cache=None):
+    """Fetch new videos for a single playlist, without writing anything.
+
+    Video lengths are left unset, unless length_cache is given. The feed is
+    only read if the manifest has no up to date summary of it.
+
+    Return a tuple of the playlist, its current number of videos, the new
+    videos (or None if the playlist is unchanged), the new etag and the new
+    watermark (either may be None), and the newest timestamp and signature of
+    the feed before the new videos are added.
+    """
+    target = self._feed_path(playlist['directory'])
+    playlist_id = playlist['playlist_id']
+    signature = None
+    if initialize:
+      (timestamp, current_count) = (None, 0)
+    else:
+      signature = self.store.feed_signature(target)
+      summary = manifest.get_summary(playlist_id, target, signature)
+      if summary is None:
+        summary = self.store.feed_summary(target)
+      (timestamp, current_count) = summary
+    # Each fetch gets private caches, merged back by the caller.
+    private_cache = {}
+    if playlist_id in etag_cache:
+      private_cache[playlist_id] = etag_cache[playlist_id]
+    private_watermarks = {}
+    if playlist_id in watermarks:
+      private_watermarks[playlist_id] = watermarks[playlist_id]
+    videos = account.get_playlist_videos(playlist_id,
+                                         min_timestamp=timestamp,
+                                         etag_cache=private_cache,
+                                         fetch_lengths=not length_cache is None,
+                                         watermarks=private_watermarks,
+                                         length_cache=length_cache)
+    return (playlist, current_count, videos, private_cache.get(playlist_id),
+            private_watermarks.get(playlist_id), timestamp, signature)
+
+  def _save_cache(self, name, cache):
+    path = os.path.join(self.output_directory, 'data', name)
+    file_util.write_atomic(path, [
+      json.dumps(cache, indent=2, separators=(',', ': '))])
+
+  def _load_cache(self, name):
+    path = os.path.join(self.output_directory, 'data', name)
     try:
       fp = open(path, 'r')
     except IOError:
@@ -136,34 +445,42 @@ class LocalMetadata(object):
     fp.close()
     return json.loads(content)
 
-  def _set_current_metadata(self, title, feed_directory, initialize):
+  def _feed_path(self, feed_directory):
+    return metadata_store.feed_path(self.output_directory, feed_directory)
+
+  def _set_current_metadata(self, title, feed_directory, current_count):
     self.feed_name = title
-    self.target = os.path.join(self.output_directory, 'data', feed_directory,
-                               'feed.json')
-    file_util.mkdir_p(os.path.dirname(self.target))
-    if initialize:
-      self.current_metadata = []
-    else:
-      self.current_metadata = self.deserialize_feed(self.target)
+    self.target = self._feed_path(feed_directory)
+    self.current_count = current_count
 
-  def _add_to_current_metadata(self, videos, quiet):
+  def _add_to_current_metadata(self, videos, quiet, initialize=False,
+                               on_added=None):
+    if initialize or len(videos) > 0:
+      file_util.mkdir_p(os.path.dirname(self.target))
     if len(videos) == 0:
       if not quiet:
         sys.stderr.write('No new elements for "%s", has %d elements\n' % (
-            self.feed_name, len(self.current_metadata)))
+            self.feed_name, self.current_count))
       return 0
     if not quiet:
       sys.stderr.write('Adding %d elements to "%s", had %d elements\n' % (
-          len(videos), self.feed_name, len(self.current_metadata)))
-    self.current_metadata = ([v.to_json() for v in videos] +
-                             self.current_metadata)
-    self.serialize_feed(self.target, self.current_metadata)
+          len(videos), self.feed_name, self.current_count))
+    entries = [v.to_json() for v in videos]
+    with self.lock:
+      self.store.add_to_feed(self.target, entries, replace=initialize)
+      if initialize and not self._get_pending():
+        self.pending = pending_index.PendingIndex(self.output_directory)
+        self.pending.clear()
+      if self._get_pending():
+        self.pending.add(self.target, [e['video_id'] for e in entries],
+                         replace=initialize)
+      if self._get_query_index():
+        self.query_index.add(self.target, entries, replace=initialize)
+    self.current_count += len(videos)
+    if not on_added is None:
+      on_added(self.target, entries)
     return len(videos)
 
-  def _most_recent_timestamp(self):
-    if len(self.current_metadata) > 0:
-      return self.current_metadata[0]['timestamp']
-
   def _warning_accepted(self):
     message = """Output directory '%s' already found. Running init will
 clear existing metadata and download it again. Modifications that have been
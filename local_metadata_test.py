@@ -2,18 +2,27 @@ import os
 import shutil
 import sys
 import tempfile
+import threading
 import unittest
 
+import json
+
+import file_util
 import local_metadata
+import metadata_store
 import user_account_fake
 
 
 class LocalMetadataTest(unittest.TestCase):
+  jobs = 1
+  backend = None
+
   def setUp(self):
     self.temp_directory = tempfile.mkdtemp()
     self.output_directory = os.path.join(self.temp_directory, 'output')
     self.metadata = local_metadata.LocalMetadata(self.output_directory,
-                                                 verbose=False)
+                                                 verbose=False, jobs=self.jobs,
+                                                 backend=self.backend)
     self.account = user_account_fake.UserAccountFake()
 
   def tearDown(self):
@@ -73,11 +82,7 @@ class LocalMetadataTest(unittest.TestCase):
     "length": 0
   }
 ]"""
-    expect_etags = """{
-  "PLC": "Cetag1",
-  "PLB": "Betag1",
-  "PLA": "Aetag1"
-}"""
+    expect_etags = {'PLA': 'Aetag1', 'PLB': 'Betag1', 'PLC': 'Cetag1'}
     expect_stderr = """Getting playlist "Apple"
 Adding 1 elements to "Apple", had 0 elements
 Getting playlist "Banana"
@@ -85,10 +90,12 @@ Adding 1 elements to "Banana", had 0 elements
 Getting playlist "Carrot"
 Adding 1 elements to "Carrot", had 0 elements
 """
-    self.assertEqual(expect_apple, self.read('output/data/apple/feed.json'))
-    self.assertEqual(expect_banana, self.read('output/data/banana/feed.json'))
-    self.assertEqual(expect_carrot, self.read('output/data/carrot/feed.json'))
-    self.assertEqual(expect_etags, self.read('output/data/etags.json'))
+    # Key order depends on the Python version, compare the parsed feeds.
+    for (expect, name) in [(expect_apple, 'apple'), (expect_banana, 'banana'),
+                           (expect_carrot, 'carrot')]:
+      self.assertEqual(json.loads(expect), json.loads(
+        self.read('output/data/%s/feed.json' % name)))
+    self.assertEqual(expect_etags, self.metadata.get_etags())
     self.assertEqual(expect_stderr, self.read('stderr'))
     # Get metadata feeds.
     expect_feeds = [self.temp_directory + '/output/data/apple/feed.json',
@@ -97,6 +104,297 @@ Adding 1 elements to "Carrot", had 0 elements
     feeds = self.metadata.get_metadata_feeds()
     self.assertEqual(expect_feeds, feeds)
 
+  def test_sequential_and_parallel_match(self):
+    other_directory = os.path.join(self.temp_directory, 'other')
+    other = local_metadata.LocalMetadata(other_directory, verbose=True,
+                                         jobs=(4 if self.jobs == 1 else 1))
+    self.metadata.synchronize(self.account)
+    other.synchronize(self.account)
+    for name in ['apple/feed.json', 'banana/feed.json', 'carrot/feed.json']:
+      self.assertEqual(self.read(os.path.join('output/data', name)),
+                       self.read(os.path.join('other/data', name)))
+    self.assertEqual(self.metadata.get_etags(), other.get_etags())
+
+  def test_status_journal(self):
+    self.metadata.synchronize(self.account)
+    filename = os.path.join(self.output_directory, 'data/apple/feed.json')
+    self.metadata.append_status(filename, 'vA_', 'success')
+    # Feed is unchanged on disk, but the journal is overlaid when loading.
+    self.assertFalse('status' in self.read('output/data/apple/feed.json'))
+    data = self.metadata.deserialize_feed(filename)
+    self.assertEqual(data[0]['status'], 'success')
+    # A record cut short by a crash is ignored.
+    fp = open(os.path.join(self.output_directory, 'data/apple',
+                           'status.journal'), 'a')
+    fp.write('{"video_id": "vA_", "sta')
+    fp.close()
+    self.metadata.append_status(filename, 'vA_', 'failed')
+    data = self.metadata.deserialize_feed(filename)
+    self.assertEqual(data[0]['status'], 'failed')
+    # Compaction folds the journal into the feed.
+    self.metadata.compact_feed(filename)
+    self.assertFalse(os.path.exists(os.path.join(
+        self.output_directory, 'data/apple/status.journal')))
+    self.assertTrue('"status": "failed"' in
+                    self.read('output/data/apple/feed.json'))
+
+  def test_video_length_cache(self):
+    self.metadata.synchronize(self.account)
+    self.assertEqual(self.account.length_requests, [['vA_', 'vB_', 'vC_']])
+    # Lengths are remembered across runs.
+    self.metadata = local_metadata.LocalMetadata(self.output_directory,
+                                                 verbose=False, jobs=self.jobs,
+                                                 backend=self.backend)
+    self.account = user_account_fake.UserAccountFake()
+    self.metadata.synchronize(self.account)
+    self.assertEqual(self.account.length_requests, [])
+    data = self.metadata.deserialize_feed(
+        os.path.join(self.output_directory, 'data/apple/feed.json'))
+    self.assertEqual(data[0]['length'], 0)
+
+  def test_on_added(self):
+    added = []
+    def on_added(filename, entries):
+      # Each playlist is saved before its entries are handed over.
+      saved = [e['video_id'] for e in self.metadata.iter_feed(filename)]
+      added.append((os.path.basename(os.path.dirname(filename)),
+                    [e['video_id'] for e in entries], saved,
+                    [e['length'] for e in entries]))
+    num_added = self.metadata.synchronize(self.account, on_added=on_added)
+    self.assertEqual(num_added, 3)
+    self.assertEqual(added, [('apple', ['vA_'], ['vA_'], [0]),
+                             ('banana', ['vB_'], ['vB_'], [0]),
+                             ('carrot', ['vC_'], ['vC_'], [0])])
+
+  def test_pending_index(self):
+    self.metadata.synchronize(self.account)
+    # Built by the first full scan, not by a sync into an existing directory.
+    self.assertFalse(self.metadata.has_pending_index())
+    feeds = self.metadata.get_metadata_feeds()
+    work = list(self.metadata.rebuild_pending(
+      (f, e) for f in feeds for e in self.metadata.iter_feed(f)))
+    self.assertEqual(len(work), 3)
+    self.metadata.save_pending()
+    apple = os.path.join(self.output_directory, 'data/apple/feed.json')
+    self.metadata.append_status(apple, 'vA_', 'success')
+    self.metadata.save_pending()
+    metadata = local_metadata.LocalMetadata(self.output_directory,
+                                            verbose=False, jobs=self.jobs,
+                                            backend=self.backend)
+    self.assertTrue(metadata.has_pending_index())
+    self.assertEqual(sorted(meta['video_id'] for (f, meta)
+                            in metadata.iter_pending()), ['vB_', 'vC_'])
+
+  def test_pending_entry_missing_from_feed(self):
+    self.metadata.synchronize(self.account)
+    feeds = self.metadata.get_metadata_feeds()
+    list(self.metadata.rebuild_pending(
+      (f, e) for f in feeds for e in self.metadata.iter_feed(f)))
+    self.metadata.save_pending()
+    # The feed is replaced by one without the pending video.
+    apple = os.path.join(self.output_directory, 'data/apple/feed.json')
+    self.metadata.serialize_feed(apple, [])
+    read = []
+    iter_feed = self.metadata.iter_feed
+    def counting_iter_feed(filename):
+      read.append(os.path.basename(os.path.dirname(filename)))
+      return iter_feed(filename)
+    self.metadata.iter_feed = counting_iter_feed
+    self.assertEqual(sorted(meta['video_id'] for (f, meta)
+                            in self.metadata.iter_pending()), ['vB_', 'vC_'])
+    self.metadata.save_pending()
+    # The entry is dropped, and the feed is not read again.
+    del read[:]
+    metadata = local_metadata.LocalMetadata(self.output_directory,
+                                            verbose=False, jobs=self.jobs,
+                                            backend=self.backend)
+    metadata.iter_feed = counting_iter_feed
+    self.assertEqual(sorted(meta['video_id'] for (f, meta)
+                            in metadata.iter_pending()), ['vB_', 'vC_'])
+    self.assertEqual(sorted(read), ['banana', 'carrot'])
+
+  def test_shared_pending_index(self):
+    self.metadata.synchronize(self.account)
+    feeds = self.metadata.get_metadata_feeds()
+    list(self.metadata.rebuild_pending(
+      (f, e) for f in feeds for e in self.metadata.iter_feed(f)))
+    self.metadata.save_pending()
+    # Two processes record statuses, neither loses the other's.
+    other = local_metadata.LocalMetadata(self.output_directory,
+                                         verbose=False, jobs=self.jobs,
+                                         backend=self.backend)
+    self.assertTrue(other.has_pending_index())
+    self.metadata.append_status(feeds[0], 'vA_', 'success')
+    other.append_status(feeds[1], 'vB_', 'failed')
+    self.metadata.save_pending()
+    other.save_pending()
+    metadata = local_metadata.LocalMetadata(self.output_directory,
+                                            verbose=False, jobs=self.jobs,
+                                            backend=self.backend)
+    self.assertEqual([meta['video_id'] for (f, meta)
+                      in metadata.iter_pending()], ['vC_'])
+
+  def test_query(self):
+    self.metadata.synchronize(self.account)
+    # Built from the feeds on first use.
+    self.assertEqual(['vC_', 'vB_', 'vA_'],
+                     [e['video_id'] for e in self.metadata.query()])
+    self.assertEqual(['vA_'], [e['video_id'] for e in
+                               self.metadata.query(text='APPLE video')])
+    self.assertEqual([], self.metadata.query(text='apple banana'))
+    self.assertEqual(['vB_'], [e['video_id'] for e in
+                               self.metadata.query(since=400, until=500)])
+    self.assertEqual(3, len(self.metadata.query(min_length=0, max_length=0)))
+    self.assertEqual(['vC_'], [e['video_id'] for e in
+                               self.metadata.query(limit=1)])
+    # Then kept up to date.
+    apple = os.path.join(self.output_directory, 'data/apple/feed.json')
+    self.metadata.append_status(apple, 'vA_', 'success')
+    self.assertEqual([{'feed': 'data/apple/feed.json', 'video_id': 'vA_',
+                       'title': 'Apple Video',
+                       'url': 'http://youtube.com/watch?v=vA_',
+                       'timestamp': 123, 'length': 0, 'status': 'success'}],
+                     self.metadata.query(status='success'))
+    self.assertEqual(['vC_', 'vB_'], [e['video_id'] for e in
+                                      self.metadata.query(status='')])
+    get_playlist_videos = self.account.get_playlist_videos
+    def get_new_videos(playlist_id, **kwargs):
+      videos = get_playlist_videos(playlist_id, **kwargs)
+      for video in videos:
+        video.video_id += 'new'
+        video.title = 'New ' + video.title
+      return videos
+    self.account.get_playlist_videos = get_new_videos
+    self.account.clone = lambda: self.account
+    self.metadata.synchronize(self.account)
+    self.assertEqual(['vA_new', 'vA_'], [e['video_id'] for e in
+                                         self.metadata.query(text='apple')])
+    self.assertEqual(3, len(self.metadata.query(text='new')))
+
+  def test_manifest(self):
+    self.metadata.synchronize(self.account)
+    read = []
+    feed_summary = self.metadata.store.feed_summary
+    def summary(filename):
+      read.append(os.path.basename(os.path.dirname(filename)))
+      return feed_summary(filename)
+    self.metadata.store.feed_summary = summary
+    self.metadata.synchronize(self.account)
+    self.assertEqual(read, [])
+    # A feed changed by anything but a sync is read again.
+    apple = os.path.join(self.output_directory, 'data/apple/feed.json')
+    self.metadata.serialize_feed(apple, [])
+    self.metadata.synchronize(self.account)
+    self.assertEqual(read, ['apple'])
+
+  def test_manifest_after_compact(self):
+    self.metadata.synchronize(self.account)
+    apple = os.path.join(self.output_directory, 'data/apple/feed.json')
+    self.metadata.append_status(apple, 'vA_', 'success')
+    self.metadata.compact_feeds([apple])
+    read = []
+    feed_summary = self.metadata.store.feed_summary
+    def summary(filename):
+      read.append(os.path.basename(os.path.dirname(filename)))
+      return feed_summary(filename)
+    self.metadata.store.feed_summary = summary
+    # Compacting rewrote the feed, but did not change its summary.
+    self.metadata.synchronize(self.account)
+    self.assertEqual(read, [])
+
+  def test_serialize_and_iterate_feed(self):
+    os.makedirs(os.path.join(self.output_directory, 'data/apple'))
+    filename = os.path.join(self.output_directory, 'data/apple/feed.json')
+    data = [{'title': 'Video %d' % i, 'description': 'line\n"%d"' % i,
+             'video_id': 'v%d' % i} for i in range(100)]
+    self.metadata.serialize_feed(filename, iter(data))
+    self.assertEqual(data, list(self.metadata.iter_feed(filename)))
+    self.assertEqual(data, self.metadata.deserialize_feed(filename))
+
+  def test_segmented_feed(self):
+    self.metadata.synchronize(self.account)
+    segmented = local_metadata.LocalMetadata(self.output_directory,
+                                             verbose=False, backend='segmented')
+    filename = os.path.join(self.output_directory, 'data/apple/feed.json')
+    before = self.read('output/data/apple/feed.json')
+    entries = [{'video_id': 'new%d' % i, 'timestamp': 1000 + i}
+               for i in range(3)]
+    segmented.store.add_to_feed(filename, entries[:1])
+    segmented.store.add_to_feed(filename, entries[1:][::-1])
+    # The feed itself is not rewritten.
+    self.assertEqual(before, self.read('output/data/apple/feed.json'))
+    data = segmented.deserialize_feed(filename)
+    self.assertEqual(['new2', 'new1', 'new0', 'vA_'],
+                     [meta['video_id'] for meta in data])
+    segmented.compact()
+    self.assertEqual(['feed.json'], os.listdir(os.path.dirname(filename)))
+    self.assertEqual(data, segmented.deserialize_feed(filename))
+
+
+class LocalMetadataParallelTest(LocalMetadataTest):
+  jobs = 4
+
+
+class LocalMetadataSqliteTest(LocalMetadataTest):
+  backend = 'sqlite'
+
+  def read(self, relative_path):
+    # Feeds only exist in the database until they are exported.
+    if relative_path.endswith('feed.json'):
+      self.metadata.export_json()
+    return LocalMetadataTest.read(self, relative_path)
+
+  def test_status_journal(self):
+    self.metadata.synchronize(self.account)
+    filename = os.path.join(self.output_directory, 'data/apple/feed.json')
+    self.metadata.append_status(filename, 'vA_', 'success')
+    data = self.metadata.deserialize_feed(filename)
+    self.assertEqual(data[0]['status'], 'success')
+    self.assertFalse(os.path.exists(os.path.join(
+        self.output_directory, 'data/apple/status.journal')))
+
+  def test_writes_hold_file_lock(self):
+    self.metadata.synchronize(self.account)
+    filename = os.path.join(self.output_directory, 'data/apple/feed.json')
+    lock = file_util.output_lock(self.output_directory,
+                                 self.metadata.store.path)
+    writer = threading.Thread(target=self.metadata.append_status,
+                              args=(filename, 'vA_', 'success'))
+    with lock:
+      writer.start()
+      writer.join(0.2)
+      # Waits for the lock, as a process on another machine would.
+      self.assertTrue(writer.is_alive())
+    writer.join()
+    self.assertEqual(self.metadata.deserialize_feed(filename)[0]['status'],
+                     'success')
+
+  def test_segmented_feed(self):
+    self.skipTest('Segments are only used by the json layout.')
+
+  def test_manifest(self):
+    self.skipTest('Feed summaries are read from the database every time.')
+
+  def test_manifest_after_compact(self):
+    self.skipTest('Feed summaries are read from the database every time.')
+
+  def test_migrate(self):
+    json_metadata = local_metadata.LocalMetadata(self.output_directory,
+                                                 verbose=False, backend='json')
+    json_metadata.synchronize(self.account)
+    filename = os.path.join(self.output_directory, 'data/apple/feed.json')
+    json_metadata.append_status(filename, 'vA_', 'success')
+    expect = [json_metadata.deserialize_feed(f)
+              for f in json_metadata.get_metadata_feeds()]
+    json_metadata.migrate('sqlite')
+    # Detected as sqlite from now on.
+    metadata = local_metadata.LocalMetadata(self.output_directory)
+    self.assertTrue(isinstance(metadata.store,
+                               metadata_store.SqliteMetadataStore))
+    actual = [metadata.deserialize_feed(f)
+              for f in metadata.get_metadata_feeds()]
+    self.assertEqual(expect, actual)
+
 
 if __name__ == '__main__':
   unittest.main()
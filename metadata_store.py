@@ -0,0 +1,523 @@
+#!/usr/bin/env python
+
+"""Storage backends for local metadata.
+
+Feeds are identified by the path of their feed.json file, whichever backend is
+used, so that callers can treat feeds the same way.
+
+JsonMetadataStore keeps each feed as a feed.json file, in the layout described
+in local_metadata. Plugin results are appended to a status.journal file next to
+each feed.json, one json object per line:
+
+{"video_id": "XXXXXXXXXXX", "status": "success", "timestamp": 1234567890}
+
+Journal records are overlaid onto the feed when it is deserialized, and folded
+back into feed.json by compact_feed.
+
+With the segmented layout, new videos are written to small segment-N.json files
+next to feed.json instead of rewriting the whole feed, and segments.json lists
+them newest first:
+
+{"base": [1234, 1234567890.5], "segments": ["segment-2.json", "segment-1.json"]}
+
+Readers chain the segments before feed.json. "base" is the size and mtime of
+feed.json when the segments were written. If feed.json has been rewritten since,
+the segments have already been folded into it and are ignored. compact_feed
+merges segments into feed.json.
+
+Writes to a feed, including status records, hold a lock on
+output_directory/locks/<feed directory>.lock, so that several processes, on
+one or several machines sharing the output directory, can update the same feeds
+without losing each other's changes.
+
+SqliteMetadataStore keeps all feeds in a single output_directory/data/
+metadata.sqlite database, indexed by feed and timestamp, video_id and status.
+Its write transactions hold a lock on output_directory/locks/
+data_metadata.sqlite.lock, as sqlite's own locking is not reliable over NFS.
+"""
+
+import errno
+import itertools
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import json
+
+import file_util
+
+
+JOURNAL_FILENAME = 'status.journal'
+JOURNAL_COMPACT_SIZE = 1024 * 1024
+SEGMENTS_FILENAME = 'segments.json'
+SEGMENTS_COMPACT_COUNT = 32
+SQLITE_FILENAME = 'metadata.sqlite'
+READ_CHUNK_SIZE = 64 * 1024
+WHITESPACE = re.compile(r'\s*')
+
+
+def create_store(output_directory, backend=None):
+  """Create the store for the given backend, 'json', 'segmented' or 'sqlite'.
+
+  If backend is None, use sqlite if the output directory already has a
+  database, otherwise json.
+  """
+  if backend is None:
+    if os.path.exists(os.path.join(output_directory, 'data', SQLITE_FILENAME)):
+      backend = 'sqlite'
+    else:
+      backend = 'json'
+  if backend == 'json':
+    return JsonMetadataStore(output_directory)
+  elif backend == 'segmented':
+    return JsonMetadataStore(output_directory, segmented=True)
+  elif backend == 'sqlite':
+    return SqliteMetadataStore(output_directory)
+  raise RuntimeError('Unknown metadata backend %s' % (backend,))
+
+
+def feed_path(output_directory, feed_directory):
+  return os.path.join(output_directory, 'data', feed_directory, 'feed.json')
+
+
+def encode_feed(entries):
+  """Yield the json text of a list of entries, one entry at a time.
+
+  The text is the same as json.dumps(list(entries), indent=2,
+  separators=(',', ': ')).
+  """
+  empty = True
+  for meta in entries:
+    text = json.dumps(meta, indent=2, separators=(',', ': '))
+    # Indent the entry one level, as an element of the list.
+    yield ('[\n  ' if empty else ',\n  ') + text.replace('\n', '\n  ')
+    empty = False
+  yield '[]' if empty else '\n]'
+
+
+def decode_feed(fp):
+  """Yield the entries of a json list read from fp, one entry at a time.
+
+  Only the entry being decoded is held in memory, not the whole text.
+  """
+  decoder = json.JSONDecoder()
+  buffer = ''
+  started = False
+  while True:
+    chunk = fp.read(READ_CHUNK_SIZE)
+    buffer += chunk
+    position = 0
+    while True:
+      position = WHITESPACE.match(buffer, position).end()
+      if position == len(buffer):
+        break
+      if not started:
+        if buffer[position] != '[':
+          raise ValueError('Expected a json list')
+        started = True
+        position += 1
+      elif buffer[position] == ']':
+        return
+      elif buffer[position] == ',':
+        position += 1
+      else:
+        try:
+          (meta, position) = decoder.raw_decode(buffer, position)
+        except ValueError:
+          # The entry continues in the next chunk.
+          if not chunk:
+            raise
+          break
+        yield meta
+    buffer = buffer[position:]
+    if not chunk:
+      raise ValueError('Unexpected end of json list')
+
+
+class JsonMetadataStore(object):
+  def __init__(self, output_directory, segmented=False):
+    self.output_directory = output_directory
+    self.segmented = segmented
+
+  def get_metadata_feeds(self):
+    """Return list of paths to local metadata json files."""
+    feeds = []
+    try:
+      feed_directories = os.listdir(os.path.join(self.output_directory,
+                                                 'data'))
+    except OSError:
+      e = sys.exc_info()[1]
+      if e.errno == errno.ENOENT:
+        # Nothing has been synced yet.
+        return feeds
+      else:
+        raise
+    for item in feed_directories:
+      directory = os.path.join(self.output_directory, 'data', item)
+      if not os.path.isdir(directory):
+        continue
+      feeds.append(os.path.join(directory, 'feed.json'))
+    feeds.sort()
+    return feeds
+
+  def serialize_feed(self, filename, data):
+    """Serialize the metadata to the given filename, replacing it atomically.
+
+    data may be any iterable of entries, it is encoded one entry at a time.
+    Any segments are replaced as well.
+    """
+    with self._lock(filename):
+      file_util.write_atomic(filename, encode_feed(data))
+      self._remove_segments(filename)
+
+  def deserialize_feed(self, filename):
+    """Deserialize the metadata from the given filename."""
+    return list(self.iter_feed(filename))
+
+  def iter_feed(self, filename):
+    """Yield the entries of the feed, without loading the whole file."""
+    # Files are opened under the lock, so that they are consistent with each
+    # other, then read without it. Files are replaced rather than rewritten,
+    # so the content of open files does not change.
+    files = []
+    try:
+      with self._lock(filename):
+        statuses = self._load_journal(filename)
+        directory = os.path.dirname(filename)
+        paths = [os.path.join(directory, segment)
+                 for segment in self._load_segments(filename)]
+        paths.append(filename)
+        for path in paths:
+          try:
+            files.append(open(path, 'r'))
+          except IOError:
+            e = sys.exc_info()[1]
+            if e.errno != errno.ENOENT:
+              raise
+      for fp in files:
+        for meta in decode_feed(fp):
+          if meta.get('video_id') in statuses:
+            meta['status'] = statuses[meta['video_id']]
+          yield meta
+    finally:
+      for fp in files:
+        fp.close()
+
+  def feed_summary(self, filename):
+    """Return the newest timestamp in the feed, or None, and its length."""
+    timestamp = None
+    count = 0
+    for meta in self.iter_feed(filename):
+      if count == 0:
+        timestamp = meta['timestamp']
+      count += 1
+    return (timestamp, count)
+
+  def feed_signature(self, filename):
+    """Return a value that changes whenever entries are added to the feed.
+
+    Only the files are looked at, not their content, so that a summary of
+    the feed can be reused without reading it.
+    """
+    return [self._base_signature(filename),
+            self._base_signature(self._segments_path(filename))]
+
+  def add_to_feed(self, filename, entries, replace=False):
+    """Add entries, newest first, to the front of the feed.
+
+    If replace is set, existing entries and statuses are discarded.
+    """
+    with self._lock(filename):
+      if replace:
+        self._remove_journal(filename)
+        self.serialize_feed(filename, entries)
+      elif self.segmented:
+        self._add_segment(filename, entries)
+      else:
+        self.serialize_feed(filename,
+                            itertools.chain(entries, self.iter_feed(filename)))
+
+  def append_status(self, filename, video_id, status):
+    """Record the status of a video in the journal for the given feed."""
+    path = self._journal_path(filename)
+    record = {'video_id': video_id, 'status': status,
+              'timestamp': int(time.time())}
+    with self._lock(filename):
+      fp = open(path, 'ab+')
+      fp.seek(0, os.SEEK_END)
+      line = json.dumps(record) + '\n'
+      if fp.tell() > 0:
+        # Start a new line if the last record was cut short by a crash.
+        fp.seek(-1, os.SEEK_END)
+        if fp.read(1) != b'\n':
+          line = '\n' + line
+      fp.write(line.encode('utf-8'))
+      fp.flush()
+      os.fsync(fp.fileno())
+      size = fp.tell()
+      fp.close()
+      if size > JOURNAL_COMPACT_SIZE:
+        self.compact_feed(filename)
+
+  def compact_feed(self, filename):
+    """Fold the status journal and segments back into the feed.json."""
+    path = self._journal_path(filename)
+    # Held until the journal is removed, so that no status recorded meanwhile
+    # is lost.
+    with self._lock(filename):
+      has_journal = os.path.exists(path)
+      if not has_journal and not self._load_segments(filename):
+        return
+      self.serialize_feed(filename, self.iter_feed(filename))
+      if has_journal:
+        os.unlink(path)
+
+  def _lock(self, filename):
+    return file_util.output_lock(self.output_directory,
+                                 os.path.dirname(filename))
+
+  def _segments_path(self, filename):
+    return os.path.join(os.path.dirname(filename), SEGMENTS_FILENAME)
+
+  def _base_signature(self, filename):
+    try:
+      stat = os.stat(filename)
+    except OSError:
+      e = sys.exc_info()[1]
+      if e.errno == errno.ENOENT:
+        return [0, 0]
+      else:
+        raise
+    return [stat.st_size, stat.st_mtime]
+
+  def _load_segments(self, filename):
+    """Return the segment filenames for the feed, newest first."""
+    try:
+      fp = open(self._segments_path(filename), 'r')
+    except IOError:
+      e = sys.exc_info()[1]
+      if e.errno == errno.ENOENT:
+        return []
+      else:
+        raise
+    manifest = json.loads(fp.read())
+    fp.close()
+    # Segments written before feed.json was last replaced are already in it.
+    if manifest['base'] != self._base_signature(filename):
+      return []
+    return manifest['segments']
+
+  def _add_segment(self, filename, entries):
+    segments = self._load_segments(filename)
+    number = 1
+    if segments:
+      number = int(segments[0][len('segment-'):-len('.json')]) + 1
+    segment = 'segment-%d.json' % number
+    directory = os.path.dirname(filename)
+    file_util.write_atomic(os.path.join(directory, segment),
+                           encode_feed(entries))
+    manifest = {'base': self._base_signature(filename),
+                'segments': [segment] + segments}
+    file_util.write_atomic(self._segments_path(filename),
+                           [json.dumps(manifest)])
+    if len(manifest['segments']) >= SEGMENTS_COMPACT_COUNT:
+      self.compact_feed(filename)
+
+  def _remove_segments(self, filename):
+    directory = os.path.dirname(filename)
+    for item in os.listdir(directory):
+      if item == SEGMENTS_FILENAME or item.startswith('segment-'):
+        os.unlink(os.path.join(directory, item))
+
+  def _journal_path(self, filename):
+    return os.path.join(os.path.dirname(filename), JOURNAL_FILENAME)
+
+  def _remove_journal(self, filename):
+    try:
+      os.unlink(self._journal_path(filename))
+    except OSError:
+      e = sys.exc_info()[1]
+      if e.errno != errno.ENOENT:
+        raise
+
+  def _load_journal(self, filename):
+    """Return a dictionary mapping video_id to the last journaled status."""
+    statuses = {}
+    try:
+      fp = open(self._journal_path(filename), 'r')
+    except IOError:
+      e = sys.exc_info()[1]
+      if e.errno == errno.ENOENT:
+        return statuses
+      else:
+        raise
+    for line in fp:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        # A record that was only partially written before a crash.
+        continue
+      statuses[record['video_id']] = record['status']
+    fp.close()
+    return statuses
+
+
+class SqliteMetadataStore(object):
+  def __init__(self, output_directory):
+    self.output_directory = output_directory
+    self.path = os.path.join(output_directory, 'data', SQLITE_FILENAME)
+    self.lock = threading.Lock()
+    self.connection = None
+
+  def _connect(self):
+    if self.connection is None:
+      directory = os.path.dirname(self.path)
+      if not os.path.isdir(directory):
+        os.makedirs(directory)
+      # Plugin workers share the connection, guarded by the lock.
+      connection = sqlite3.connect(self.path, check_same_thread=False)
+      with self._write_lock():
+        connection.executescript("""
+CREATE TABLE IF NOT EXISTS feeds (
+  feed_id INTEGER PRIMARY KEY,
+  directory TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS videos (
+  feed_id INTEGER NOT NULL,
+  seq INTEGER NOT NULL,
+  video_id TEXT,
+  timestamp INTEGER,
+  status TEXT,
+  entry TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS videos_feed_timestamp ON videos (feed_id, timestamp);
+CREATE INDEX IF NOT EXISTS videos_feed_seq ON videos (feed_id, seq);
+CREATE INDEX IF NOT EXISTS videos_video_id ON videos (video_id);
+CREATE INDEX IF NOT EXISTS videos_status ON videos (status);
+""")
+      self.connection = connection
+    return self.connection
+
+  def _write_lock(self):
+    return file_util.output_lock(self.output_directory, self.path)
+
+  def _feed_id(self, connection, filename, create=False):
+    directory = os.path.basename(os.path.dirname(filename))
+    row = connection.execute('SELECT feed_id FROM feeds WHERE directory = ?',
+                             (directory,)).fetchone()
+    if row:
+      return row[0]
+    if not create:
+      return None
+    cursor = connection.execute('INSERT INTO feeds (directory) VALUES (?)',
+                                (directory,))
+    return cursor.lastrowid
+
+  def get_metadata_feeds(self):
+    """Return list of paths that identify each feed."""
+    with self.lock:
+      rows = self._connect().execute('SELECT directory FROM feeds').fetchall()
+    feeds = [feed_path(self.output_directory, row[0]) for row in rows]
+    feeds.sort()
+    return feeds
+
+  def serialize_feed(self, filename, data):
+    """Replace all entries of the feed with the given metadata."""
+    with self.lock:
+      connection = self._connect()
+      with self._write_lock():
+        feed_id = self._feed_id(connection, filename, create=True)
+        connection.execute('DELETE FROM videos WHERE feed_id = ?', (feed_id,))
+        self._insert(connection, feed_id, data, 0)
+        connection.commit()
+
+  def iter_feed(self, filename):
+    """Yield the entries of the feed, newest first."""
+    for meta in self.deserialize_feed(filename):
+      yield meta
+
+  def deserialize_feed(self, filename):
+    """Return all entries of the feed, newest first."""
+    with self.lock:
+      connection = self._connect()
+      feed_id = self._feed_id(connection, filename)
+      if feed_id is None:
+        return []
+      rows = connection.execute(
+        'SELECT entry, status FROM videos WHERE feed_id = ? ORDER BY seq DESC',
+        (feed_id,)).fetchall()
+    data = []
+    for entry, status in rows:
+      meta = json.loads(entry)
+      if not status is None:
+        meta['status'] = status
+      data.append(meta)
+    return data
+
+  def feed_summary(self, filename):
+    """Return the newest timestamp in the feed, or None, and its length."""
+    with self.lock:
+      connection = self._connect()
+      feed_id = self._feed_id(connection, filename)
+      if feed_id is None:
+        return (None, 0)
+      row = connection.execute(
+        'SELECT timestamp FROM videos WHERE feed_id = ? ORDER BY seq DESC '
+        'LIMIT 1', (feed_id,)).fetchone()
+      count = connection.execute(
+        'SELECT COUNT(*) FROM videos WHERE feed_id = ?',
+        (feed_id,)).fetchone()[0]
+    if row is None:
+      return (None, 0)
+    return (row[0], count)
+
+  def feed_signature(self, filename):
+    """Return None, as feed_summary is cheap enough to call every time."""
+    return None
+
+  def add_to_feed(self, filename, entries, replace=False):
+    """Add entries, newest first, to the front of the feed.
+
+    If replace is set, existing entries and statuses are discarded.
+    """
+    with self.lock:
+      connection = self._connect()
+      with self._write_lock():
+        feed_id = self._feed_id(connection, filename, create=True)
+        if replace:
+          connection.execute('DELETE FROM videos WHERE feed_id = ?',
+                             (feed_id,))
+        row = connection.execute(
+          'SELECT MAX(seq) FROM videos WHERE feed_id = ?',
+          (feed_id,)).fetchone()
+        self._insert(connection, feed_id, entries, row[0] or 0)
+        connection.commit()
+
+  def append_status(self, filename, video_id, status):
+    """Record the status of a video in the given feed."""
+    with self.lock:
+      connection = self._connect()
+      with self._write_lock():
+        feed_id = self._feed_id(connection, filename)
+        connection.execute(
+          'UPDATE videos SET status = ? WHERE feed_id = ? AND video_id = ?',
+          (status, feed_id, video_id))
+        connection.commit()
+
+  def compact_feed(self, filename):
+    """Statuses are written in place, there is nothing to compact."""
+    pass
+
+  def _insert(self, connection, feed_id, entries, base_seq):
+    """Insert entries, given newest first, after base_seq."""
+    entries = list(entries)
+    rows = []
+    for i, meta in enumerate(entries):
+      entry = dict(meta)
+      status = entry.pop('status', None)
+      rows.append((feed_id, base_seq + len(entries) - i, entry.get('video_id'),
+                   entry.get('timestamp'), status, json.dumps(entry)))
+    connection.executemany(
+      'INSERT INTO videos (feed_id, seq, video_id, timestamp, status, entry) '
+      'VALUES (?, ?, ?, ?, ?, ?)', rows)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""Run a command for several accounts at once, each in its own process.
+
+The accounts are listed in a json config file:
+
+{
+  "processes": 4,
+  "rate": 50,
+  "quota": 100000,
+  "accounts": [
+    {"name": "music", "auth": "music/auth.json", "output": "music/output"},
+    {"name": "talks", "auth": "talks/auth.json", "output": "talks/output",
+     "jobs": 4, "backend": "sqlite"},
+    ...
+  ]
+}
+
+Each account runs in a fresh process, so a failure in one does not affect the
+others. All processes share a single budget of "rate" API requests per second
+and, if set, of "quota" requests for the whole run. Accounts may override the
+"jobs", "backend", "prometheus" and "api_url" options given on the command
+line. Once all accounts are done, a summary of the results is printed.
+"""
+
+import copy
+import multiprocessing
+import sys
+import time
+import traceback
+
+import json
+
+import rate_limiter
+
+
+COMMANDS = ['update', 'sync', 'execute', 'compact', 'export', 'migrate']
+ACCOUNT_OPTIONS = ['jobs', 'backend', 'prometheus', 'api_url']
+
+# The rate budget shared by all processes, set by _init_process.
+shared_bucket = None
+
+
+def load_config(path):
+  fp = open(path, 'r')
+  content = fp.read()
+  fp.close()
+  config = json.loads(content)
+  for account in config.get('accounts', []):
+    if not 'output' in account:
+      raise RuntimeError('Account without an output directory in %s' % path)
+  return config
+
+
+def run_accounts(cmdline):
+  """Run cmdline's command for every account in the config file.
+
+  Return a list of the results of each account, as dictionaries.
+  """
+  if not cmdline.command in COMMANDS:
+    raise RuntimeError('Command %s cannot run for several accounts' %
+                       cmdline.command)
+  config = load_config(cmdline.accounts)
+  bucket = rate_limiter.SharedTokenBucket(config.get('rate', cmdline.rate),
+                                          config.get('quota'))
+  tasks = []
+  for account in config['accounts']:
+    account_cmdline = copy.copy(cmdline)
+    account_cmdline.accounts = None
+    account_cmdline.output = account['output']
+    account_cmdline.auth = account.get('auth', cmdline.auth)
+    for option in ACCOUNT_OPTIONS:
+      if option in account:
+        setattr(account_cmdline, option, account[option])
+    tasks.append((account.get('name', account['output']), account_cmdline))
+  processes = config.get('processes', multiprocessing.cpu_count())
+  # A new process for every account, so that none of them share any state.
+  pool = multiprocessing.Pool(processes, initializer=_init_process,
+                              initargs=(bucket,), maxtasksperchild=1)
+  try:
+    results = list(pool.imap_unordered(_run_account, tasks))
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+  results.sort(key=lambda result: result['name'])
+  print_summary(results)
+  return results
+
+
+def print_summary(results):
+  line = '%-24s %10s %10s %10s %9s  %s'
+  print(line % ('Account', 'New videos', 'API calls', 'Quota', 'Time',
+                'Result'))
+  total = {'new_videos': 0, 'api_calls': 0, 'quota_units': 0, 'duration': 0}
+  for result in results:
+    print(line % (result['name'], result['new_videos'], result['api_calls'],
+                  result['quota_units'], '%.1fs' % result['duration'],
+                  result['error'] or 'ok'))
+    for key in total:
+      total[key] += result[key]
+  failed = len([result for result in results if result['error']])
+  print(line % ('Total', total['new_videos'], total['api_calls'],
+                total['quota_units'], '%.1fs' % total['duration'],
+                '%d failed' % failed if failed else 'ok'))
+
+
+def _init_process(bucket):
+  global shared_bucket
+  shared_bucket = bucket
+
+
+def _run_account(task):
+  (name, cmdline) = task
+  # Imported here, as youtube_metadata_sync imports this module.
+  import youtube_metadata_sync
+  start = time.time()
+  result = {'name': name, 'output': cmdline.output, 'new_videos': 0,
+            'api_calls': 0, 'quota_units': 0, 'error': None}
+  try:
+    metrics = youtube_metadata_sync.run_command(cmdline, shared_bucket)
+    data = metrics.to_json()
+    result['new_videos'] = data['new_videos']
+    result['quota_units'] = data['quota_units']
+    result['api_calls'] = sum(stats['calls'] for stats in data['api'].values())
+  except Exception as e:
+    traceback.print_exc()
+    result['error'] = str(e) or e.__class__.__name__
+  result['duration'] = time.time() - start
+  sys.stdout.flush()
+  return result
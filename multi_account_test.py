@@ -0,0 +1,122 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import json
+
+import fake_youtube_server
+import multi_account
+import rate_limiter
+import youtube_metadata_sync
+
+
+def _take_tokens(bucket, count, results):
+  taken = 0
+  try:
+    for unused in range(count):
+      bucket.take(1)
+      taken += 1
+  except rate_limiter.QuotaExhausted:
+    pass
+  results.put(taken)
+
+
+class MultiAccountTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.servers = []
+    for num_playlists in [1, 2]:
+      server = fake_youtube_server.FakeYoutubeServer(
+        fake_youtube_server.FakeAccount(num_playlists, 5))
+      server.start()
+      self.servers.append(server)
+
+  def tearDown(self):
+    for server in self.servers:
+      server.stop()
+    shutil.rmtree(self.temp_directory)
+
+  def run_accounts(self, config, command='sync'):
+    path = os.path.join(self.temp_directory, 'accounts.json')
+    fp = open(path, 'w')
+    fp.write(json.dumps(config))
+    fp.close()
+    cmdline = youtube_metadata_sync.get_command_line(
+      ['--accounts', path, command])
+    return multi_account.run_accounts(cmdline)
+
+  def account(self, name, server=None):
+    account = {'name': name,
+               'output': os.path.join(self.temp_directory, name),
+               'auth': os.path.join(self.temp_directory, name + '.json')}
+    if server:
+      account['api_url'] = server.url
+    return account
+
+  def read_feeds(self, name):
+    feeds = []
+    for directory in os.listdir(os.path.join(self.temp_directory, name,
+                                             'data')):
+      path = os.path.join(self.temp_directory, name, 'data', directory,
+                          'feed.json')
+      if os.path.exists(path):
+        feeds.append(directory)
+    return sorted(feeds)
+
+  def test_accounts(self):
+    results = self.run_accounts({'processes': 2, 'accounts': [
+      self.account('first', self.servers[0]),
+      self.account('second', self.servers[1])]})
+    self.assertEqual([r['name'] for r in results], ['first', 'second'])
+    self.assertEqual([r['error'] for r in results], [None, None])
+    self.assertEqual([r['new_videos'] for r in results], [10, 15])
+    for result in results:
+      self.assertTrue(result['api_calls'] > 0)
+      self.assertEqual(result['quota_units'], result['api_calls'])
+    self.assertEqual(len(self.read_feeds('first')), 2)
+    self.assertEqual(len(self.read_feeds('second')), 3)
+
+  def test_failure_does_not_stop_others(self):
+    # With a single process, accounts still run one after the other.
+    results = self.run_accounts({'processes': 1, 'accounts': [
+      self.account('broken'),
+      self.account('working', self.servers[1])]})
+    self.assertEqual(results[0]['name'], 'broken')
+    self.assertEqual(results[0]['error'], 'Not authenticated!')
+    self.assertEqual(results[1]['name'], 'working')
+    self.assertEqual(results[1]['error'], None)
+    self.assertEqual(results[1]['new_videos'], 15)
+
+  def test_shared_quota(self):
+    results = self.run_accounts({'processes': 2, 'quota': 3, 'accounts': [
+      self.account('first', self.servers[0]),
+      self.account('second', self.servers[1])]})
+    for result in results:
+      self.assertTrue('Quota of 3 calls used up' in result['error'])
+    # The discovery document is not fetched through the rate limiter.
+    calls = sum(count for server in self.servers
+                for (endpoint, count) in server.requests.items()
+                if endpoint != 'rest')
+    self.assertEqual(calls, 3)
+
+
+class SharedTokenBucketTest(unittest.TestCase):
+  def test_quota_across_processes(self):
+    bucket = rate_limiter.SharedTokenBucket(rate=1000, quota=10)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_take_tokens,
+                                         args=(bucket, 8, results))
+                 for unused in range(3)]
+    for process in processes:
+      process.start()
+    taken = [results.get() for unused in processes]
+    for process in processes:
+      process.join()
+    self.assertEqual(sum(taken), 10)
+    self.assertRaises(rate_limiter.QuotaExhausted, bucket.take, 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""Index of metadata entries waiting for plugins to run.
+
+Kept in output_directory/data/pending.json, it maps each feed, relative to the
+output directory, to the video_ids in it that have no status yet:
+
+{
+  "data/favorites/feed.json": ["XXXXXXXXXXX", ...],
+  ...
+}
+
+Videos are added when a sync adds them to a feed, and removed when a status is
+recorded, so that execute only reads the feeds that have work. When several
+processes share the index, each saves only its own changes, applied to the
+file as it is on disk at that time.
+"""
+
+import errno
+import os
+import sys
+
+import json
+
+import file_util
+
+
+class PendingIndex(object):
+  def __init__(self, output_directory):
+    self.output_directory = output_directory
+    self.path = os.path.join(output_directory, 'data', 'pending.json')
+    self.feeds = {}
+    # Changes since the index was last saved: video_ids added and removed, by
+    # feed, feeds replaced, and whether the whole index was replaced.
+    self.added = {}
+    self.removed = {}
+    self.replaced = set()
+    self.cleared = False
+    self.dirty = False
+
+  def load(self):
+    """Load the index from disk. Return False if it does not exist."""
+    try:
+      fp = open(self.path, 'r')
+    except IOError:
+      e = sys.exc_info()[1]
+      if e.errno == errno.ENOENT:
+        return False
+      else:
+        raise
+    content = fp.read()
+    fp.close()
+    self.feeds = dict((k, set(v)) for k, v in json.loads(content).items())
+    return True
+
+  def save(self):
+    """Save the index to disk, if it has been modified."""
+    if not self.dirty:
+      return
+    with file_util.output_lock(self.output_directory, self.path):
+      if not self.cleared:
+        self.load()
+        for key in self.replaced:
+          self.feeds[key] = set()
+        for key, video_ids in self.added.items():
+          self.feeds.setdefault(key, set()).update(video_ids)
+        for key, video_ids in self.removed.items():
+          self.feeds.get(key, set()).difference_update(video_ids)
+      data = dict((k, sorted(v)) for k, v in self.feeds.items() if v)
+      file_util.write_atomic(self.path, [
+        json.dumps(data, indent=2, separators=(',', ': '), sort_keys=True)])
+    self.added = {}
+    self.removed = {}
+    self.replaced = set()
+    self.cleared = False
+    self.dirty = False
+
+  def get_feeds(self):
+    """Return the filenames of feeds with pending videos."""
+    return [os.path.join(self.output_directory, k)
+            for k, v in sorted(self.feeds.items()) if v]
+
+  def get(self, filename):
+    """Return the set of pending video_ids in the given feed."""
+    return self.feeds.get(self._key(filename), set())
+
+  def clear(self):
+    """Forget all pending videos, such as before rebuilding the index."""
+    self.feeds = {}
+    self.added = {}
+    self.removed = {}
+    self.replaced = set()
+    self.cleared = True
+    self.dirty = True
+
+  def add(self, filename, video_ids, replace=False):
+    key = self._key(filename)
+    if replace or not key in self.feeds:
+      self.feeds[key] = set()
+    if replace:
+      self.replaced.add(key)
+      self.added[key] = set()
+      self.removed.pop(key, None)
+    self.feeds[key].update(video_ids)
+    self.added.setdefault(key, set()).update(video_ids)
+    self.removed.get(key, set()).difference_update(video_ids)
+    self.dirty = True
+
+  def remove(self, filename, video_id):
+    key = self._key(filename)
+    pending = self.feeds.get(key)
+    if pending and video_id in pending:
+      pending.discard(video_id)
+      self.added.get(key, set()).discard(video_id)
+      self.removed.setdefault(key, set()).add(video_id)
+      self.dirty = True
+
+  def _key(self, filename):
+    return os.path.relpath(filename, self.output_directory)
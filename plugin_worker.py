@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""Long-lived plugin process, fed work items as json lines.
+
+A plugin declared with "mode": "worker" in plugin_config.cfg is started once,
+and reads one json object per line on stdin:
+
+  {"url": ..., "video_id": ..., "safename": ..., "directory": ...}
+
+For each item it writes one json object per line on stdout:
+
+  {"status": "success" or "failure", "output": path or null}
+
+Output files should be created in the given directory, which is empty. The
+output path may be relative to it, and an output outside of it is rejected.
+Anything else the plugin needs to print should go to stderr. A worker that does
+not read an item or reply to it within the timeout, set by "timeout" in
+plugin_config.cfg, is killed, and the item counts as failed.
+"""
+
+import errno
+import os
+import select
+import signal
+import subprocess
+import sys
+import time
+
+import json
+
+
+ITEM_TIMEOUT = 3600
+READ_SIZE = 64 * 1024
+# Writes of up to this size never block once select reports a pipe writable.
+PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+
+
+class ItemTimeout(RuntimeError):
+  pass
+
+
+class PluginWorker(object):
+  def __init__(self, command, timeout=ITEM_TIMEOUT):
+    self.command = command
+    self.timeout = timeout
+    self.process = None
+    # Read from the worker but not returned yet.
+    self.buffer = b''
+
+  def start(self):
+    # In a process group of its own, so that killing it also kills the
+    # plugin the shell started.
+    self.process = subprocess.Popen(self.command, shell=True,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    universal_newlines=True,
+                                    preexec_fn=getattr(os, 'setsid', None))
+    self.buffer = b''
+
+  def process_item(self, item):
+    """Send a work item and return the reply, restarting the worker if needed.
+
+    If the worker exits or replies with something that is not json, it is
+    restarted and the item is sent once more. Return None if that fails too,
+    or if the worker does not reply in time, in which case it is killed and
+    restarted with the next item.
+    """
+    for attempt in range(2):
+      if self.process is None or self.process.poll() is not None:
+        self.start()
+      try:
+        reply = self._send(item)
+      except ItemTimeout:
+        # Not sent again, as it would likely time out again.
+        self.stop(kill=True)
+        return None
+      if reply is not None:
+        return reply
+      self.stop(kill=True)
+    return None
+
+  def _send(self, item):
+    deadline = time.time() + self.timeout
+    try:
+      self._write(json.dumps(item).encode('utf-8') + b'\n', deadline)
+      line = self._read_line(deadline)
+    except (IOError, OSError):
+      return None
+    try:
+      reply = json.loads(line)
+    except ValueError:
+      return None
+    if not isinstance(reply, dict):
+      return None
+    return reply
+
+  def _write(self, data, deadline):
+    """Write data to the worker's stdin.
+
+    Writes the pipe directly, no more than it can take at once, so that a
+    worker that stops reading cannot block us. Raise ItemTimeout if the data
+    cannot be written before deadline.
+    """
+    fd = self.process.stdin.fileno()
+    while data:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        raise ItemTimeout('%s is not reading' % self.command)
+      (unused_readable, writable, unused_errors) = select.select(
+        [], [fd], [], remaining)
+      if not writable:
+        continue
+      written = os.write(fd, data[:PIPE_BUF])
+      data = data[written:]
+
+  def _read_line(self, deadline):
+    """Return the next line from the worker, or '' if it exited.
+
+    Reads the pipe directly rather than through stdout, whose buffer select
+    cannot see. Raise ItemTimeout if no line arrives before deadline.
+    """
+    fd = self.process.stdout.fileno()
+    while not b'\n' in self.buffer:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        raise ItemTimeout('No reply from %s' % self.command)
+      (readable, unused_writable, unused_errors) = select.select(
+        [fd], [], [], remaining)
+      if not readable:
+        continue
+      chunk = os.read(fd, READ_SIZE)
+      if not chunk:
+        return ''
+      self.buffer += chunk
+    (line, self.buffer) = self.buffer.split(b'\n', 1)
+    return line.decode('utf-8')
+
+  def stop(self, kill=False):
+    """Close the worker's stdin and wait for it to exit, or kill it."""
+    if self.process is None:
+      return
+    try:
+      self.process.stdin.close()
+    except (IOError, OSError):
+      pass
+    if kill and self.process.poll() is None:
+      if hasattr(os, 'killpg'):
+        try:
+          os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+          e = sys.exc_info()[1]
+          if e.errno != errno.ESRCH:
+            raise
+      else:
+        self.process.kill()
+    self.process.wait()
+    self.process.stdout.close()
+    self.process = None
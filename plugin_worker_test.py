@@ -0,0 +1,146 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+import plugin_worker
+
+
+# Writes the item's safename to a file in its directory. Crashes on items
+# with a video_id of "crash", until the crashes file exists, replies with
+# something that is not json to items with a video_id of "garbage", never
+# replies to "hang", replies in two writes to "split", and stops reading after
+# replying to "deaf".
+WORKER = """
+import json
+import os
+import sys
+import time
+
+while True:
+  line = sys.stdin.readline()
+  if not line:
+    break
+  item = json.loads(line)
+  if item['video_id'] == 'crash' and not os.path.exists(%(crashes)r):
+    open(%(crashes)r, 'w').close()
+    sys.exit(1)
+  if item['video_id'] == 'garbage':
+    sys.stdout.write('garbage\\n')
+    sys.stdout.flush()
+    continue
+  if item['video_id'] == 'hang':
+    time.sleep(60)
+  fp = open(os.path.join(item['directory'], 'output.txt'), 'w')
+  fp.write(item['safename'])
+  fp.close()
+  reply = json.dumps({'status': 'success', 'output': 'output.txt'}) + '\\n'
+  if item['video_id'] == 'split':
+    sys.stdout.write(reply[:5])
+    sys.stdout.flush()
+    time.sleep(0.1)
+    reply = reply[5:]
+  sys.stdout.write(reply)
+  sys.stdout.flush()
+  if item['video_id'] == 'deaf':
+    time.sleep(60)
+"""
+
+
+class PluginWorkerTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.crashes_path = os.path.join(self.temp_directory, 'crashes')
+    script = os.path.join(self.temp_directory, 'worker.py')
+    fp = open(script, 'w')
+    fp.write(WORKER % {'crashes': self.crashes_path})
+    fp.close()
+    self.worker = plugin_worker.PluginWorker(
+      '"%s" "%s"' % (sys.executable, script), timeout=2)
+
+  def tearDown(self):
+    self.worker.stop(kill=True)
+    shutil.rmtree(self.temp_directory)
+
+  def item(self, video_id):
+    directory = tempfile.mkdtemp(dir=self.temp_directory)
+    return {'url': 'http://youtube.com/watch?v=' + video_id,
+            'video_id': video_id, 'safename': video_id + '-name',
+            'directory': directory}
+
+  def read_output(self, item):
+    fp = open(os.path.join(item['directory'], 'output.txt'), 'r')
+    content = fp.read()
+    fp.close()
+    return content
+
+  def test_process_items(self):
+    first = self.item('v1')
+    self.assertEqual(self.worker.process_item(first),
+                     {'status': 'success', 'output': 'output.txt'})
+    pid = self.worker.process.pid
+    second = self.item('v2')
+    self.worker.process_item(second)
+    # The same process handles every item.
+    self.assertEqual(self.worker.process.pid, pid)
+    self.assertEqual(self.read_output(first), 'v1-name')
+    self.assertEqual(self.read_output(second), 'v2-name')
+
+  def test_restart_after_crash(self):
+    self.worker.process_item(self.item('v1'))
+    pid = self.worker.process.pid
+    self.assertEqual(self.worker.process_item(self.item('crash')),
+                     {'status': 'success', 'output': 'output.txt'})
+    self.assertTrue(os.path.exists(self.crashes_path))
+    self.assertNotEqual(self.worker.process.pid, pid)
+    self.assertEqual(self.worker.process_item(self.item('v2'))['status'],
+                     'success')
+
+  def test_invalid_reply(self):
+    self.assertEqual(self.worker.process_item(self.item('garbage')), None)
+    # The worker is restarted for the next item.
+    self.assertEqual(self.worker.process_item(self.item('v1'))['status'],
+                     'success')
+
+  def test_timeout(self):
+    self.worker.process_item(self.item('v1'))
+    process = self.worker.process
+    start = time.time()
+    self.assertEqual(self.worker.process_item(self.item('hang')), None)
+    self.assertTrue(time.time() - start < 10)
+    # The worker was killed, and a new one handles the next item.
+    self.assertEqual(self.worker.process, None)
+    self.assertNotEqual(process.returncode, 0)
+    self.assertEqual(self.worker.process_item(self.item('v2'))['status'],
+                     'success')
+
+  def test_write_timeout(self):
+    self.worker.process_item(self.item('deaf'))
+    process = self.worker.process
+    # More than the pipe can take, so the write blocks.
+    item = self.item('v1')
+    item['url'] += 'x' * (1024 * 1024)
+    start = time.time()
+    self.assertEqual(self.worker.process_item(item), None)
+    self.assertTrue(time.time() - start < 10)
+    self.assertEqual(self.worker.process, None)
+    self.assertNotEqual(process.returncode, 0)
+    self.assertEqual(self.worker.process_item(self.item('v2'))['status'],
+                     'success')
+
+  def test_split_reply(self):
+    self.assertEqual(self.worker.process_item(self.item('split')),
+                     {'status': 'success', 'output': 'output.txt'})
+
+  def test_stop(self):
+    self.worker.process_item(self.item('v1'))
+    process = self.worker.process
+    self.worker.stop()
+    self.assertEqual(self.worker.process, None)
+    self.assertEqual(process.returncode, 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
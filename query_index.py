@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""Index of metadata entries for fast queries, whatever the metadata backend.
+
+Kept in output_directory/data/query.sqlite, it has a row for each entry of
+each feed, with indexes on timestamp, length and status, and an inverted index
+from each word of the title and description to the entries that contain it.
+Words are lowercased, and only match whole.
+
+The index is updated as a sync adds entries and as statuses are recorded. If
+the feeds are modified in any other way, it can be rebuilt from them.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+
+import file_util
+
+
+QUERY_INDEX_FILENAME = 'query.sqlite'
+# Matches entries with no status, for the status condition.
+NO_STATUS = ''
+CACHE_SIZE_KB = 64 * 1024
+WORDS_INDEXES = """
+CREATE INDEX IF NOT EXISTS words_word ON words (word, entry_id);
+CREATE INDEX IF NOT EXISTS words_entry_id ON words (entry_id);
+"""
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+  """Return the set of lowercased words in text."""
+  return set(word.lower() for word in WORD.findall(text or ''))
+
+
+class QueryIndex(object):
+  def __init__(self, output_directory):
+    self.output_directory = output_directory
+    self.path = os.path.join(output_directory, 'data', QUERY_INDEX_FILENAME)
+    self.lock = threading.Lock()
+    self.connection = None
+
+  def exists(self):
+    return os.path.exists(self.path)
+
+  def _connect(self):
+    if self.connection is None:
+      file_util.mkdir_p(os.path.dirname(self.path))
+      # Plugin workers share the connection, guarded by the lock.
+      self.connection = sqlite3.connect(self.path, timeout=60,
+                                        check_same_thread=False)
+      # Words are inserted in no particular order, keep most of the index in
+      # memory while doing so.
+      self.connection.execute('PRAGMA cache_size = -%d' % CACHE_SIZE_KB)
+      self.connection.executescript("""
+CREATE TABLE IF NOT EXISTS entries (
+  entry_id INTEGER PRIMARY KEY,
+  feed TEXT NOT NULL,
+  video_id TEXT NOT NULL,
+  title TEXT,
+  url TEXT,
+  timestamp INTEGER,
+  length INTEGER,
+  status TEXT,
+  UNIQUE (feed, video_id));
+CREATE TABLE IF NOT EXISTS words (
+  word TEXT NOT NULL,
+  entry_id INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS entries_timestamp ON entries (timestamp);
+CREATE INDEX IF NOT EXISTS entries_length ON entries (length);
+CREATE INDEX IF NOT EXISTS entries_status ON entries (status, timestamp);
+""" + WORDS_INDEXES)
+    return self.connection
+
+  def add(self, filename, entries, replace=False):
+    """Index entries of the given feed.
+
+    If replace is set, entries previously indexed for the feed are removed.
+    """
+    feed = self._key(filename)
+    with self.lock:
+      connection = self._connect()
+      if replace:
+        self._remove_feed(connection, feed)
+      for meta in entries:
+        self._insert(connection, feed, meta)
+      connection.commit()
+
+  def set_status(self, filename, video_id, status):
+    with self.lock:
+      connection = self._connect()
+      connection.execute(
+        'UPDATE entries SET status = ? WHERE feed = ? AND video_id = ?',
+        (status, self._key(filename), video_id))
+      connection.commit()
+
+  def rebuild(self, feeds):
+    """Replace the whole index with (filename, entries) for every feed."""
+    with self.lock:
+      connection = self._connect()
+      # In a single transaction, so that the index is left as it was if
+      # reading the feeds fails. Set explicitly, as some versions of sqlite3
+      # commit before DROP INDEX otherwise.
+      isolation_level = connection.isolation_level
+      connection.isolation_level = None
+      try:
+        connection.execute('BEGIN')
+        connection.execute('DELETE FROM words')
+        connection.execute('DELETE FROM entries')
+        # Indexing the words once they are all inserted, in sorted order, is
+        # much faster than inserting them in a random order into the indexes.
+        connection.execute('DROP INDEX words_word')
+        connection.execute('DROP INDEX words_entry_id')
+        for (filename, entries) in feeds:
+          feed = self._key(filename)
+          for meta in entries:
+            self._insert(connection, feed, meta)
+        for statement in WORDS_INDEXES.strip().split(';')[:-1]:
+          connection.execute(statement)
+        connection.execute('COMMIT')
+      except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+      finally:
+        connection.isolation_level = isolation_level
+
+  def query(self, text=None, min_length=None, max_length=None, status=None,
+            since=None, until=None, limit=None):
+    """Return entries matching all of the given conditions, newest first.
+
+    text matches entries with all of its words in their title or description.
+    Lengths are in seconds, since and until are timestamps, both inclusive.
+    status may be NO_STATUS to match entries with no status. Each entry is a
+    dictionary with its feed, relative to the output directory, video_id,
+    title, url, timestamp, length and status.
+    """
+    conditions = []
+    parameters = []
+    words = sorted(tokenize(text))
+    if text and not words:
+      return []
+    for word in words:
+      conditions.append(
+        'entry_id IN (SELECT entry_id FROM words WHERE word = ?)')
+      parameters.append(word)
+    for (condition, value) in [('length >= ?', min_length),
+                               ('length <= ?', max_length),
+                               ('timestamp >= ?', since),
+                               ('timestamp <= ?', until)]:
+      if not value is None:
+        conditions.append(condition)
+        parameters.append(value)
+    if status == NO_STATUS:
+      conditions.append('status IS NULL')
+    elif not status is None:
+      conditions.append('status = ?')
+      parameters.append(status)
+    sql = ('SELECT feed, video_id, title, url, timestamp, length, status '
+           'FROM entries')
+    if conditions:
+      sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY timestamp DESC, entry_id DESC'
+    if not limit is None:
+      sql += ' LIMIT ?'
+      parameters.append(limit)
+    with self.lock:
+      rows = self._connect().execute(sql, parameters).fetchall()
+    keys = ['feed', 'video_id', 'title', 'url', 'timestamp', 'length',
+            'status']
+    return [dict(zip(keys, row)) for row in rows]
+
+  def _insert(self, connection, feed, meta):
+    row = connection.execute(
+      'SELECT entry_id FROM entries WHERE feed = ? AND video_id = ?',
+      (feed, meta['video_id'])).fetchone()
+    if row:
+      connection.execute('DELETE FROM words WHERE entry_id = ?', (row[0],))
+      connection.execute('DELETE FROM entries WHERE entry_id = ?', (row[0],))
+    cursor = connection.execute(
+      'INSERT INTO entries (feed, video_id, title, url, timestamp, length, '
+      'status) VALUES (?, ?, ?, ?, ?, ?, ?)',
+      (feed, meta['video_id'], meta.get('title'), meta.get('url'),
+       meta.get('timestamp'), meta.get('length'), meta.get('status')))
+    words = tokenize(meta.get('title')) | tokenize(meta.get('description'))
+    connection.executemany(
+      'INSERT INTO words (word, entry_id) VALUES (?, ?)',
+      [(word, cursor.lastrowid) for word in words])
+
+  def _remove_feed(self, connection, feed):
+    connection.execute(
+      'DELETE FROM words WHERE entry_id IN '
+      '(SELECT entry_id FROM entries WHERE feed = ?)', (feed,))
+    connection.execute('DELETE FROM entries WHERE feed = ?', (feed,))
+
+  def _key(self, filename):
+    return os.path.relpath(filename, self.output_directory)
@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import query_index
+
+
+def entry(video_id, title, timestamp):
+  return {'video_id': video_id, 'title': title, 'description': '',
+          'url': 'http://youtube.com/watch?v=' + video_id,
+          'timestamp': timestamp, 'length': 60}
+
+
+class QueryIndexTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.feed = os.path.join(self.temp_directory, 'data', 'apple',
+                             'feed.json')
+    self.index = query_index.QueryIndex(self.temp_directory)
+    self.index.add(self.feed, [entry('v1', 'Apple pie', 100),
+                               entry('v2', 'Apple tart', 200)])
+
+  def tearDown(self):
+    if self.index.connection:
+      self.index.connection.close()
+    shutil.rmtree(self.temp_directory)
+
+  def video_ids(self, **kwargs):
+    return [e['video_id'] for e in self.index.query(**kwargs)]
+
+  def index_names(self):
+    return sorted(row[0] for row in self.index.connection.execute(
+      "SELECT name FROM sqlite_master WHERE type = 'index' AND "
+      "tbl_name = 'words'"))
+
+  def test_rebuild(self):
+    self.index.rebuild([(self.feed, [entry('v3', 'Banana split', 300)])])
+    self.assertEqual(self.video_ids(), ['v3'])
+    self.assertEqual(self.video_ids(text='banana'), ['v3'])
+    self.assertEqual(self.index_names(), ['words_entry_id', 'words_word'])
+
+  def test_rebuild_failure_keeps_index(self):
+    def feeds():
+      yield (self.feed, [entry('v3', 'Banana split', 300)])
+      raise IOError('feed unreadable')
+    self.assertRaises(IOError, self.index.rebuild, feeds())
+    self.assertEqual(self.video_ids(), ['v2', 'v1'])
+    self.assertEqual(self.video_ids(text='apple'), ['v2', 'v1'])
+    self.assertEqual(self.index_names(), ['words_entry_id', 'words_word'])
+    # Other processes see the index as it was too.
+    other = query_index.QueryIndex(self.temp_directory)
+    self.assertEqual([e['video_id'] for e in other.query()], ['v2', 'v1'])
+    other.connection.close()
+    # And it can still be updated.
+    self.index.add(self.feed, [entry('v3', 'Banana split', 300)])
+    self.assertEqual(self.video_ids(text='split'), ['v3'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""Client-side rate limiting and retries for Youtube API calls.
+
+A single RateLimiter is shared by every thread making API calls. It combines a
+token bucket, which bounds the request rate, with a concurrency limit that
+adapts to the errors seen: throttling errors halve the number of calls allowed
+in flight, while successful calls slowly raise it again. Throttled and server
+errors are retried with exponential backoff and jitter.
+
+Processes syncing several accounts can share a SharedTokenBucket, so that
+together they stay within one rate, and optionally one quota of calls.
+"""
+
+import errno
+import random
+import socket
+import threading
+import time
+
+
+DEFAULT_RATE = 50.0
+DEFAULT_CONCURRENCY = 8
+MAX_RETRIES = 6
+BASE_DELAY = 1.0
+MAX_DELAY = 64.0
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+RETRY_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded',
+                 'backendError']
+# Connection errors worth retrying. Other OSErrors, such as from local files,
+# are not.
+RETRY_ERRNOS = [errno.ECONNRESET, errno.ECONNREFUSED, errno.ETIMEDOUT,
+                errno.EPIPE]
+
+
+def is_retryable(error):
+  """Return whether an error from an API call is worth retrying.
+
+  HttpErrors are recognized by their resp and content attributes, so that
+  this module does not depend on the API client.
+  """
+  if isinstance(error, socket.timeout):
+    return True
+  if isinstance(error, socket.error):
+    return getattr(error, 'errno', None) in RETRY_ERRNOS
+  resp = getattr(error, 'resp', None)
+  if resp is None:
+    return False
+  status = int(getattr(resp, 'status', 0))
+  if status in RETRY_STATUSES:
+    return True
+  if status == 403:
+    content = getattr(error, 'content', b'')
+    if isinstance(content, bytes):
+      content = content.decode('utf-8', 'replace')
+    for reason in RETRY_REASONS:
+      if reason in content:
+        return True
+  return False
+
+
+class QuotaExhausted(RuntimeError):
+  pass
+
+
+class TokenBucket(object):
+  """Tokens for rate calls per second, for the threads of one process."""
+  def __init__(self, rate=DEFAULT_RATE):
+    self.rate = float(rate)
+    self.capacity = max(1.0, self.rate)
+    self.tokens = self.capacity
+    self.last_refill = time.time()
+    self.lock = threading.Lock()
+
+  def take(self, cost):
+    """Take cost tokens. Return 0, or how long to wait before trying again.
+
+    Tokens may go negative for a batch that costs more than the bucket holds,
+    later callers wait for it to refill.
+    """
+    with self.lock:
+      return self._take(cost)
+
+  def _take(self, cost):
+    now = time.time()
+    self.tokens = min(self.capacity,
+                      self.tokens + (now - self.last_refill) * self.rate)
+    self.last_refill = now
+    needed = min(cost, self.capacity)
+    if self.tokens >= needed:
+      self.tokens -= cost
+      return 0
+    return (needed - self.tokens) / self.rate
+
+
+class SharedTokenBucket(TokenBucket):
+  """Tokens shared by several processes, with an optional overall quota.
+
+  Create it before starting the processes, and pass it to each of them, such
+  as through a multiprocessing.Pool initializer.
+  """
+  def __init__(self, rate=DEFAULT_RATE, quota=None):
+    import multiprocessing
+    self.rate = float(rate)
+    self.capacity = max(1.0, self.rate)
+    self.shared_tokens = multiprocessing.Value('d', self.capacity, lock=False)
+    self.shared_refill = multiprocessing.Value('d', time.time(), lock=False)
+    self.used = multiprocessing.Value('l', 0, lock=False)
+    self.quota = quota
+    self.lock = multiprocessing.Lock()
+
+  def take(self, cost):
+    """Like TokenBucket.take, raising QuotaExhausted past the quota."""
+    with self.lock:
+      if not self.quota is None and self.used.value + cost > self.quota:
+        raise QuotaExhausted('Quota of %d calls used up' % self.quota)
+      self.tokens = self.shared_tokens.value
+      self.last_refill = self.shared_refill.value
+      wait = self._take(cost)
+      self.shared_tokens.value = self.tokens
+      self.shared_refill.value = self.last_refill
+      if not wait:
+        self.used.value += cost
+      return wait
+
+
+class RateLimiter(object):
+  def __init__(self, rate=DEFAULT_RATE, max_concurrency=DEFAULT_CONCURRENCY,
+               max_retries=MAX_RETRIES, base_delay=BASE_DELAY,
+               max_delay=MAX_DELAY, bucket=None):
+    if bucket is None:
+      bucket = TokenBucket(rate)
+    self.bucket = bucket
+    self.max_concurrency = max_concurrency
+    self.concurrency = float(max_concurrency)
+    self.in_flight = 0
+    self.max_retries = max_retries
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.condition = threading.Condition()
+    self.sleep = time.sleep
+
+  def call(self, function, cost=1):
+    """Call function, retrying with backoff if it raises a retryable error.
+
+    cost is the number of tokens the call uses, such as the number of requests
+    in a batch.
+    """
+    attempt = 0
+    while True:
+      self._acquire(cost)
+      try:
+        result = function()
+      except Exception as e:
+        retry = is_retryable(e) and attempt < self.max_retries
+        self._release(throttled=is_retryable(e))
+        if not retry:
+          raise
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        self.sleep(delay + random.uniform(0, delay))
+        attempt += 1
+        continue
+      self._release(throttled=False)
+      return result
+
+  def _acquire(self, cost):
+    with self.condition:
+      while self.in_flight >= int(self.concurrency):
+        self.condition.wait()
+      self.in_flight += 1
+    try:
+      while True:
+        wait = self.bucket.take(cost)
+        if not wait:
+          return
+        self.sleep(wait)
+    except BaseException:
+      with self.condition:
+        self.in_flight -= 1
+        self.condition.notify_all()
+      raise
+
+  def _release(self, throttled):
+    with self.condition:
+      self.in_flight -= 1
+      if throttled:
+        # Multiplicative decrease.
+        self.concurrency = max(1.0, self.concurrency / 2)
+      else:
+        # Additive increase, by about one per window of calls.
+        self.concurrency = min(float(self.max_concurrency),
+                               self.concurrency + 1.0 / self.concurrency)
+      self.condition.notify_all()
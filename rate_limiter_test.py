@@ -0,0 +1,90 @@
+import errno
+import socket
+import unittest
+
+import rate_limiter
+
+
+class FakeResponse(object):
+  def __init__(self, status):
+    self.status = status
+
+
+class FakeHttpError(Exception):
+  def __init__(self, status, content=b''):
+    Exception.__init__(self, status)
+    self.resp = FakeResponse(status)
+    self.content = content
+
+
+class RateLimiterTest(unittest.TestCase):
+  def setUp(self):
+    self.limiter = rate_limiter.RateLimiter(rate=1000, max_concurrency=4)
+    self.delays = []
+    self.limiter.sleep = self.delays.append
+
+  def test_retryable(self):
+    self.assertTrue(rate_limiter.is_retryable(FakeHttpError(503)))
+    self.assertTrue(rate_limiter.is_retryable(FakeHttpError(429)))
+    self.assertTrue(rate_limiter.is_retryable(
+      FakeHttpError(403, b'{"reason": "rateLimitExceeded"}')))
+    self.assertFalse(rate_limiter.is_retryable(
+      FakeHttpError(403, b'{"reason": "quotaExceeded"}')))
+    self.assertFalse(rate_limiter.is_retryable(FakeHttpError(404)))
+    self.assertFalse(rate_limiter.is_retryable(ValueError()))
+
+  def test_retryable_socket_errors(self):
+    self.assertTrue(rate_limiter.is_retryable(socket.timeout()))
+    for code in [errno.ECONNRESET, errno.ECONNREFUSED, errno.ETIMEDOUT,
+                 errno.EPIPE]:
+      self.assertTrue(rate_limiter.is_retryable(socket.error(code, 'error')))
+    # Errors from local files are not worth retrying.
+    for code in [errno.ENOENT, errno.EACCES, errno.ENOSPC]:
+      self.assertFalse(rate_limiter.is_retryable(OSError(code, 'error')))
+      self.assertFalse(rate_limiter.is_retryable(IOError(code, 'error')))
+
+  def test_retry_with_backoff(self):
+    errors = [FakeHttpError(500), FakeHttpError(503)]
+    def call():
+      if errors:
+        raise errors.pop(0)
+      return 'ok'
+    self.assertEqual(self.limiter.call(call), 'ok')
+    self.assertEqual(len(self.delays), 2)
+    self.assertTrue(1.0 <= self.delays[0] <= 2.0)
+    self.assertTrue(2.0 <= self.delays[1] <= 4.0)
+    self.assertEqual(self.limiter.in_flight, 0)
+
+  def test_give_up(self):
+    def call():
+      raise FakeHttpError(500)
+    self.assertRaises(FakeHttpError, self.limiter.call, call)
+    self.assertEqual(len(self.delays), self.limiter.max_retries)
+    def fail():
+      raise ValueError()
+    self.assertRaises(ValueError, self.limiter.call, fail)
+    self.assertEqual(self.limiter.in_flight, 0)
+
+  def test_adapt_concurrency(self):
+    errors = [FakeHttpError(429)]
+    def call():
+      if errors:
+        raise errors.pop(0)
+    self.limiter.call(call)
+    self.assertTrue(self.limiter.concurrency < 4)
+    for unused in range(20):
+      self.limiter.call(lambda: None)
+    self.assertEqual(self.limiter.concurrency, 4)
+
+  def test_shared_quota(self):
+    bucket = rate_limiter.SharedTokenBucket(rate=1000, quota=3)
+    limiter = rate_limiter.RateLimiter(bucket=bucket)
+    for unused in range(3):
+      limiter.call(lambda: None)
+    self.assertRaises(rate_limiter.QuotaExhausted, limiter.call, lambda: None)
+    self.assertEqual(bucket.used.value, 3)
+    self.assertEqual(limiter.in_flight, 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
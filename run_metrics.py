@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""Metrics collected during a single run, such as from cron.
+
+Counts Youtube API calls and quota units per endpoint and per playlist, call
+latency, etag cache hits and misses, and plugin run times and results. The
+metrics are written as json, and optionally in the Prometheus text format for
+the node_exporter textfile collector.
+"""
+
+import threading
+import time
+
+import json
+
+import file_util
+
+
+# Quota cost of each endpoint. All calls used are list calls, which cost 1.
+QUOTA_UNITS = {'channels': 1, 'playlists': 1, 'playlistItems': 1, 'videos': 1}
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+class Histogram(object):
+  def __init__(self, buckets=LATENCY_BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.total = 0.0
+    self.count = 0
+
+  def observe(self, value):
+    i = 0
+    while i < len(self.buckets) and value > self.buckets[i]:
+      i += 1
+    self.counts[i] += 1
+    self.total += value
+    self.count += 1
+
+  def to_json(self):
+    return {'buckets': self.buckets, 'counts': self.counts,
+            'sum': self.total, 'count': self.count}
+
+
+class RunMetrics(object):
+  def __init__(self, command=None):
+    self.lock = threading.Lock()
+    self.command = command
+    self.start_time = time.time()
+    self.api = {}
+    self.playlists = {}
+    self.etags = {'hits': 0, 'misses': 0}
+    self.plugins = {}
+    self.new_videos = 0
+
+  def record_new_videos(self, count):
+    with self.lock:
+      self.new_videos += count
+
+  def record_api_call(self, endpoint, seconds=None, playlist_id=None,
+                      error=False):
+    """Record a call to an API endpoint, and how long it took if known."""
+    units = QUOTA_UNITS.get(endpoint, 0)
+    with self.lock:
+      if not endpoint in self.api:
+        self.api[endpoint] = {'calls': 0, 'errors': 0, 'quota_units': 0,
+                              'latency': Histogram()}
+      stats = self.api[endpoint]
+      stats['calls'] += 1
+      stats['quota_units'] += units
+      if error:
+        stats['errors'] += 1
+      if not seconds is None:
+        stats['latency'].observe(seconds)
+      if playlist_id:
+        if not playlist_id in self.playlists:
+          self.playlists[playlist_id] = {'calls': 0, 'quota_units': 0}
+        self.playlists[playlist_id]['calls'] += 1
+        self.playlists[playlist_id]['quota_units'] += units
+
+  def record_etag(self, hit):
+    with self.lock:
+      self.etags['hits' if hit else 'misses'] += 1
+
+  def record_plugin(self, name, seconds, status):
+    with self.lock:
+      if not name in self.plugins:
+        self.plugins[name] = {'runs': 0, 'success': 0, 'failure': 0,
+                              'wall_time': 0.0}
+      stats = self.plugins[name]
+      stats['runs'] += 1
+      stats['wall_time'] += seconds
+      if status == 'success':
+        stats['success'] += 1
+      elif status:
+        stats['failure'] += 1
+
+  def quota_units(self):
+    return sum(stats['quota_units'] for stats in self.api.values())
+
+  def to_json(self):
+    with self.lock:
+      api = {}
+      for endpoint, stats in self.api.items():
+        api[endpoint] = dict(stats)
+        api[endpoint]['latency'] = stats['latency'].to_json()
+      return {'command': self.command,
+              'start_time': int(self.start_time),
+              'duration': time.time() - self.start_time,
+              'quota_units': sum(s['quota_units'] for s in api.values()),
+              'new_videos': self.new_videos,
+              'api': api,
+              'playlists': dict(self.playlists),
+              'etags': dict(self.etags),
+              'plugins': dict(self.plugins)}
+
+  def write_json(self, path):
+    data = self.to_json()
+    file_util.write_atomic(path, [
+      json.dumps(data, indent=2, separators=(',', ': '), sort_keys=True)])
+
+  def write_prometheus(self, path):
+    """Write metrics in the Prometheus text exposition format."""
+    data = self.to_json()
+    lines = []
+    def metric(name, kind, help_text):
+      lines.append('# HELP youtube_metadata_sync_%s %s' % (name, help_text))
+      lines.append('# TYPE youtube_metadata_sync_%s %s' % (name, kind))
+    def sample(name, labels, value):
+      text = ','.join('%s="%s"' % (k, v) for k, v in sorted(labels.items()))
+      lines.append('youtube_metadata_sync_%s{%s} %s' % (name, text, value))
+    metric('last_run_timestamp_seconds', 'gauge', 'Start time of the run.')
+    sample('last_run_timestamp_seconds', {'command': data['command']},
+           data['start_time'])
+    metric('last_run_duration_seconds', 'gauge', 'Duration of the run.')
+    sample('last_run_duration_seconds', {'command': data['command']},
+           data['duration'])
+    metric('new_videos', 'gauge', 'Videos added by the run.')
+    sample('new_videos', {'command': data['command']}, data['new_videos'])
+    metric('api_calls', 'gauge', 'API calls made by the run.')
+    for endpoint, stats in sorted(data['api'].items()):
+      sample('api_calls', {'endpoint': endpoint}, stats['calls'])
+    metric('api_errors', 'gauge', 'API calls that failed.')
+    for endpoint, stats in sorted(data['api'].items()):
+      sample('api_errors', {'endpoint': endpoint}, stats['errors'])
+    metric('api_quota_units', 'gauge', 'API quota units used by the run.')
+    for endpoint, stats in sorted(data['api'].items()):
+      sample('api_quota_units', {'endpoint': endpoint}, stats['quota_units'])
+    metric('api_latency_seconds', 'histogram', 'Latency of API calls.')
+    for endpoint, stats in sorted(data['api'].items()):
+      latency = stats['latency']
+      cumulative = 0
+      for bound, count in zip(latency['buckets'] + ['+Inf'],
+                              latency['counts']):
+        cumulative += count
+        sample('api_latency_seconds_bucket',
+               {'endpoint': endpoint, 'le': bound}, cumulative)
+      sample('api_latency_seconds_sum', {'endpoint': endpoint},
+             latency['sum'])
+      sample('api_latency_seconds_count', {'endpoint': endpoint},
+             latency['count'])
+    metric('etag_lookups', 'gauge', 'Playlist etag cache hits and misses.')
+    sample('etag_lookups', {'result': 'hit'}, data['etags']['hits'])
+    sample('etag_lookups', {'result': 'miss'}, data['etags']['misses'])
+    metric('plugin_runs', 'gauge', 'Plugin runs, by result.')
+    for name, stats in sorted(data['plugins'].items()):
+      for result in ['success', 'failure']:
+        sample('plugin_runs', {'plugin': name, 'result': result},
+               stats[result])
+    metric('plugin_wall_time_seconds', 'gauge', 'Time spent running plugins.')
+    for name, stats in sorted(data['plugins'].items()):
+      sample('plugin_wall_time_seconds', {'plugin': name}, stats['wall_time'])
+    file_util.write_atomic(path, ['\n'.join(lines) + '\n'])
@@ -0,0 +1,154 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import json
+
+import fake_youtube_server
+import run_metrics
+import user_account
+
+
+class HistogramTest(unittest.TestCase):
+  def test_buckets(self):
+    histogram = run_metrics.Histogram([0.1, 1.0])
+    for value in [0.05, 0.1, 0.5, 2.0, 3.0]:
+      histogram.observe(value)
+    self.assertEqual(histogram.to_json(),
+                     {'buckets': [0.1, 1.0], 'counts': [2, 1, 2],
+                      'sum': 5.65, 'count': 5})
+
+
+class RunMetricsTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.metrics = run_metrics.RunMetrics('sync')
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def read_prometheus(self):
+    path = os.path.join(self.temp_directory, 'metrics.prom')
+    self.metrics.write_prometheus(path)
+    fp = open(path, 'r')
+    lines = fp.read().splitlines()
+    fp.close()
+    return lines
+
+  def test_prometheus(self):
+    self.metrics.record_api_call('videos', 0.2, error=True)
+    self.metrics.record_etag(hit=True)
+    self.metrics.record_plugin('plugin.sh', 1.5, 'success')
+    self.metrics.record_plugin('plugin.sh', 0.5, 'failed')
+    self.metrics.record_new_videos(3)
+    lines = self.read_prometheus()
+    prefix = 'youtube_metadata_sync_'
+    for line in lines:
+      if not line.startswith('#'):
+        self.assertTrue(line.startswith(prefix))
+    for line in ['# TYPE youtube_metadata_sync_api_calls gauge',
+                 'youtube_metadata_sync_new_videos{command="sync"} 3',
+                 'youtube_metadata_sync_api_calls{endpoint="videos"} 1',
+                 'youtube_metadata_sync_api_errors{endpoint="videos"} 1',
+                 'youtube_metadata_sync_api_quota_units{endpoint="videos"} 1',
+                 'youtube_metadata_sync_etag_lookups{result="hit"} 1',
+                 'youtube_metadata_sync_etag_lookups{result="miss"} 0',
+                 'youtube_metadata_sync_plugin_runs'
+                 '{plugin="plugin.sh",result="success"} 1',
+                 'youtube_metadata_sync_plugin_runs'
+                 '{plugin="plugin.sh",result="failure"} 1',
+                 'youtube_metadata_sync_plugin_wall_time_seconds'
+                 '{plugin="plugin.sh"} 2.0']:
+      self.assertTrue(line in lines, line)
+
+  def test_prometheus_histogram(self):
+    for seconds in [0.01, 0.07, 0.3, 20.0]:
+      self.metrics.record_api_call('playlistItems', seconds)
+    lines = [line for line in self.read_prometheus()
+             if line.startswith('youtube_metadata_sync_api_latency')]
+    buckets = [line for line in lines if '_bucket{' in line]
+    self.assertEqual(len(buckets), len(run_metrics.LATENCY_BUCKETS) + 1)
+    # Buckets are cumulative, ending with +Inf.
+    self.assertEqual(
+      [int(line.split(' ')[1]) for line in buckets],
+      [1, 2, 2, 3, 3, 3, 3, 3, 4])
+    self.assertTrue(buckets[0].startswith(
+      'youtube_metadata_sync_api_latency_seconds_bucket'
+      '{endpoint="playlistItems",le="0.05"}'))
+    self.assertTrue(buckets[-1].startswith(
+      'youtube_metadata_sync_api_latency_seconds_bucket'
+      '{endpoint="playlistItems",le="+Inf"}'))
+    self.assertEqual(lines[-2], 'youtube_metadata_sync_api_latency_seconds_sum'
+                     '{endpoint="playlistItems"} 20.38')
+    self.assertEqual(lines[-1], 'youtube_metadata_sync_api_latency_seconds_'
+                     'count{endpoint="playlistItems"} 4')
+
+  def test_json(self):
+    self.metrics.record_api_call('playlistItems', 0.1, 'PL1')
+    self.metrics.record_api_call('batch', 0.1)
+    path = os.path.join(self.temp_directory, 'metrics.json')
+    self.metrics.write_json(path)
+    fp = open(path, 'r')
+    data = json.loads(fp.read())
+    fp.close()
+    self.assertEqual(data['command'], 'sync')
+    self.assertEqual(data['quota_units'], 1)
+    self.assertEqual(data['playlists'], {'PL1': {'calls': 1,
+                                                 'quota_units': 1}})
+    self.assertEqual(data['api']['batch']['quota_units'], 0)
+
+
+class QuotaAccountingTest(unittest.TestCase):
+  def setUp(self):
+    self.server = fake_youtube_server.FakeYoutubeServer(
+      fake_youtube_server.FakeAccount(2, 20))
+    self.server.start()
+    self.metrics = run_metrics.RunMetrics('sync')
+    self.account = user_account.UserAccount(page_size=5, use_batch=True)
+    self.account.connect(self.server.url)
+    self.account.metrics = self.metrics
+    self.account.rate_limiter.sleep = lambda seconds: None
+    # Number of requests to throttle, by endpoint.
+    self.failures = {}
+    respond = self.server.respond
+    def throttling_respond(path, query):
+      endpoint = path.rstrip('/').split('/')[-1]
+      if self.failures.get(endpoint):
+        self.failures[endpoint] -= 1
+        return (403, endpoint, {'error': {
+          'code': 403, 'message': 'Rate Limit Exceeded',
+          'errors': [{'reason': 'rateLimitExceeded'}]}})
+      return respond(path, query)
+    self.server.respond = throttling_respond
+
+  def tearDown(self):
+    self.server.stop()
+
+  def test_retries(self):
+    self.failures['playlistItems'] = 1
+    self.account.get_playlist_videos('PL00000001', fetch_lengths=False)
+    stats = self.metrics.to_json()['api']['playlistItems']
+    # Four pages, one of them sent twice.
+    self.assertEqual(stats['calls'], 5)
+    self.assertEqual(stats['errors'], 1)
+    self.assertEqual(stats['quota_units'], 5)
+    self.assertEqual(self.metrics.playlists['PL00000001']['quota_units'], 5)
+
+  def test_batch(self):
+    self.failures['playlistItems'] = 1
+    self.account.prefetch_first_pages(['PL00000001', 'PL00000002',
+                                       fake_youtube_server.FAVORITES_ID])
+    api = self.metrics.to_json()['api']
+    # Every request in the batch is sent, and counted, again.
+    self.assertEqual(api['batch']['calls'], 2)
+    self.assertEqual(api['batch']['errors'], 1)
+    self.assertEqual(api['batch']['quota_units'], 0)
+    self.assertEqual(api['playlistItems']['calls'], 6)
+    self.assertEqual(api['playlistItems']['quota_units'], 6)
+    self.assertEqual(self.metrics.quota_units(), 6)
+    self.assertEqual(self.metrics.playlists['PL00000002']['quota_units'], 2)
+
+
+if __name__ == '__main__':
+  unittest.main()
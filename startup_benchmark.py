@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""Startup time benchmark for each command.
+
+Usage: python startup_benchmark.py [-r repeat]
+
+Runs the offline commands (execute, compact, export) as separate processes on
+a small output directory, and reports the best wall time of several runs. The
+network commands (init, update, sync) cannot run without credentials, so for
+them the time and requests to connect to the local fake Youtube API server are
+reported, with and without a cached discovery document.
+"""
+
+import importlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_youtube_server
+import local_metadata
+import user_account
+import user_account_fake
+
+
+OFFLINE_COMMANDS = ['execute', 'compact', 'export']
+
+
+def best_time(function, repeat):
+  best = None
+  for unused in range(repeat):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def run_command(command, output_directory):
+  script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'youtube_metadata_sync.py')
+  with open(os.devnull, 'w') as devnull:
+    subprocess.check_call([sys.executable, script, '-o', output_directory,
+                           command], stdout=devnull)
+
+
+def run():
+  repeat = 5
+  if len(sys.argv) == 3 and sys.argv[1] == '-r':
+    repeat = int(sys.argv[2])
+  elif len(sys.argv) != 1:
+    sys.stderr.write(__doc__)
+    sys.exit(1)
+  temp_directory = tempfile.mkdtemp()
+  server = fake_youtube_server.FakeYoutubeServer(
+    fake_youtube_server.FakeAccount(1, 1))
+  server.start()
+  try:
+    output_directory = os.path.join(temp_directory, 'output')
+    metadata = local_metadata.LocalMetadata(output_directory)
+    metadata.synchronize(user_account_fake.UserAccountFake(), quiet=True)
+    print('%-24s %8.3fs' % ('python', best_time(
+      lambda: subprocess.check_call([sys.executable, '-c', 'pass']), repeat)))
+    for command in OFFLINE_COMMANDS:
+      elapsed = best_time(lambda: run_command(command, output_directory),
+                          repeat)
+      print('%-24s %8.3fs' % (command, elapsed))
+    # Loaded by the first connect, measured on its own.
+    start = time.time()
+    importlib.import_module('apiclient.discovery')
+    print('%-24s %8.3fs' % ('import apiclient', time.time() - start))
+    cache = os.path.join(temp_directory, 'discovery.json')
+    for name in ['connect', 'connect cached']:
+      server.reset_stats()
+      start = time.time()
+      account = user_account.UserAccount(discovery_cache=cache)
+      account.connect(api_url=server.url)
+      elapsed = time.time() - start
+      print('%-24s %8.3fs %8d requests' % (name, elapsed,
+                                           sum(server.requests.values())))
+  finally:
+    server.stop()
+    shutil.rmtree(temp_directory)
+
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""End-to-end sync benchmark against a local fake Youtube API server.
+
+Usage: python sync_benchmark.py [-p playlists] [-i items] [-l latency]
+                                [-j jobs] [-c churn] [-d delta] [--batch]
+                                [-e error_rate] [--pipeline]
+
+Reports wall time, number of API requests and bytes received for init, an
+update where nothing changed, an update where some etags changed without new
+videos (churn), and an update that adds a few new videos (delta). With -e, that
+fraction of API requests fail with rateLimitExceeded and are retried. With
+--pipeline, videos are saved as each playlist is fetched, and their lengths are
+looked up while the next pages of the playlist are fetched.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import fake_youtube_server
+import local_metadata
+import user_account
+
+
+class BenchmarkOptions(object):
+  def __init__(self):
+    self.playlists = 50
+    self.items = 200
+    self.latency = 0.005
+    self.jobs = 1
+    self.churn = 5
+    self.delta = 10
+    self.batch = False
+    self.error_rate = 0.0
+    self.pipeline = False
+
+
+def get_options(args):
+  options = BenchmarkOptions()
+  flags = {'-p': 'playlists', '-i': 'items', '-j': 'jobs', '-c': 'churn',
+           '-d': 'delta'}
+  i = 0
+  while i < len(args):
+    if args[i] in flags:
+      i += 1
+      setattr(options, flags[args[i - 1]], int(args[i]))
+    elif args[i] == '-l':
+      i += 1
+      options.latency = float(args[i])
+    elif args[i] == '-e':
+      i += 1
+      options.error_rate = float(args[i])
+    elif args[i] == '--batch':
+      options.batch = True
+    elif args[i] == '--pipeline':
+      options.pipeline = True
+    else:
+      sys.stderr.write(__doc__)
+      sys.exit(1)
+    i += 1
+  return options
+
+
+def measure(name, server, function):
+  server.reset_stats()
+  start = time.time()
+  num_added = function()
+  elapsed = time.time() - start
+  requests = sum(server.requests.values())
+  print('%-16s %8.3fs %8d requests %12d bytes %8d new videos' % (
+    name, elapsed, requests, server.bytes_sent, num_added or 0))
+
+
+def run():
+  options = get_options(sys.argv[1:])
+  account = fake_youtube_server.FakeAccount(options.playlists, options.items)
+  server = fake_youtube_server.FakeYoutubeServer(
+    account, latency=options.latency, error_rate=options.error_rate)
+  server.start()
+  temp_directory = tempfile.mkdtemp()
+  try:
+    output_directory = os.path.join(temp_directory, 'output')
+    youtube = user_account.UserAccount(use_batch=options.batch,
+                                       pipeline_lengths=options.pipeline)
+    youtube.connect(api_url=server.url)
+    metadata = local_metadata.LocalMetadata(output_directory, verbose=True,
+                                            jobs=options.jobs)
+    print('%d playlists, %d items each, %.3fs latency, %d jobs%s%s' % (
+      options.playlists + 1, options.items, options.latency, options.jobs,
+      ', batch' if options.batch else '',
+      ', pipeline' if options.pipeline else ''))
+    on_added = None
+    if options.pipeline:
+      on_added = lambda filename, entries: None
+    sync = lambda: metadata.synchronize(youtube, on_added=on_added)
+    # A first sync into an empty directory does the same work as init.
+    measure('init', server, sync)
+    measure('update', server, sync)
+    account.churn(options.churn)
+    measure('update churn', server, sync)
+    account.add_videos(options.delta)
+    measure('update delta', server, sync)
+  finally:
+    server.stop()
+    shutil.rmtree(temp_directory)
+
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""Long-running sync, checking each playlist at its own pace.
+
+The daemon keeps the account connected and the metadata open between checks.
+Each playlist is checked again after an interval that follows its history:
+when its etag has changed since the last check, the interval is halved, down to
+a minimum, and when it has not, the interval is doubled, up to a maximum. Busy
+playlists are checked every few minutes, while playlists that haven't changed
+in years cost a request a week. The schedule is kept in
+output_directory/data/schedule.json:
+
+{
+  "PLXXXXXXXXXXXXXXXX": {"interval": 600, "next_check": 1234567890,
+                         "last_change": 1234567000},
+  ...
+}
+
+SIGTERM or SIGINT stop the daemon once the current check is done. A second
+signal stops it at once.
+"""
+
+import errno
+import os
+import random
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import json
+
+import file_util
+
+
+MIN_INTERVAL = 5 * 60
+MAX_INTERVAL = 7 * 24 * 3600
+PLAYLISTS_REFRESH_INTERVAL = 6 * 3600
+# Spread checks out, so that playlists found together aren't always checked
+# together.
+JITTER = 0.1
+
+
+class SyncDaemon(object):
+  def __init__(self, metadata, account, executor=None,
+               min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL,
+               on_pass=None):
+    self.metadata = metadata
+    self.account = account
+    self.executor = executor
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.on_pass = on_pass
+    self.path = os.path.join(metadata.output_directory, 'data',
+                             'schedule.json')
+    self.schedule = {}
+    self.playlists = []
+    self.playlists_time = None
+    self.stopping = False
+    self.wakeup = threading.Event()
+    self.jitter = JITTER
+    self.time = time.time
+
+  def run(self):
+    """Check playlists as they are due, until stopped by a signal."""
+    handlers = {}
+    for signum in [signal.SIGTERM, signal.SIGINT]:
+      handlers[signum] = signal.signal(signum, self._handle_signal)
+    try:
+      self.load()
+      while not self.stopping:
+        try:
+          self.run_once()
+          wait = self.next_check() - self.time()
+        except Exception:
+          # Keep running through network errors and the like.
+          traceback.print_exc()
+          wait = self.min_interval
+        if self.stopping:
+          break
+        self.wakeup.wait(max(0, wait))
+    finally:
+      for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+  def stop(self):
+    self.stopping = True
+    self.wakeup.set()
+
+  def run_once(self):
+    """Check the playlists that are due. Return the number of new videos."""
+    now = self.time()
+    if (self.playlists_time is None or
+        now - self.playlists_time >= PLAYLISTS_REFRESH_INTERVAL):
+      self._refresh_playlists(now)
+    due = [p for p in self.playlists
+           if self.schedule[p['playlist_id']]['next_check'] <= now]
+    if not due:
+      return 0
+    etags = self.metadata.get_etags()
+    def sync(on_added=None):
+      return self.metadata.synchronize(self.account, quiet=True,
+                                       on_added=on_added, playlists=due)
+    if self.executor:
+      num_added = self.executor.execute(self.metadata, sync=sync)
+    else:
+      num_added = sync()
+    if num_added > 0:
+      print('Sync found %d new videos.' % (num_added,))
+    new_etags = self.metadata.get_etags()
+    now = self.time()
+    for playlist in due:
+      playlist_id = playlist['playlist_id']
+      changed = etags.get(playlist_id) != new_etags.get(playlist_id)
+      self._reschedule(playlist_id, changed, now)
+    self.save()
+    if self.on_pass:
+      self.on_pass()
+    return num_added
+
+  def next_check(self):
+    """Return the time the next playlist is due."""
+    times = [entry['next_check'] for entry in self.schedule.values()]
+    if self.playlists_time is not None:
+      times.append(self.playlists_time + PLAYLISTS_REFRESH_INTERVAL)
+    return min(times)
+
+  def load(self):
+    """Load the schedule from disk, if it exists."""
+    try:
+      fp = open(self.path, 'r')
+    except IOError:
+      e = sys.exc_info()[1]
+      if e.errno == errno.ENOENT:
+        return
+      else:
+        raise
+    content = fp.read()
+    fp.close()
+    self.schedule = json.loads(content)
+
+  def save(self):
+    file_util.write_atomic(self.path, [
+      json.dumps(self.schedule, indent=2, separators=(',', ': '),
+                 sort_keys=True)])
+
+  def _refresh_playlists(self, now):
+    self.playlists = self.account.get_all_playlists()
+    self.playlists_time = now
+    playlist_ids = set(p['playlist_id'] for p in self.playlists)
+    for playlist_id in list(self.schedule):
+      if not playlist_id in playlist_ids:
+        del self.schedule[playlist_id]
+    for playlist_id in playlist_ids:
+      if not playlist_id in self.schedule:
+        # New playlists are checked right away.
+        self.schedule[playlist_id] = {'interval': self.min_interval,
+                                      'next_check': now,
+                                      'last_change': None}
+
+  def _reschedule(self, playlist_id, changed, now):
+    entry = self.schedule[playlist_id]
+    if changed:
+      entry['interval'] = max(self.min_interval, entry['interval'] // 2)
+      entry['last_change'] = int(now)
+    else:
+      entry['interval'] = min(self.max_interval, entry['interval'] * 2)
+    jitter = random.uniform(-self.jitter, self.jitter) * entry['interval']
+    entry['next_check'] = int(now + entry['interval'] + jitter)
+
+  def _handle_signal(self, signum, frame):
+    if self.stopping:
+      raise KeyboardInterrupt()
+    sys.stderr.write('Stopping after the current check.\n')
+    self.stop()
@@ -0,0 +1,54 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import local_metadata
+import sync_daemon
+import user_account_fake
+
+
+class SyncDaemonTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.output_directory = os.path.join(self.temp_directory, 'output')
+    self.metadata = local_metadata.LocalMetadata(self.output_directory,
+                                                 verbose=True)
+    self.account = user_account_fake.UserAccountFake()
+    self.daemon = sync_daemon.SyncDaemon(self.metadata, self.account,
+                                         min_interval=100, max_interval=1000)
+    self.daemon.jitter = 0
+    self.now = 10000
+    self.daemon.time = lambda: self.now
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def test_schedule(self):
+    # Every playlist is new, so checked and found changed.
+    self.assertEqual(self.daemon.run_once(), 3)
+    for entry in self.daemon.schedule.values():
+      self.assertEqual(entry['interval'], 100)
+      self.assertEqual(entry['last_change'], 10000)
+      self.assertEqual(entry['next_check'], 10100)
+    # Nothing is due yet.
+    self.assertEqual(self.daemon.run_once(), 0)
+    # Unchanged playlists are checked less and less often.
+    for interval in [200, 400, 800, 1000, 1000]:
+      self.now = self.daemon.next_check()
+      self.daemon.run_once()
+      for entry in self.daemon.schedule.values():
+        self.assertEqual(entry['interval'], interval)
+    # The schedule is kept across runs.
+    daemon = sync_daemon.SyncDaemon(self.metadata, self.account)
+    daemon.load()
+    self.assertEqual(daemon.schedule, self.daemon.schedule)
+
+  def test_stop(self):
+    self.daemon.stop()
+    self.daemon.run()
+    self.assertTrue(self.daemon.stopping)
+
+
+if __name__ == '__main__':
+  unittest.main()
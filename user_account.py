@@ -1,27 +1,41 @@
 #!/usr/bin/env python
 
-"""Wraps the Youtube API to make it trivial to use."""
+"""Wraps the Youtube API to make it trivial to use.
 
-import httplib2
+The API client and oauth2client are imported only when an account is
+connected or authenticated, so that commands which never touch the network
+start quickly.
+"""
+
+import copy
+import json
 import os
 import sys
+import threading
+import time
 
-from apiclient.discovery import build
-from oauth2client.client import flow_from_clientsecrets
-from oauth2client.file import Storage
-from oauth2client.tools import run_flow
+from multiprocessing.pool import ThreadPool
 
 import data_util
+import file_util
+import rate_limiter
 import secret_obfuscator
 import video_element
+import video_length_cache
 
 
 AUTHENTICATION_FILE = 'auth.json'
 CLIENT_SECRETS_FILE = 'client_secrets.obf'
-VIDEO_LENGTH_REQUEST_SIZE = 20
+PLAYLIST_PAGE_SIZE = 50
+BATCH_REQUEST_SIZE = 50
+VIDEO_LENGTH_REQUEST_SIZE = 50
+LENGTH_LOOKUP_JOBS = 4
 YOUTUBE_READONLY_SCOPE = 'https://www.googleapis.com/auth/youtube.readonly'
 YOUTUBE_API_SERVICE_NAME = 'youtube'
 YOUTUBE_API_VERSION = 'v3'
+DISCOVERY_PATH = '/discovery/v1/apis/{api}/{apiVersion}/rest'
+DISCOVERY_URL = 'https://www.googleapis.com' + DISCOVERY_PATH
+DISCOVERY_CACHE_TTL = 24 * 3600
 
 
 class OauthFlags(object):
@@ -33,29 +47,141 @@ class OauthFlags(object):
 
 
 class UserAccount(object):
-  def __init__(self):
+  def __init__(self, page_size=PLAYLIST_PAGE_SIZE, use_batch=False,
+               batch_uri=None, rate=rate_limiter.DEFAULT_RATE,
+               discovery_cache=None, auth_file=AUTHENTICATION_FILE,
+               rate_bucket=None, pipeline_lengths=False):
     self.credentials = None
     self.service = None
-    self.auth_storage = Storage(AUTHENTICATION_FILE)
-    obfuscator = secret_obfuscator.SecretObfuscator()
-    secret_cleartext = obfuscator.make_cleartext(CLIENT_SECRETS_FILE)
-    self.connect_flow = flow_from_clientsecrets(secret_cleartext,
-                                                scope=YOUTUBE_READONLY_SCOPE)
-    obfuscator.cleanup()
+    self.page_size = page_size
+    self.use_batch = use_batch
+    self.batch_uri = batch_uri
+    # Filled by prefetch_first_pages and used up by get_playlist_videos,
+    # possibly on clones in other threads.
+    self.first_pages = {}
+    self.first_pages_lock = threading.Lock()
+    self.api_url = None
+    self.metrics = None
+    self.auth_file = auth_file
+    # Shared by clones, so that all threads are limited together. A shared
+    # rate_bucket also limits other processes. Like metrics, it has a lock.
+    self.rate_limiter = rate_limiter.RateLimiter(rate, bucket=rate_bucket)
+    # Path of a file caching the discovery document between runs, and the
+    # document itself once loaded, shared by clones.
+    self.discovery_cache = discovery_cache
+    self.discovery_document = None
+    # If set, lengths are looked up by worker threads as each page of a
+    # playlist arrives. Each clone has its own pool, created on first use.
+    self.pipeline_lengths = pipeline_lengths
+    self.length_workers = {'lock': threading.Lock(), 'pool': None,
+                           'local': threading.local()}
+    # Clones made since the last close, stopped along with this account.
+    self.clones = []
 
   def authenticate(self):
     """Run the command-line authentication flow and save credentials."""
-    self.credentials = run_flow(self.connect_flow, self.auth_storage,
+    from oauth2client.client import flow_from_clientsecrets
+    from oauth2client.file import Storage
+    from oauth2client.tools import run_flow
+    obfuscator = secret_obfuscator.SecretObfuscator()
+    secret_cleartext = obfuscator.make_cleartext(CLIENT_SECRETS_FILE)
+    try:
+      connect_flow = flow_from_clientsecrets(secret_cleartext,
+                                             scope=YOUTUBE_READONLY_SCOPE)
+    finally:
+      obfuscator.cleanup()
+    self.credentials = run_flow(connect_flow, Storage(self.auth_file),
                                 OauthFlags())
 
-  def connect(self):
-    """Load credentials and create the Youtube API wrapper."""
-    self.credentials = self.auth_storage.get()
-    if self.credentials is None or self.credentials.invalid:
-      raise RuntimeError('Not authenticated!')
-    http_credentials = self.credentials.authorize(httplib2.Http())
-    self.youtube_service = build(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION,
-                                 http=http_credentials)
+  def connect(self, api_url=None):
+    """Load credentials and create the Youtube API wrapper.
+
+    If api_url is set, connect without credentials to a local stand-in for the
+    API at that url, such as fake_youtube_server.
+    """
+    self.api_url = api_url
+    if not api_url:
+      from oauth2client.file import Storage
+      self.credentials = Storage(self.auth_file).get()
+      if self.credentials is None or self.credentials.invalid:
+        raise RuntimeError('Not authenticated!')
+    self._build_service()
+
+  def _build_service(self):
+    """Create the Youtube API wrapper, with an HTTP client of its own."""
+    import httplib2
+    from apiclient.discovery import build_from_document
+    if self.api_url:
+      http = httplib2.Http()
+      discovery_url = self.api_url + DISCOVERY_PATH
+    else:
+      http = self.credentials.authorize(httplib2.Http())
+      discovery_url = DISCOVERY_URL
+    discovery_url = discovery_url.format(api=YOUTUBE_API_SERVICE_NAME,
+                                         apiVersion=YOUTUBE_API_VERSION)
+    if self.discovery_document is None:
+      self.discovery_document = self._get_discovery_document(discovery_url)
+    self.youtube_service = build_from_document(self.discovery_document,
+                                               http=http)
+
+  def _get_discovery_document(self, discovery_url):
+    """Return the discovery document, from the cache file if it is fresh."""
+    path = self.discovery_cache
+    if path and os.path.exists(path):
+      if time.time() - os.path.getmtime(path) < DISCOVERY_CACHE_TTL:
+        try:
+          with open(path) as fp:
+            cached = json.load(fp)
+          if cached.get('url') == discovery_url:
+            return cached['document']
+        except ValueError:
+          pass
+    import httplib2
+    (response, content) = httplib2.Http().request(discovery_url)
+    if response.status >= 400:
+      raise RuntimeError('Cannot get discovery document: %s' % (
+        response.status,))
+    if isinstance(content, bytes):
+      content = content.decode('utf-8')
+    if path:
+      file_util.mkdir_p(os.path.dirname(path))
+      file_util.write_atomic(path, [json.dumps({'url': discovery_url,
+                                                'document': content})])
+    return content
+
+  def clone(self):
+    """Return a connected copy of this account with its own HTTP client.
+
+    httplib2.Http objects are not thread-safe, so each worker thread must use
+    its own clone. Clones share the credentials, discovery document, rate
+    limiter, metrics and prefetched pages of this account, without reading or
+    fetching them again, and have their own length lookup threads.
+    """
+    account = copy.copy(self)
+    account.length_workers = {'lock': threading.Lock(), 'pool': None,
+                              'local': threading.local()}
+    account.clones = []
+    account._build_service()
+    with self.length_workers['lock']:
+      self.clones.append(account)
+    return account
+
+  def close(self):
+    """Stop the length lookup threads of this account and its clones.
+
+    They are started again by the next lookup that needs them.
+    """
+    workers = self.length_workers
+    with workers['lock']:
+      pool = workers['pool']
+      workers['pool'] = None
+      clones = self.clones
+      self.clones = []
+    for account in clones:
+      account.close()
+    if pool:
+      pool.close()
+      pool.join()
 
   def get_all_playlists(self):
     """Get information about all playlists the user has.
@@ -64,8 +190,8 @@ class UserAccount(object):
     a dictionary with keys 'title', 'directory', 'playlist_id'.
     """
     playlists = []
-    response = self.youtube_service.channels().list(
-      mine=True, part='contentDetails').execute()
+    response = self._execute(self.youtube_service.channels().list(
+      mine=True, part='contentDetails'), 'channels')
     favorites_id = (response['items'][0]['contentDetails']
                     ['relatedPlaylists']['favorites'])
     playlists.append({'title': u'Favorites',
@@ -73,8 +199,8 @@ class UserAccount(object):
                       'playlist_id': favorites_id})
     page_token = None
     while True:
-      response = self.youtube_service.playlists().list(
-        part='id,snippet', mine='true', pageToken=page_token).execute()
+      response = self._execute(self.youtube_service.playlists().list(
+        part='id,snippet', mine='true', pageToken=page_token), 'playlists')
       for item in response['items']:
         title = item['snippet']['title']
         playlists.append({'title': title,
@@ -87,13 +213,22 @@ class UserAccount(object):
     return playlists
 
   def get_playlist_videos(self, playlist_id, min_timestamp=None,
-                          etag_cache=None):
+                          etag_cache=None, fetch_lengths=True,
+                          watermarks=None, length_cache=None):
     """Get information about all videos in the playlist.
 
     Return videos in order by timestamp, with newer (larger timestamp) videos
     first. If min_timestamp is set, only return videos with larger timestamps.
     If playlist has the same etag as in the etag_cache, return None. Each video
-    is represented by a VideoElement object.
+    is represented by a VideoElement object. If fetch_lengths is False, video
+    lengths are left unset, to be filled later by fill_video_lengths.
+    Otherwise, they are looked up using length_cache if given, while the
+    next pages are fetched if pipeline_lengths is set. Lookups then wait for a
+    full request of ids, across pages, except for the last one.
+
+    For playlists ordered with newest videos last, watermarks maps playlist_id
+    to the last item seen by a previous call. If it is set, only the pages
+    after that item are fetched, and the watermark is updated.
     """
     videos = []
     # Youtube API's playlist ids begin with 'FL' for favorites list, and 'PL'
@@ -112,32 +247,44 @@ class UserAccount(object):
     last_timestamp = None
     # Call Youtube API to get videos in the playlist.
     page_token = None
+    response = self._list_playlist_items(playlist_id, page_token)
+    # Check etag for only the first page, and abort if it matches the cache.
+    if not etag_cache is None:
+      if etag_cache.get(playlist_id) == response['etag']:
+        if self.metrics:
+          self.metrics.record_etag(hit=True)
+        return None
+      if self.metrics:
+        self.metrics.record_etag(hit=False)
+      etag_cache[playlist_id] = response['etag']
+    # Resume after the watermark if possible, rather than walking every page.
+    first_position = 0
+    if reverse_order and watermarks and playlist_id in watermarks:
+      watermark = watermarks[playlist_id]
+      resumed = self._resume_from_watermark(playlist_id, response, watermark)
+      if resumed:
+        (page_token, response) = resumed
+        first_position = watermark['count']
+    last_item = None
+    pipeline = fetch_lengths and self.pipeline_lengths
+    lookups = []
+    requested = set()
+    queued = []
     while True:
-      response = self.youtube_service.playlistItems().list(
-        part='snippet,contentDetails',
-        maxResults=10,
-        playlistId=playlist_id,
-        pageToken=page_token
-      ).execute()
-      # Check etag for only the first page, and abort if it matches the cache.
-      if not etag_cache is None and page_token is None:
-        if etag_cache.get(playlist_id) == response['etag']:
-          return None
-        etag_cache[playlist_id] = response['etag']
+      page_start = len(videos)
       for item in response['items']:
-        element = video_element.VideoElement()
-        element.title = item['snippet']['title']
-        element.description = item['snippet']['description']
-        element.published = item['snippet']['publishedAt']
-        element.timestamp = data_util.create_timestamp(element.published)
-        element.video_id = item['contentDetails']['videoId']
-        element.safename = (data_util.normalize_name(element.title) + '-' +
-                            element.video_id)
-        element.url = 'http://youtube.com/watch?v=%s' % element.video_id
+        last_item = item
+        if first_position and item['snippet']['position'] < first_position:
+          continue
+        element = video_element.VideoElement.from_playlist_item(item)
         # Filter by timestamp if necessary.
         last_timestamp = element.timestamp
         if not min_timestamp or last_timestamp > min_timestamp:
           videos.append(element)
+      if pipeline:
+        lookups.extend(self._lookup_lengths_async(videos[page_start:],
+                                                  length_cache, requested,
+                                                  queued))
       # Pagination. We want all pages if the order needs to be reversed, or
       # there is no minimum timestamp. Otherwise, continue as long as the
       # last timestamp is larger than the minimum timestamp and a next page
@@ -146,32 +293,211 @@ class UserAccount(object):
            (min_timestamp and last_timestamp > min_timestamp)) and
           'nextPageToken' in response):
         page_token = response['nextPageToken']
+        response = self._list_playlist_items(playlist_id, page_token)
       else:
         break
+    # Remember the last page, so the next call can start from there.
+    if reverse_order and not watermarks is None and last_item:
+      watermarks[playlist_id] = {
+        'count': last_item['snippet']['position'] + 1,
+        'video_id': last_item['contentDetails']['videoId'],
+        'page_token': page_token,
+        'page_size': self.page_size}
     # Reverse the order after getting all videos.
     if reverse_order:
       videos.reverse()
     # Get video lengths.
-    lengths = self.get_video_length([element.video_id for element in videos])
-    for element in videos:
-      if element.video_id in lengths:
-        element.length = lengths[element.video_id]
+    if pipeline:
+      lookups.extend(self._lookup_lengths_async([], length_cache, requested,
+                                                queued, flush=True))
+      self._join_lengths(videos, lookups, length_cache)
+    elif fetch_lengths:
+      self.fill_video_lengths(videos, length_cache)
     return videos
 
+  def prefetch_first_pages(self, playlist_ids):
+    """Get the first page of each playlist, using batch requests.
+
+    Does nothing unless batch requests are enabled. Prefetched pages are used
+    by the next get_playlist_videos call for that playlist.
+    """
+    if not self.use_batch:
+      return
+    requests = [(playlist_id, self._playlist_items_request(playlist_id, None))
+                for playlist_id in playlist_ids]
+    responses = self._execute_batch(requests, 'playlistItems')
+    with self.first_pages_lock:
+      self.first_pages.update(responses)
+
+  def _list_playlist_items(self, playlist_id, page_token):
+    if page_token is None:
+      with self.first_pages_lock:
+        response = self.first_pages.pop(playlist_id, None)
+      if response is not None:
+        return response
+    return self._execute(self._playlist_items_request(playlist_id, page_token),
+                         'playlistItems', playlist_id)
+
+  def _playlist_items_request(self, playlist_id, page_token):
+    return self.youtube_service.playlistItems().list(
+      part='snippet,contentDetails',
+      maxResults=self.page_size,
+      playlistId=playlist_id,
+      pageToken=page_token
+    )
+
+  def _execute(self, request, endpoint, playlist_id=None, cost=1, parts=()):
+    """Execute a single API request, recording it in the metrics if set.
+
+    The request goes through the rate limiter, which retries it with backoff
+    if it is throttled or fails with a server error. For a batch request,
+    parts lists the endpoint and playlist id of each request in it, recorded
+    as calls every time the batch is sent.
+    """
+    def attempt():
+      if not self.metrics:
+        return request.execute()
+      for (part_endpoint, part_playlist_id) in parts:
+        self.metrics.record_api_call(part_endpoint,
+                                     playlist_id=part_playlist_id)
+      start = time.time()
+      try:
+        response = request.execute()
+      except Exception:
+        self.metrics.record_api_call(endpoint, time.time() - start,
+                                     playlist_id, error=True)
+        raise
+      self.metrics.record_api_call(endpoint, time.time() - start, playlist_id)
+      return response
+    if not self.rate_limiter:
+      return attempt()
+    return self.rate_limiter.call(attempt, cost)
+
+  def _execute_batch(self, requests, endpoint):
+    """Execute (key, request) pairs to endpoint as batch HTTP requests.
+
+    Return a dictionary mapping each key to its response. For playlistItems
+    requests, keys are playlist ids.
+    """
+    responses = {}
+    def callback(request_id, response, exception):
+      if exception is not None:
+        raise exception
+      responses[request_id] = response
+    from apiclient.http import BatchHttpRequest
+    offset = 0
+    while offset < len(requests):
+      if self.batch_uri:
+        batch = BatchHttpRequest(callback=callback, batch_uri=self.batch_uri)
+      else:
+        batch = self.youtube_service.new_batch_http_request(callback=callback)
+      chunk = requests[offset:offset + BATCH_REQUEST_SIZE]
+      parts = []
+      for key, request in chunk:
+        batch.add(request, request_id=key)
+        parts.append((endpoint, key if endpoint == 'playlistItems' else None))
+      self._execute(batch, 'batch', cost=len(chunk), parts=parts)
+      offset += BATCH_REQUEST_SIZE
+    return responses
+
+  def _resume_from_watermark(self, playlist_id, first_response, watermark):
+    """Get the page containing the watermark, if the playlist only grew.
+
+    Return a tuple of the page token and response, or None if the playlist
+    has been reordered or shrunk and needs to be walked from the start.
+    """
+    if watermark.get('page_size') != self.page_size:
+      return None
+    if first_response['pageInfo']['totalResults'] < watermark['count']:
+      return None
+    page_token = watermark['page_token']
+    if page_token is None:
+      response = first_response
+    else:
+      response = self._list_playlist_items(playlist_id, page_token)
+    for item in response['items']:
+      if item['snippet']['position'] == watermark['count'] - 1:
+        if item['contentDetails']['videoId'] == watermark['video_id']:
+          return (page_token, response)
+        break
+    return None
+
+  def _lookup_lengths_async(self, videos, length_cache, requested, queued,
+                            flush=False):
+    """Queue the lengths of videos to be looked up on length worker threads.
+
+    Ids already in requested or in the cache are skipped. Queued ids are sent
+    as soon as they fill a request, and the rest only if flush is set. Return
+    a list of the pending results.
+    """
+    for element in videos:
+      video_id = element.video_id
+      if element.length is not None or video_id in requested:
+        continue
+      if length_cache is not None and length_cache.get(video_id) is not None:
+        continue
+      requested.add(video_id)
+      queued.append(video_id)
+    lookups = []
+    while queued and (flush or len(queued) >= VIDEO_LENGTH_REQUEST_SIZE):
+      video_ids = queued[:VIDEO_LENGTH_REQUEST_SIZE]
+      del queued[:VIDEO_LENGTH_REQUEST_SIZE]
+      workers = self.length_workers
+      with workers['lock']:
+        if workers['pool'] is None:
+          workers['pool'] = ThreadPool(LENGTH_LOOKUP_JOBS)
+        pool = workers['pool']
+      lookups.append(pool.apply_async(self._get_video_length_in_worker,
+                                      (video_ids,)))
+    return lookups
+
+  def _get_video_length_in_worker(self, video_ids):
+    local = self.length_workers['local']
+    if not hasattr(local, 'account'):
+      # httplib2.Http objects are not thread-safe.
+      local.account = self.clone()
+    return local.account.get_video_length(video_ids)
+
+  def _join_lengths(self, videos, lookups, length_cache):
+    """Set the lengths of videos, in order, from the pending lookups."""
+    lengths = {}
+    for lookup in lookups:
+      lengths.update(lookup.get())
+    def get_video_length(video_ids):
+      missing = [v for v in video_ids if not v in lengths]
+      if missing:
+        lengths.update(self.get_video_length(missing))
+      return lengths
+    video_length_cache.fill_lengths(videos, length_cache, get_video_length)
+
+  def fill_video_lengths(self, videos, length_cache=None):
+    """Set the length of each VideoElement, using the cache if given."""
+    video_length_cache.fill_lengths(videos, length_cache, self.get_video_length)
+
   def get_video_length(self, video_ids):
     """Get a dictionary mapping video_id to length of video in seconds."""
     lengths = {}
     if not isinstance(video_ids, list):
       video_ids = [video_ids]
+    # Remove duplicates, keeping order.
+    seen = set()
+    video_ids = [v for v in video_ids if not (v in seen or seen.add(v))]
+    requests = []
     offset = 0
     while offset < len(video_ids):
       request_ids = video_ids[offset:offset + VIDEO_LENGTH_REQUEST_SIZE]
-      response = self.youtube_service.videos().list(
+      requests.append((str(offset), self.youtube_service.videos().list(
         part='contentDetails',
-        id=','.join(request_ids)).execute()
+        id=','.join(request_ids))))
+      offset += VIDEO_LENGTH_REQUEST_SIZE
+    if self.use_batch:
+      responses = list(self._execute_batch(requests, 'videos').values())
+    else:
+      responses = [self._execute(request, 'videos')
+                   for key, request in requests]
+    for response in responses:
       for item in response['items']:
         duration = item['contentDetails']['duration']
         length = data_util.convert_youtube_time_to_sec(duration)
         lengths[item['id']] = length
-      offset += VIDEO_LENGTH_REQUEST_SIZE
     return lengths
@@ -1,14 +1,29 @@
 import video_element
+import video_length_cache
 
 
 class UserAccountFake(object):
+  def __init__(self):
+    self.length_requests = []
+    self.pipeline_lengths = False
+
+  def clone(self):
+    return UserAccountFake()
+
+  def close(self):
+    pass
+
   def get_all_playlists(self):
     return [{'title': 'Apple', 'directory': 'apple', 'playlist_id': 'PLA'},
             {'title': 'Banana', 'directory': 'banana', 'playlist_id': 'PLB'},
             {'title': 'Carrot', 'directory': 'carrot', 'playlist_id': 'PLC'}]
 
+  def prefetch_first_pages(self, playlist_ids):
+    pass
+
   def get_playlist_videos(self, playlist_id, min_timestamp=None,
-                          etag_cache=None):
+                          etag_cache=None, fetch_lengths=True,
+                          watermarks=None, length_cache=None):
     videos = []
     if playlist_id == 'PLA':
       element = video_element.VideoElement()
@@ -19,7 +34,7 @@ class UserAccountFake(object):
       element.video_id = 'vA_'
       element.safename = 'apple-video'
       element.url = 'http://youtube.com/watch?v=vA_'
-      element.length = 0
+      element.length = 0 if fetch_lengths else None
       videos.append(element)
       etag_cache['PLA'] = 'Aetag1'
     elif playlist_id == 'PLB':
@@ -31,7 +46,7 @@ class UserAccountFake(object):
       element.video_id = 'vB_'
       element.safename = 'banana-video'
       element.url = 'http://youtube.com/watch?v=vB_'
-      element.length = 0
+      element.length = 0 if fetch_lengths else None
       videos.append(element)
       etag_cache['PLB'] = 'Betag1'
     elif playlist_id == 'PLC':
@@ -43,7 +58,14 @@ class UserAccountFake(object):
       element.video_id = 'vC_'
       element.safename = 'carrot-video'
       element.url = 'http://youtube.com/watch?v=vC_'
-      element.length = 0
+      element.length = 0 if fetch_lengths else None
       videos.append(element)
       etag_cache['PLC'] = 'Cetag1'
     return videos
+
+  def fill_video_lengths(self, videos, length_cache=None):
+    video_length_cache.fill_lengths(videos, length_cache, self.get_video_length)
+
+  def get_video_length(self, video_ids):
+    self.length_requests.append(video_ids)
+    return dict((video_id, 0) for video_id in video_ids)
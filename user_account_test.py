@@ -0,0 +1,220 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import json
+
+import fake_youtube_server
+import local_metadata
+import user_account
+
+
+class UserAccountTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.fake = fake_youtube_server.FakeAccount(2, 20)
+    self.server = fake_youtube_server.FakeYoutubeServer(self.fake)
+    self.server.start()
+
+  def tearDown(self):
+    self.server.stop()
+    shutil.rmtree(self.temp_directory)
+
+  def connect(self, **kwargs):
+    kwargs.setdefault('page_size', 5)
+    account = user_account.UserAccount(**kwargs)
+    account.connect(self.server.url)
+    return account
+
+  def add_videos(self, playlist_id, count):
+    with self.fake.lock:
+      for unused in range(count):
+        self.fake._add_video(playlist_id)
+
+  def read_watermarks(self, output_directory):
+    fp = open(os.path.join(output_directory, 'data', 'watermarks.json'), 'r')
+    watermarks = json.loads(fp.read())
+    fp.close()
+    return watermarks
+
+  def test_resume_from_watermark(self):
+    account = self.connect()
+    watermarks = {}
+    videos = account.get_playlist_videos('PL00000001', watermarks=watermarks)
+    self.assertEqual(len(videos), 20)
+    self.assertEqual(watermarks['PL00000001']['count'], 20)
+    self.add_videos('PL00000001', 3)
+    self.server.reset_stats()
+    videos = account.get_playlist_videos('PL00000001', watermarks=watermarks)
+    # The first page, the page of the watermark and the new page.
+    self.assertEqual(self.server.requests['playlistItems'], 3)
+    self.assertEqual([v.video_id for v in videos],
+                     [item['videoId'] for item
+                      in self.fake.items['PL00000001'][:-4:-1]])
+    self.assertEqual(watermarks['PL00000001']['count'], 23)
+    self.assertEqual(watermarks['PL00000001']['video_id'], videos[0].video_id)
+
+  def test_full_fetch_without_watermark_item(self):
+    account = self.connect()
+    watermarks = {}
+    account.get_playlist_videos('PL00000001', watermarks=watermarks)
+    # The last item seen is removed, and others are added after it.
+    with self.fake.lock:
+      del self.fake.items['PL00000001'][-1]
+    self.add_videos('PL00000001', 2)
+    self.server.reset_stats()
+    videos = account.get_playlist_videos('PL00000001', watermarks=watermarks)
+    # The page of the watermark, then every page from the start.
+    self.assertEqual(self.server.requests['playlistItems'], 6)
+    self.assertEqual(len(videos), 21)
+    self.assertEqual(watermarks['PL00000001']['count'], 21)
+
+  def test_full_fetch_when_playlist_shrinks(self):
+    account = self.connect()
+    watermarks = {}
+    account.get_playlist_videos('PL00000001', watermarks=watermarks)
+    with self.fake.lock:
+      del self.fake.items['PL00000001'][0]
+    videos = account.get_playlist_videos('PL00000001', watermarks=watermarks)
+    self.assertEqual(len(videos), 19)
+    self.assertEqual(watermarks['PL00000001']['count'], 19)
+
+  def test_watermarks_saved_after_merge(self):
+    output_directory = os.path.join(self.temp_directory, 'output')
+    metadata = local_metadata.LocalMetadata(output_directory, verbose=True)
+    metadata.synchronize(self.connect())
+    before = self.read_watermarks(output_directory)
+    self.add_videos('PL00000001', 3)
+    self.add_videos('PL00000002', 3)
+    # Merging the second playlist fails.
+    add_to_current_metadata = metadata._add_to_current_metadata
+    def failing_add(videos, *args):
+      if videos and videos[0].video_id in [
+          item['videoId'] for item in self.fake.items['PL00000002']]:
+        raise IOError('disk full')
+      return add_to_current_metadata(videos, *args)
+    metadata._add_to_current_metadata = failing_add
+    self.assertRaises(IOError, metadata.synchronize, self.connect())
+    watermarks = self.read_watermarks(output_directory)
+    self.assertEqual(watermarks['PL00000001']['count'], 23)
+    self.assertEqual(watermarks['PL00000002'], before['PL00000002'])
+    # The next sync picks up the videos that were not merged.
+    metadata._add_to_current_metadata = add_to_current_metadata
+    self.assertEqual(metadata.synchronize(self.connect()), 3)
+    self.assertEqual(self.read_watermarks(output_directory)[
+      'PL00000002']['count'], 23)
+
+  def test_batch_chunks(self):
+    self.fake = fake_youtube_server.FakeAccount(
+      user_account.BATCH_REQUEST_SIZE * 2 + 10, 1)
+    self.server.account = self.fake
+    account = self.connect(use_batch=True)
+    playlist_ids = [p['id'] for p in self.fake.playlists]
+    self.server.reset_stats()
+    account.prefetch_first_pages(playlist_ids)
+    self.assertEqual(self.server.requests['batch'], 3)
+    self.assertEqual(self.server.requests['playlistItems'], len(playlist_ids))
+    # The prefetched pages are used rather than requested again.
+    self.server.reset_stats()
+    videos = account.get_playlist_videos(playlist_ids[-1], fetch_lengths=False)
+    self.assertEqual(len(videos), 1)
+    self.assertEqual(self.server.requests, {})
+
+  def test_clone(self):
+    account = self.connect(use_batch=True, pipeline_lengths=True)
+    account.prefetch_first_pages(['PL00000001'])
+    clone = account.clone()
+    self.assertTrue(clone.rate_limiter is account.rate_limiter)
+    self.assertFalse(clone.youtube_service is account.youtube_service)
+    # The clone uses the page prefetched by the account, only once.
+    self.server.reset_stats()
+    self.assertEqual(len(clone.get_playlist_videos('PL00000001')), 20)
+    self.assertEqual(self.server.requests.get('playlistItems'), 3)
+    self.assertEqual(account.first_pages, {})
+    # The clone has its own lookup threads, stopped with the account.
+    self.assertEqual(account.length_workers['pool'], None)
+    self.assertNotEqual(clone.length_workers['pool'], None)
+    account.close()
+    self.assertEqual(clone.length_workers['pool'], None)
+    self.assertEqual(account.clones, [])
+
+  def test_batch_part_error(self):
+    from apiclient.errors import HttpError
+    account = self.connect(use_batch=True)
+    self.server.reset_stats()
+    self.assertRaises(HttpError, account.prefetch_first_pages,
+                      ['PL00000001', 'PLmissing', 'PL00000002'])
+    # The whole batch was sent in one request.
+    self.assertEqual(self.server.requests['batch'], 1)
+    self.assertEqual(self.server.requests['playlistItems'], 3)
+
+  def test_page_size(self):
+    for (page_size, num_requests) in [(5, 4), (7, 3), (50, 1)]:
+      account = self.connect(page_size=page_size)
+      self.server.reset_stats()
+      videos = account.get_playlist_videos('PL00000001', fetch_lengths=False)
+      self.assertEqual(len(videos), 20)
+      self.assertEqual(self.server.requests['playlistItems'], num_requests)
+
+  def test_page_size_change_ignores_watermark(self):
+    watermarks = {}
+    self.connect(page_size=5).get_playlist_videos(
+      'PL00000001', fetch_lengths=False, watermarks=watermarks)
+    self.add_videos('PL00000001', 1)
+    # Page tokens of the watermark are not valid with another page size.
+    videos = self.connect(page_size=7).get_playlist_videos(
+      'PL00000001', fetch_lengths=False, watermarks=watermarks)
+    self.assertEqual(len(videos), 21)
+    self.assertEqual(watermarks['PL00000001']['page_size'], 7)
+
+  def sync_pipelined(self, **kwargs):
+    """Sync with pipeline_lengths, recording pages and length lookups."""
+    self.server.latency = 0.02
+    self.add_videos('PL00000001', 100)
+    account = self.connect(pipeline_lengths=True)
+    self.events = []
+    self.threads = []
+    list_playlist_items = account._list_playlist_items
+    def list_items(playlist_id, page_token):
+      self.events.append('page')
+      return list_playlist_items(playlist_id, page_token)
+    account._list_playlist_items = list_items
+    get_video_length = account._get_video_length_in_worker
+    def get_lengths(video_ids):
+      self.events.append(len(video_ids))
+      self.threads.append(threading.current_thread())
+      return get_video_length(video_ids)
+    account._get_video_length_in_worker = get_lengths
+    metadata = local_metadata.LocalMetadata(
+      os.path.join(self.temp_directory, 'output'), verbose=True)
+    metadata.synchronize(account, **kwargs)
+    feeds = metadata.get_metadata_feeds()
+    lengths = [meta['length'] for f in feeds for meta in metadata.iter_feed(f)]
+    self.assertEqual(len(lengths), 160)
+    self.assertFalse(None in lengths)
+    return account
+
+  def test_pipeline_lengths(self):
+    account = self.sync_pipelined(
+      on_added=lambda filename, entries: None)
+    # Lengths are looked up in full requests while the next pages are
+    # fetched, and the rest once the last page of each playlist is fetched.
+    lookups = [e for e in self.events if e != 'page']
+    self.assertEqual(sorted(lookups), [20, 20, 20, 50, 50])
+    self.assertTrue('page' in self.events[self.events.index(50):])
+    # The lookup threads are stopped once the sync is done.
+    self.assertTrue(self.threads)
+    self.assertEqual(account.length_workers['pool'], None)
+    self.assertFalse([t for t in self.threads if t.is_alive()])
+
+  def test_pipeline_lengths_without_on_added(self):
+    self.sync_pipelined()
+    lookups = [e for e in self.events if e != 'page']
+    self.assertEqual(sorted(lookups), [20, 20, 20, 50, 50])
+    self.assertTrue('page' in self.events[self.events.index(50):])
+
+
+if __name__ == '__main__':
+  unittest.main()
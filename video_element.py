@@ -2,8 +2,13 @@
 
 """VideoElement plain old data."""
 
+import data_util
+
 
 class VideoElement(object):
+  __slots__ = ('title', 'description', 'published', 'timestamp', 'video_id',
+               'safename', 'url', 'length')
+
   def __init__(self):
     self.title = None
     self.description = None
@@ -14,6 +19,20 @@ class VideoElement(object):
     self.url = None
     self.length = None
 
+  @classmethod
+  def from_playlist_item(cls, item):
+    """Create an element from an item of a playlistItems API response."""
+    snippet = item['snippet']
+    element = cls()
+    element.title = snippet['title']
+    element.description = snippet['description']
+    element.published = snippet['publishedAt']
+    element.timestamp = data_util.create_timestamp(element.published)
+    element.video_id = video_id = item['contentDetails']['videoId']
+    element.safename = data_util.normalize_name(element.title) + '-' + video_id
+    element.url = 'http://youtube.com/watch?v=' + video_id
+    return element
+
   def to_json(self):
     return {'title':self.title,
             'description': self.description,
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""Index of plugin results for each video, across all feeds.
+
+The same video is often found in several playlists. The index, kept in
+output_directory/data/videos.json, records the plugin status and output file
+for each video_id, so that plugins run once per video:
+
+{
+  "XXXXXXXXXXX": {"status": "success", "artifact": "files/video-title.mp4"},
+  ...
+}
+
+Several processes may share the index. Each saves only the results it added,
+merged into the file as it is on disk at that time.
+"""
+
+import errno
+import os
+import sys
+import threading
+
+import json
+
+import file_util
+
+
+class VideoIndex(object):
+  def __init__(self, output_directory):
+    self.output_directory = output_directory
+    self.path = os.path.join(output_directory, 'data', 'videos.json')
+    self.videos = {}
+    # Results added since the index was last saved.
+    self.changes = {}
+    self.signature = None
+    self.dirty = False
+    # Plugin workers record results while the index is refreshed.
+    self.lock = threading.Lock()
+
+  def load(self):
+    """Load the index from disk, if it exists."""
+    videos = self._read()
+    if not videos is None:
+      with self.lock:
+        videos.update(self.changes)
+        self.videos = videos
+
+  def refresh(self):
+    """Load the index again if another process has saved it since."""
+    if self._signature() != self.signature:
+      self.load()
+
+  def save(self):
+    """Save the index to disk, if it has been modified."""
+    if not self.dirty:
+      return
+    with file_util.output_lock(self.output_directory, self.path):
+      self.load()
+      with self.lock:
+        content = json.dumps(self.videos, indent=2, separators=(',', ': '))
+        saved = dict(self.changes)
+      file_util.write_atomic(self.path, [content])
+      self.signature = self._signature()
+    with self.lock:
+      # Keep results recorded while saving for the next save.
+      for video_id, result in saved.items():
+        if self.changes.get(video_id) is result:
+          del self.changes[video_id]
+      self.dirty = bool(self.changes)
+
+  def get(self, video_id):
+    """Return the recorded result for the video, or None."""
+    return self.videos.get(video_id)
+
+  def put(self, video_id, status, artifact=None):
+    with self.lock:
+      self.videos[video_id] = {'status': status, 'artifact': artifact}
+      self.changes[video_id] = self.videos[video_id]
+      self.dirty = True
+
+  def _read(self):
+    try:
+      fp = open(self.path, 'r')
+    except IOError:
+      e = sys.exc_info()[1]
+      if e.errno == errno.ENOENT:
+        return None
+      else:
+        raise
+    self.signature = self._signature(fp.fileno())
+    content = fp.read()
+    fp.close()
+    return json.loads(content)
+
+  def _signature(self, fd=None):
+    try:
+      if fd is None:
+        stat = os.stat(self.path)
+      else:
+        stat = os.fstat(fd)
+    except OSError:
+      e = sys.exc_info()[1]
+      if e.errno == errno.ENOENT:
+        return None
+      else:
+        raise
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
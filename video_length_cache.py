@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""Persistent cache of video lengths, shared by all playlists.
+
+Video durations never change, so lengths looked up once are kept in
+output_directory/data/lengths.json. The file holds a list of [video_id, length]
+pairs, least recently used first. When the cache grows past its maximum size,
+the least recently used entries are evicted.
+
+Hits only reorder the cache in memory. The order is written along with the
+next added entries, so that a sync finding every length in the cache does not
+rewrite the file.
+"""
+
+import collections
+import errno
+import sys
+import threading
+
+import json
+
+import file_util
+
+
+CACHE_MAX_SIZE = 200000
+
+
+class VideoLengthCache(object):
+  def __init__(self, path, max_size=CACHE_MAX_SIZE):
+    self.path = path
+    self.max_size = max_size
+    self.lengths = collections.OrderedDict()
+    self.dirty = False
+    # Playlists fetched in parallel may share the cache.
+    self.lock = threading.Lock()
+
+  def load(self):
+    """Load the cache from disk, if it exists."""
+    try:
+      fp = open(self.path, 'r')
+    except IOError:
+      e = sys.exc_info()[1]
+      if e.errno == errno.ENOENT:
+        return
+      else:
+        raise
+    content = fp.read()
+    fp.close()
+    for video_id, length in json.loads(content):
+      self.lengths[video_id] = length
+
+  def save(self):
+    """Save the cache to disk, if it has been modified."""
+    with self.lock:
+      if not self.dirty:
+        return
+      while len(self.lengths) > self.max_size:
+        self.lengths.popitem(last=False)
+      content = json.dumps(list(self.lengths.items()))
+      self.dirty = False
+    file_util.write_atomic(self.path, [content])
+
+  def get(self, video_id):
+    """Return the cached length of the video, or None."""
+    with self.lock:
+      length = self.lengths.pop(video_id, None)
+      if length is None:
+        return None
+      # Reinsert to mark as most recently used.
+      self.lengths[video_id] = length
+      return length
+
+  def put(self, video_id, length):
+    with self.lock:
+      if self.lengths.pop(video_id, None) != length:
+        self.dirty = True
+      self.lengths[video_id] = length
+
+
+def fill_lengths(videos, length_cache, get_video_length):
+  """Set the length of each VideoElement that doesn't already have one.
+
+  Video ids are deduplicated, then looked up in the cache. Remaining ids are
+  passed all at once to get_video_length, so that requests are as full as
+  possible.
+  """
+  missing = []
+  seen = set()
+  for element in videos:
+    if element.length is not None or element.video_id in seen:
+      continue
+    seen.add(element.video_id)
+    if length_cache is None or length_cache.get(element.video_id) is None:
+      missing.append(element.video_id)
+  lengths = {}
+  if missing:
+    lengths = get_video_length(missing)
+  for video_id, length in lengths.items():
+    if length_cache is not None:
+      length_cache.put(video_id, length)
+  for element in videos:
+    if element.length is not None:
+      continue
+    if element.video_id in lengths:
+      element.length = lengths[element.video_id]
+    elif length_cache is not None:
+      element.length = length_cache.get(element.video_id)
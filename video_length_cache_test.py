@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import video_length_cache
+
+
+class VideoLengthCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.temp_directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.temp_directory, 'lengths.json')
+
+  def tearDown(self):
+    shutil.rmtree(self.temp_directory)
+
+  def create_cache(self, max_size=3):
+    cache = video_length_cache.VideoLengthCache(self.path, max_size=max_size)
+    cache.load()
+    return cache
+
+  def test_save_and_load(self):
+    cache = self.create_cache()
+    cache.put('v1', 10)
+    cache.put('v2', 20)
+    cache.save()
+    self.assertEqual(os.listdir(self.temp_directory), ['lengths.json'])
+    cache = self.create_cache()
+    self.assertEqual(cache.get('v1'), 10)
+    self.assertEqual(cache.get('v2'), 20)
+    self.assertEqual(cache.get('v3'), None)
+
+  def test_hits_do_not_save(self):
+    cache = self.create_cache()
+    cache.put('v1', 10)
+    cache.save()
+    mtime = os.stat(self.path).st_mtime
+    os.utime(self.path, (mtime - 100, mtime - 100))
+    cache = self.create_cache()
+    cache.get('v1')
+    cache.put('v1', 10)
+    self.assertFalse(cache.dirty)
+    cache.save()
+    self.assertEqual(os.stat(self.path).st_mtime, mtime - 100)
+
+  def test_evict_least_recently_used(self):
+    cache = self.create_cache()
+    for (video_id, length) in [('v1', 10), ('v2', 20), ('v3', 30)]:
+      cache.put(video_id, length)
+    cache.save()
+    cache = self.create_cache()
+    # The order of hits is saved along with added entries.
+    cache.get('v1')
+    cache.put('v4', 40)
+    cache.save()
+    cache = self.create_cache()
+    self.assertEqual(list(cache.lengths.keys()), ['v3', 'v1', 'v4'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -3,24 +3,97 @@
 """Frontend for Youtube Metadata Sync."""
 
 
+import os
 import sys
 
+import json
+
 import execute_plugins
 import local_metadata
+import multi_account
+import query_index
+import rate_limiter
+import run_metrics
+import sync_daemon
 import user_account
 
 
 def usage():
   print("""Usage: python youtube_metadata_sync.py [command] [-o [output]] [-v] [-a]
+                                               [-j [jobs]] [--page-size [size]]
+                                               [--batch] [-b [backend]]
+                                               [--prometheus [path]]
+                                               [--rate [requests]]
+                                               [--pipeline]
+                                               [--min-interval [seconds]]
+                                               [--auth [file]]
+                                               [--accounts [config]]
+                                               [--api-url [url]]
+                                               [--max-interval [seconds]]
+                                               [--text [words]]
+                                               [--min-length [seconds]]
+                                               [--max-length [seconds]]
+                                               [--status [status]]
+                                               [--since [timestamp]]
+                                               [--until [timestamp]]
+                                               [--limit [count]] [--reindex]
   Commands:
       init     Initialize your metadata repository.
       update   Sync and execute any plugins.
       sync     Synchronize new metadata since the last run.
       execute  Run plugins for any items with no status attribute.
+      migrate  Move json metadata into an sqlite database.
+      export   Write metadata as feed.json files, whatever the backend.
+      compact  Fold statuses and segments back into each feed.json.
+      daemon   Keep running, syncing each playlist and executing plugins as
+               often as it changes.
+      query    Print the entries matching all of the query options, newest
+               first, one json object per line.
   Options:
    -o output   Output directory.
    -v          Verbose logging.
    -a          Skip authentication flow, just use existing auth.json.
+   -j jobs     Number of playlists to fetch, or plugins to run, at the same
+               time (--jobs).
+   --page-size size
+               Number of playlist items to request per page, up to 50.
+   --batch     Group independent API calls into batch HTTP requests.
+   -b backend  Metadata storage, 'json', 'segmented' or 'sqlite' (--backend).
+               Existing sqlite databases are detected automatically.
+   --prometheus path
+               Also write run metrics to path, for the Prometheus textfile
+               collector. Metrics are always written to output/metrics.json.
+   --rate requests
+               Maximum API requests per second. Throttled and failed requests
+               are retried with backoff.
+   --pipeline  Look up video lengths while playlist pages are still being
+               fetched. With update and daemon, also run plugins on new videos
+               while the sync is still going on.
+   --min-interval seconds, --max-interval seconds
+               With daemon, the shortest and longest time between checks of a
+               playlist. Defaults to 5 minutes and a week.
+   --auth file Credentials file, auth.json by default.
+   --accounts config
+               Run the command for each account listed in the config file,
+               in a pool of processes, instead of for -o output. See
+               multi_account.py.
+   --api-url url
+               Call a local stand-in for the API at url, without credentials,
+               such as fake_youtube_server.py.
+   --text words
+               With query, entries with all of the words in their title or
+               description.
+   --min-length seconds, --max-length seconds
+               With query, entries with a length in the given range.
+   --status status
+               With query, entries with the given status, or 'none' for
+               entries with no status.
+   --since timestamp, --until timestamp
+               With query, entries published in the given range.
+   --limit count
+               With query, print at most count entries.
+   --reindex   With query, index every feed again first, such as after feeds
+               were modified by hand.
 """)
   sys.exit(1)
 
@@ -31,6 +104,20 @@ class CommandLine(object):
     self.command = None
     self.verbose = None
     self.authenticated = False
+    self.jobs = 1
+    self.page_size = user_account.PLAYLIST_PAGE_SIZE
+    self.batch = False
+    self.backend = None
+    self.prometheus = None
+    self.rate = rate_limiter.DEFAULT_RATE
+    self.pipeline = False
+    self.min_interval = sync_daemon.MIN_INTERVAL
+    self.max_interval = sync_daemon.MAX_INTERVAL
+    self.auth = user_account.AUTHENTICATION_FILE
+    self.accounts = None
+    self.api_url = None
+    self.query = {}
+    self.reindex = False
 
 
 def get_command_line(args):
@@ -44,43 +131,174 @@ def get_command_line(args):
       cmdline.verbose = True
     elif args[i] == '-a':
       cmdline.authenticated = True
+    elif args[i] in ['-j', '--jobs']:
+      i += 1
+      cmdline.jobs = int(args[i])
+    elif args[i] == '--page-size':
+      i += 1
+      cmdline.page_size = int(args[i])
+    elif args[i] == '--batch':
+      cmdline.batch = True
+    elif args[i] in ['-b', '--backend']:
+      i += 1
+      cmdline.backend = args[i]
+    elif args[i] == '--prometheus':
+      i += 1
+      cmdline.prometheus = args[i]
+    elif args[i] == '--rate':
+      i += 1
+      cmdline.rate = float(args[i])
+    elif args[i] == '--pipeline':
+      cmdline.pipeline = True
+    elif args[i] == '--min-interval':
+      i += 1
+      cmdline.min_interval = int(args[i])
+    elif args[i] == '--max-interval':
+      i += 1
+      cmdline.max_interval = int(args[i])
+    elif args[i] == '--auth':
+      i += 1
+      cmdline.auth = args[i]
+    elif args[i] == '--accounts':
+      i += 1
+      cmdline.accounts = args[i]
+    elif args[i] == '--api-url':
+      i += 1
+      cmdline.api_url = args[i]
+    elif args[i] == '--text':
+      i += 1
+      cmdline.query['text'] = args[i]
+    elif args[i] in ['--min-length', '--max-length', '--since', '--until',
+                     '--limit']:
+      name = args[i][2:].replace('-', '_')
+      i += 1
+      cmdline.query[name] = int(args[i])
+    elif args[i] == '--status':
+      i += 1
+      if args[i] == 'none':
+        cmdline.query['status'] = query_index.NO_STATUS
+      else:
+        cmdline.query['status'] = args[i]
+    elif args[i] == '--reindex':
+      cmdline.reindex = True
     else:
       cmdline.command = args[i]
     i += 1
-  if not cmdline.output or not cmdline.command:
+  if not (cmdline.output or cmdline.accounts) or not cmdline.command:
     usage()
   return cmdline
 
 
 def run():
   cmdline = get_command_line(sys.argv[1:])
-  account = user_account.UserAccount()
+  if cmdline.accounts:
+    multi_account.run_accounts(cmdline)
+  else:
+    run_command(cmdline)
+
+
+def run_command(cmdline, rate_bucket=None):
+  """Run the command for the account and output directory of cmdline.
+
+  Return the metrics of the run.
+  """
+  metrics = run_metrics.RunMetrics(cmdline.command)
   if cmdline.command == 'init':
+    account = create_account(cmdline, metrics, rate_bucket)
     if not cmdline.authenticated:
       account.authenticate()
-    account.connect()
-    metadata = local_metadata.LocalMetadata(cmdline.output, cmdline.verbose)
+    account.connect(cmdline.api_url)
+    metadata = local_metadata.LocalMetadata(cmdline.output, cmdline.verbose,
+                                            cmdline.jobs, cmdline.backend)
     metadata.create_init(account)
   elif cmdline.command == 'update':
-    account.connect()
-    metadata = local_metadata.LocalMetadata(cmdline.output, cmdline.verbose)
-    num_added = metadata.synchronize(account, quiet=True)
-    if num_added > 0:
-      print('Sync found %d new videos.' % (num_added,))
-    executor = execute_plugins.ExecutePlugins()
-    executor.execute(metadata)
+    account = create_account(cmdline, metrics, rate_bucket)
+    account.connect(cmdline.api_url)
+    metadata = local_metadata.LocalMetadata(cmdline.output, cmdline.verbose,
+                                            cmdline.jobs, cmdline.backend)
+    executor = execute_plugins.ExecutePlugins(cmdline.jobs, metrics)
+    if cmdline.pipeline:
+      # Plugins run on new videos while the sync continues.
+      num_added = executor.execute(metadata, sync=lambda on_added:
+        metadata.synchronize(account, quiet=True, on_added=on_added))
+      if num_added > 0:
+        print('Sync found %d new videos.' % (num_added,))
+    else:
+      num_added = metadata.synchronize(account, quiet=True)
+      if num_added > 0:
+        print('Sync found %d new videos.' % (num_added,))
+      executor.execute(metadata)
+    metrics.record_new_videos(num_added)
   elif cmdline.command == 'sync':
-    account.connect()
-    metadata = local_metadata.LocalMetadata(cmdline.output, cmdline.verbose)
+    account = create_account(cmdline, metrics, rate_bucket)
+    account.connect(cmdline.api_url)
+    metadata = local_metadata.LocalMetadata(cmdline.output, cmdline.verbose,
+                                            cmdline.jobs, cmdline.backend)
     num_added = metadata.synchronize(account, quiet=False)
+    metrics.record_new_videos(num_added)
     if num_added > 0:
       print('Sync found %d new videos.' % (num_added,))
+  elif cmdline.command == 'daemon':
+    account = create_account(cmdline, metrics, rate_bucket)
+    account.connect(cmdline.api_url)
+    metadata = local_metadata.LocalMetadata(cmdline.output, cmdline.verbose,
+                                            cmdline.jobs, cmdline.backend)
+    executor = execute_plugins.ExecutePlugins(cmdline.jobs, metrics)
+    daemon = sync_daemon.SyncDaemon(
+      metadata, account, executor, cmdline.min_interval, cmdline.max_interval,
+      on_pass=lambda: write_metrics(metrics, cmdline))
+    daemon.run()
   elif cmdline.command == 'execute':
-    metadata = local_metadata.LocalMetadata(cmdline.output, cmdline.verbose)
-    executor = execute_plugins.ExecutePlugins()
+    metadata = local_metadata.LocalMetadata(cmdline.output, cmdline.verbose,
+                                            cmdline.jobs, cmdline.backend)
+    executor = execute_plugins.ExecutePlugins(cmdline.jobs, metrics)
     executor.execute(metadata)
+  elif cmdline.command == 'migrate':
+    metadata = local_metadata.LocalMetadata(cmdline.output, cmdline.verbose,
+                                            cmdline.jobs, 'json')
+    metadata.migrate(cmdline.backend or 'sqlite')
+  elif cmdline.command == 'export':
+    metadata = local_metadata.LocalMetadata(cmdline.output, cmdline.verbose,
+                                            cmdline.jobs, cmdline.backend)
+    metadata.export_json()
+  elif cmdline.command == 'compact':
+    metadata = local_metadata.LocalMetadata(cmdline.output, cmdline.verbose,
+                                            cmdline.jobs, cmdline.backend)
+    metadata.compact()
+  elif cmdline.command == 'query':
+    metadata = local_metadata.LocalMetadata(cmdline.output, cmdline.verbose,
+                                            cmdline.jobs, cmdline.backend)
+    if cmdline.reindex:
+      metadata.rebuild_query_index()
+    for entry in metadata.query(**cmdline.query):
+      print(json.dumps(entry, sort_keys=True))
   else:
     raise RuntimeError('Uknown command %s' % args[0])
+  if cmdline.command in ['init', 'update', 'sync', 'execute']:
+    write_metrics(metrics, cmdline)
+  return metrics
+
+
+def create_account(cmdline, metrics, rate_bucket=None):
+  """Create the account, only for commands that call the API."""
+  discovery_cache = os.path.join(cmdline.output, 'data', 'discovery.json')
+  account = user_account.UserAccount(page_size=cmdline.page_size,
+                                     use_batch=cmdline.batch,
+                                     rate=cmdline.rate,
+                                     discovery_cache=discovery_cache,
+                                     auth_file=cmdline.auth,
+                                     rate_bucket=rate_bucket,
+                                     pipeline_lengths=cmdline.pipeline)
+  account.metrics = metrics
+  return account
+
+
+def write_metrics(metrics, cmdline):
+  if not os.path.isdir(cmdline.output):
+    return
+  metrics.write_json(os.path.join(cmdline.output, 'metrics.json'))
+  if cmdline.prometheus:
+    metrics.write_prometheus(cmdline.prometheus)
 
 
 if __name__ == '__main__':